@@ -0,0 +1,127 @@
+"""Read-only HTTP API serving the latest site state from memory as JSON."""
+
+import json
+import zlib
+import asyncio
+import logging
+
+from aiohttp import web
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import API_PORT
+except ImportError:
+    API_PORT = None
+
+try:
+    from configuration import API_HOST
+except ImportError:
+    API_HOST = '127.0.0.1'
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Longest a request may wait for a change with '?wait=<seconds>'
+API_LONG_POLL_MAX = 300
+
+# name -> {'body': bytes, 'etag': str, 'changed': asyncio.Event}
+resources = {}
+local_vars = {}
+
+
+def update(name, data):
+    """Replace the state of a resource, encoded once here so requests only copy bytes."""
+    body = json.dumps(data, separators=(',', ':'), default=str).encode()
+    etag = f'"{zlib.crc32(body):08x}"'
+    resource = resources.get(name, None)
+    if resource is None:
+        resources[name] = {'body': body, 'etag': etag, 'changed': asyncio.Event()}
+        return
+    if resource['etag'] == etag:
+        return
+    resource['body'] = body
+    resource['etag'] = etag
+    changed = resource['changed']
+    resource['changed'] = asyncio.Event()
+    changed.set()
+
+
+def remove(name):
+    """Remove a resource, waiting requests are answered with 404."""
+    resource = resources.pop(name, None)
+    if resource:
+        resource['changed'].set()
+
+
+async def handle_index(request):
+    """Serve the list of resources and their ETags."""
+    return web.json_response({name: resource['etag'] for name, resource in sorted(resources.items())})
+
+
+async def handle_resource(request):
+    """Serve a resource, '304 Not Modified' if it matches If-None-Match.
+
+    With '?wait=<seconds>' a matching request is held until the resource changes or the wait ends.
+    """
+    name = request.match_info['name']
+    resource = resources.get(name, None)
+    if resource is None:
+        raise web.HTTPNotFound(text=f"unknown resource '{name}'")
+
+    if request.headers.get('If-None-Match', None) == resource['etag']:
+        try:
+            wait = min(float(request.query.get('wait', 0)), API_LONG_POLL_MAX)
+        except ValueError:
+            raise web.HTTPBadRequest(text="'wait' must be a number of seconds")
+        if wait > 0:
+            try:
+                await asyncio.wait_for(resource['changed'].wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            resource = resources.get(name, None)
+            if resource is None:
+                raise web.HTTPNotFound(text=f"unknown resource '{name}'")
+        if request.headers.get('If-None-Match', None) == resource['etag']:
+            return web.Response(status=304, headers={'ETag': resource['etag']})
+
+    return web.Response(body=resource['body'], content_type='application/json', headers={'ETag': resource['etag'], 'Cache-Control': 'no-cache'})
+
+
+#
+# Public
+#
+
+async def start():
+    """Start the API server if a port is configured."""
+    if not API_PORT:
+        return True
+
+    app = web.Application()
+    app.router.add_get('/api', handle_index)
+    app.router.add_get('/api/{name:.+}', handle_resource)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, API_HOST, API_PORT).start()
+    except OSError as e:
+        logger.error(f"Unable to start the API server on {API_HOST}:{API_PORT}: {e}")
+        await runner.cleanup()
+        return False
+
+    local_vars['runner'] = runner
+    logger.info(f"API available at http://{API_HOST}:{API_PORT}/api")
+    return True
+
+
+def running():
+    """Return True if the API server is running."""
+    return 'runner' in local_vars
+
+
+async def stop():
+    """Stop the API server, waiting long-poll requests are answered first so the shutdown is not held up."""
+    runner = local_vars.pop('runner', None)
+    if runner:
+        for resource in resources.values():
+            resource['changed'].set()
+        await runner.cleanup()
@@ -0,0 +1,165 @@
+"""Daily columnar archive of the samples, production history, and clear-sky curves.
+
+Each day is written after midnight as Arrow IPC files (or Parquet) in ARCHIVE_DIRECTORY:
+    <day>.samples.arrow     time, inverter, key, value      every poll of the sampled keys
+    <day>.history.arrow     time, inverter, value           the inverter production meter history
+    <day>.clearsky.arrow    time, name, value               the expected clear-sky production (W)
+
+Uncompressed Arrow files can be memory mapped and read without copying:
+    with pyarrow.memory_map('log/archive/2021-01-19.samples.arrow') as source:
+        table = pyarrow.ipc.open_file(source).read_all()
+"""
+
+import os
+import asyncio
+import logging
+
+import numpy as np
+
+from configuration import APPLICATION_LOG_LOGGER_NAME, APPLICATION_LOG_FILE
+
+try:
+    from configuration import ARCHIVE_ENABLE
+except ImportError:
+    ARCHIVE_ENABLE = False
+
+try:
+    from configuration import ARCHIVE_DIRECTORY
+except ImportError:
+    ARCHIVE_DIRECTORY = os.path.join(os.path.dirname(APPLICATION_LOG_FILE), 'archive')
+
+try:
+    from configuration import ARCHIVE_FORMAT
+except ImportError:
+    ARCHIVE_FORMAT = 'arrow'
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Hours of samples kept by each inverter while archiving, a day and the margin until the midnight task runs
+ARCHIVE_HOURS = 25
+
+FORMATS = ['arrow', 'parquet']
+
+
+def encode(labels):
+    """Return (codes, dictionary) of a sequence of labels."""
+    dictionary = sorted(set(labels))
+    positions = {label: code for code, label in enumerate(dictionary)}
+    return np.fromiter((positions[label] for label in labels), dtype=np.int32, count=len(labels)), dictionary
+
+
+def sample_columns(inverters, start, stop):
+    """Copy the samples of each inverter from start up to stop (timestamps) into archive columns."""
+    times, inverter_codes, key_codes, values = [], [], [], []
+    inverter_names, keys = [], []
+    for inverter in inverters:
+        samples = inverter.samples()
+        if samples is None:
+            continue
+        inverter_names.append(inverter.name())
+        for name in samples.series:
+            series_times, series_values = samples.slice(name, start, stop)
+            if name not in keys:
+                keys.append(name)
+            times.append(series_times)
+            values.append(series_values)
+            inverter_codes.append(np.full(len(series_times), len(inverter_names) - 1, dtype=np.int32))
+            key_codes.append(np.full(len(series_times), keys.index(name), dtype=np.int32))
+    if not times:
+        return None
+    return {
+        'time': np.concatenate(times),
+        'inverter': (np.concatenate(inverter_codes), inverter_names),
+        'key': (np.concatenate(key_codes), keys),
+        'value': np.concatenate(values),
+    }
+
+
+def history_columns(production):
+    """Return archive columns of a production history, as returned by PVSite.get_production_history()."""
+    times, names, values = [], [], []
+    for inverter in production:
+        name = inverter[0].get('inverter')
+        for entry in inverter[1:]:
+            times.append(entry['t'])
+            names.append(name)
+            values.append(np.nan if entry['v'] is None else entry['v'])
+    if not times:
+        return None
+    return {
+        'time': np.array(times, dtype=np.float64),
+        'inverter': encode(names),
+        'value': np.array(values, dtype=np.float64),
+    }
+
+
+def clearsky_columns(timestamps, names, production):
+    """Return archive columns of the expected production, one row of 'production' per name."""
+    names = ['/'.join(name) if isinstance(name, tuple) else name for name in names]
+    return {
+        'time': np.tile(np.asarray(timestamps, dtype=np.float64), len(names)),
+        'name': (np.repeat(np.arange(len(names), dtype=np.int32), len(timestamps)), names),
+        'value': np.asarray(production, dtype=np.float64).reshape(-1),
+    }
+
+
+def table(columns):
+    """Build a pyarrow table, labels are dictionary encoded and NaN values are nulls."""
+    import pyarrow as pa
+
+    arrays = {}
+    for name, column in columns.items():
+        if name == 'time':
+            arrays[name] = pa.array(np.round(column * 1000).astype(np.int64), type=pa.timestamp('ms', tz='UTC'))
+        elif isinstance(column, tuple):
+            codes, dictionary = column
+            arrays[name] = pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(dictionary, type=pa.string()))
+        else:
+            arrays[name] = pa.array(column, from_pandas=True)
+    return pa.table(arrays)
+
+
+def filename(day, name):
+    """Return the archive file of a day and table name."""
+    return os.path.join(os.path.expanduser(ARCHIVE_DIRECTORY), f"{day.isoformat()}.{name}.{ARCHIVE_FORMAT}")
+
+
+def write(day, tables):
+    """Write the tables of a day, each file is replaced atomically."""
+    import pyarrow as pa
+
+    os.makedirs(os.path.expanduser(ARCHIVE_DIRECTORY), exist_ok=True)
+    for name, columns in tables.items():
+        if columns is None:
+            continue
+        path = filename(day, name)
+        temporary = path + '.tmp'
+        arrow_table = table(columns)
+        if ARCHIVE_FORMAT == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(arrow_table, temporary)
+        else:
+            with pa.OSFile(temporary, 'wb') as sink:
+                with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+                    writer.write_table(arrow_table)
+        os.replace(temporary, path)
+    logger.info(f"Archived {day.isoformat()} to {os.path.expanduser(ARCHIVE_DIRECTORY)}")
+
+
+#
+# Public
+#
+
+async def archive(day, tables):
+    """Write the tables of a day in an executor, the columns must not be changed while writing."""
+    if not ARCHIVE_ENABLE:
+        return
+    if ARCHIVE_FORMAT not in FORMATS:
+        logger.error(f"Unknown ARCHIVE_FORMAT '{ARCHIVE_FORMAT}', use 'arrow' or 'parquet'")
+        return
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, write, day, tables)
+    except ImportError:
+        logger.error("Archiving needs pyarrow, 'pip3 install pyarrow'")
+    except Exception as e:
+        logger.error(f"Unable to archive {day.isoformat()}: {e}")
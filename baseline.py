@@ -0,0 +1,92 @@
+"""Production baselines for the start of each period, read from InfluxDB and cached locally."""
+
+import os
+import json
+import asyncio
+import datetime
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME, APPLICATION_LOG_FILE
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Periods that use a baseline, 'lifetime' always starts at zero
+BASELINE_PERIODS = ['today', 'month', 'year']
+
+
+class BaselineProvider():
+    """Supplies the today/month/year production baselines for the whole fleet."""
+    def __init__(self, influxdb):
+        """Create the provider, the cache file lives next to the application log."""
+        self._influxdb = influxdb
+        self._filename = os.path.join(os.path.dirname(os.path.expanduser(APPLICATION_LOG_FILE)), 'baselines.json')
+        self._cache = {}
+
+    async def baselines(self, names):
+        """Return {inverter: {period: {'t': timestamp, 'v': value}}} for the requested inverters.
+
+        Cached baselines for the current periods are used first, anything missing is read
+        from InfluxDB with a single query, run in an executor.  Periods still missing for an inverter are left
+        out and must be read from the inverter.
+        """
+        starts = period_starts()
+        self.load(starts)
+
+        missing = [name for name in names if len(self._cache.get(name, {})) < len(starts)]
+        if missing:
+            queried = await asyncio.get_event_loop().run_in_executor(None, self._influxdb.query_production_baselines, starts)
+            for name in missing:
+                for period, history in queried.get(name, {}).items():
+                    self._cache.setdefault(name, {}).setdefault(period, history)
+            self.save()
+
+        baselines = {name: self._cache.get(name, {}).copy() for name in names}
+        incomplete = [name for name in names if len(baselines[name]) < len(starts)]
+        if incomplete:
+            logger.info(f"Production baselines incomplete for {incomplete}, reading history from the inverter(s)")
+        return baselines
+
+    def update(self, name, history):
+        """Cache the baselines read from an inverter, call save() to write them out."""
+        for period in BASELINE_PERIODS:
+            if period in history:
+                self._cache.setdefault(name, {})[period] = history[period]
+
+    def load(self, starts):
+        """Load the cached baselines that belong to the current periods."""
+        self._cache = {}
+        try:
+            with open(self._filename, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        for period, start in starts.items():
+            saved_period = saved.get(period, {})
+            if saved_period.get('start') != start:
+                continue
+            for name, history in saved_period.get('baselines', {}).items():
+                self._cache.setdefault(name, {})[period] = history
+
+    def save(self):
+        """Save the cached baselines along with the period start they belong to."""
+        starts = period_starts()
+        saved = {period: {'start': start, 'baselines': {}} for period, start in starts.items()}
+        for name, periods in self._cache.items():
+            for period, history in periods.items():
+                saved[period]['baselines'][name] = history
+        try:
+            with open(self._filename, 'w') as f:
+                json.dump(saved, f)
+        except OSError as e:
+            logger.warning(f"Unable to save the production baselines to '{self._filename}': {e}")
+
+
+def period_starts():
+    """Return the timestamps for the start of the day, month, and year."""
+    today = datetime.date.today()
+    return {
+        'today': int(datetime.datetime.combine(today, datetime.time(0, 0)).timestamp()),
+        'month': int(datetime.datetime.combine(today.replace(day=1), datetime.time(0, 0)).timestamp()),
+        'year': int(datetime.datetime.combine(today.replace(month=1, day=1), datetime.time(0, 0)).timestamp()),
+    }
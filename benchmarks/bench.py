@@ -0,0 +1,205 @@
+"""Micro-benchmarks of the multisma2 hot paths, run offline against simulated inverters.
+
+    python3 benchmarks/bench.py              run and compare with the stored baseline
+    python3 benchmarks/bench.py --save       run and store the results as the new baseline
+    python3 benchmarks/bench.py -k composite only run the benchmarks matching a pattern
+
+Each benchmark reports the median and 95th percentile time per operation and the peak
+memory allocated per operation (measured in a separate tracemalloc pass).  A benchmark
+is flagged when it is slower or allocates more than the baseline by the threshold.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import copy
+import asyncio
+import argparse
+import statistics
+import tracemalloc
+
+import fixtures
+
+import clearsky
+import mqtt
+import pvsite
+from influx import InfluxDB
+from mqttcodec import Codec
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Regressions are flagged when time or memory grow by more than this fraction
+THRESHOLD = 0.20
+
+FLEET_SIZES = [1, 10, 100, 500]
+
+
+class DiscardWriteApi():
+    """InfluxDB write API that drops the records."""
+    def write(self, bucket, record, write_precision):
+        pass
+
+
+def bench_clean():
+    """Inverter.clean() on a getAllOnlValues payload."""
+    keys = fixtures.key_table()
+    inverter = fixtures.make_inverter('inv0', keys)
+    payload = fixtures.instantaneous(keys)
+    return lambda: (copy.deepcopy(payload),), inverter.clean
+
+
+def bench_composite(inverters):
+    """PVSite.get_composite() of the snapshot keys for a fleet."""
+    site = simulated_site(inverters)
+    loop = asyncio.get_event_loop()
+    return lambda: (), lambda: loop.run_until_complete(site.get_composite(pvsite.SITE_SNAPSHOT))
+
+
+def bench_total_production(inverters):
+    """PVSite.update_total_production() for a fleet."""
+    site = simulated_site(inverters)
+    loop = asyncio.get_event_loop()
+    return lambda: (), lambda: loop.run_until_complete(site.update_total_production())
+
+
+def bench_influx_encoding(inverters):
+    """InfluxDB.write_sma_sensors() line protocol encoding of a snapshot."""
+    site = simulated_site(inverters)
+    sensors = asyncio.get_event_loop().run_until_complete(site.get_composite(pvsite.SITE_SNAPSHOT))
+    influxdb = InfluxDB(True)
+    influxdb._client = True
+    influxdb._bucket = 'benchmark'
+    influxdb._write_api = DiscardWriteApi()
+    return lambda: (sensors,), influxdb.write_sma_sensors
+
+
+def bench_mqtt_encoding(inverters, encoding):
+    """mqtt.encode() of a snapshot."""
+    site = simulated_site(inverters)
+    sensors = asyncio.get_event_loop().run_until_complete(site.get_composite(pvsite.SITE_SNAPSHOT))
+    codec = Codec(encoding)
+
+    def encode(sensors):
+        mqtt.local_vars['codec'] = codec
+        return mqtt.encode(sensors)
+    return lambda: (sensors,), encode
+
+
+def bench_irradiance():
+    """clearsky.get_irradiance() for one day at 10 minute intervals."""
+    site = clearsky.site_location(pvsite.SITE_LATITUDE, pvsite.SITE_LONGITUDE, tz=pvsite.TIMEZONE)
+    return lambda: (), lambda: clearsky.get_irradiance(
+        site=site, start='2021-06-21 05:00:00', end='2021-06-21 21:00:00', tilt=30, azimuth=180, freq='10min'
+    )
+
+
+def simulated_site(inverters):
+    """Create a PVSite with simulated inverters and cached state."""
+    keys = fixtures.key_table()
+    site = pvsite.PVSite(None)
+    site._inverters = [fixtures.make_inverter(f'inv{i}', keys, seed=i) for i in range(inverters)]
+    site._keys.refresh(site._inverters, keys.keys())
+    return site
+
+
+def benchmarks():
+    """Return the benchmarks as {name: (setup, function, iterations)}."""
+    cases = {
+        'clean': bench_clean() + (2000,),
+        'irradiance/day': bench_irradiance() + (20,),
+    }
+    for size in FLEET_SIZES:
+        iterations = max(10, 2000 // size)
+        cases[f'composite/{size}'] = bench_composite(size) + (iterations,)
+        cases[f'total_production/{size}'] = bench_total_production(size) + (iterations,)
+        cases[f'influx_encoding/{size}'] = bench_influx_encoding(size) + (iterations,)
+        for encoding in ['json', 'binary']:
+            cases[f'mqtt_encoding/{encoding}/{size}'] = bench_mqtt_encoding(size, encoding) + (iterations,)
+    return cases
+
+
+def measure(setup, function, iterations):
+    """Return the time and memory statistics of a benchmark."""
+    # Warm up caches and lazy initialization
+    for _ in range(min(iterations, 5)):
+        function(*setup())
+
+    times = []
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            args = setup()
+            start = time.perf_counter()
+            function(*args)
+            times.append(time.perf_counter() - start)
+    finally:
+        gc.enable()
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(iterations, 50)):
+            args = setup()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            function(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return {
+        'median_us': round(statistics.median(times) * 1e6, 2),
+        'p95_us': round(times[int(0.95 * (len(times) - 1))] * 1e6, 2),
+        'peak_kib': round(statistics.median(peaks) / 1024, 2),
+    }
+
+
+def compare(name, result, baseline):
+    """Return a description of any regression against the baseline."""
+    previous = baseline.get(name, None)
+    if not previous:
+        return 'new'
+    regressions = []
+    for metric in ['median_us', 'peak_kib']:
+        if previous[metric] and result[metric] > previous[metric] * (1 + THRESHOLD):
+            regressions.append(f"{metric} {previous[metric]} -> {result[metric]}")
+    return 'REGRESSION ' + ', '.join(regressions) if regressions else 'ok'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multisma2 hot path benchmarks')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('-k', dest='pattern', default='', help='only run benchmarks containing this text')
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+
+    results = {}
+    regressed = False
+    for name, (setup, function, iterations) in benchmarks().items():
+        if args.pattern not in name:
+            continue
+        result = measure(setup, function, iterations)
+        status = compare(name, result, baseline)
+        regressed |= status.startswith('REGRESSION')
+        results[name] = result
+        print(f"{name:32} {result['median_us']:>12.2f} us  p95 {result['p95_us']:>12.2f} us  {result['peak_kib']:>10.2f} KiB  {status}")
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {BASELINE_FILE}")
+    return 1 if regressed and not args.save else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Simulated inverter data for the benchmarks, no inverters or network are used."""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inverter import Inverter, compact
+
+# Keys with their metadata type (0 is a value, 1 is a tag), number of phases/strings, and scale
+KNOWN_KEYS = {
+    '6100_0046C200': (0, 1, 1),
+    '6400_0046C300': (0, 1, 1),
+    '6100_40263F00': (0, 1, 1),
+    '6100_00465700': (0, 1, 0.01),
+    '6180_08465A00': (1, 1, 1),
+    '6100_00464800': (0, 1, 0.01),
+    '6100_00464900': (0, 1, 0.01),
+    '6100_00464B00': (0, 1, 0.01),
+    '6380_40251E00': (0, 2, 1),
+    '6380_40451F00': (0, 2, 0.01),
+    '6380_40452100': (0, 2, 0.001),
+    '6180_08416500': (1, 1, 1),
+    '6180_08412800': (1, 1, 1),
+    '6180_08416400': (1, 1, 1),
+    '6180_08414C00': (1, 1, 1),
+    '6400_00260100': (0, 1, 1),
+}
+
+# A Sunny Boy returns about 120 keys in getAllOnlValues
+PAYLOAD_KEYS = 120
+
+
+def key_table():
+    """Return {key: (type, phases, scale)} for a realistic getAllOnlValues payload."""
+    keys = dict(KNOWN_KEYS)
+    rng = random.Random(1)
+    while len(keys) < PAYLOAD_KEYS:
+        key = f'6100_00{rng.randrange(0x10000, 0xFFFFFF):06X}'
+        keys[key] = (rng.choice([0, 0, 0, 1]), rng.choice([1, 1, 3]), rng.choice([1, 0.1, 0.01]))
+    return keys
+
+
+def metadata(keys):
+    """Return the ObjectMetadata_Istl.json dictionary for the keys."""
+    return {key: {'Typ': typ, 'Scale': scale, 'DataFrmt': 2, 'Unit': 18} for key, (typ, _, scale) in keys.items()}
+
+
+def tags():
+    """Return a small l10n dictionary."""
+    return {'18': 'W', '307': 'Ok', '16777213': 'Information not available'}
+
+
+def instantaneous(keys, seed=0):
+    """Return a getAllOnlValues result body for the keys."""
+    rng = random.Random(seed)
+    payload = {}
+    for key, (typ, phases, _) in keys.items():
+        if typ == 0:
+            payload[key] = {'1': [{'val': rng.randrange(0, 5000)} for _ in range(phases)]}
+        else:
+            payload[key] = {'1': [{'val': [{'tag': 307}]}]}
+    return payload
+
+
+def history(start, stop, step=300, total=4_000_000):
+    """Return getLogger records from start to stop."""
+    return [{'t': t, 'v': total + (t - start) // 10} for t in range(start, stop + 1, step)]
+
+
+def make_inverter(name, keys, seed=0):
+    """Create an Inverter with cached state and no session."""
+    inverter = Inverter(name, 'http://127.0.0.1', 'user', 'password', None)
+    inverter._metadata = metadata(keys)
+    inverter._tags = tags()
+    inverter._instantaneous = compact(instantaneous(keys, seed))
+    inverter._history = {
+        'today': {'t': 0, 'v': 4_000_000},
+        'month': {'t': 0, 'v': 3_900_000},
+        'year': {'t': 0, 'v': 3_000_000},
+        'lifetime': {'t': 0, 'v': 0},
+    }
+    return inverter
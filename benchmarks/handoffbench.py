@@ -0,0 +1,129 @@
+"""Measure the collector to sink handoff through the shared-memory ring.
+
+    python3 benchmarks/handoffbench.py                       flood and paced runs, 10 and 100 inverters
+    python3 benchmarks/handoffbench.py --inverters 500 --rate 1000 --duration 10
+
+A consumer process reads the ring the way the sink process does, with the same polling
+backoff, and reports the messages per second and the handoff latency from the put() in
+the collector to the get() in the sink.  'flood' puts messages back to back to find the
+throughput, 'paced' puts --rate messages per second to show the latency of a normal load.
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shmring import SharedRing
+
+# The sink polling interval, doubling while the ring stays empty
+POLL_INTERVAL = (0.001, 0.05)
+
+
+def snapshot(inverters):
+    """Return a site snapshot sensor list like the 10 second task publishes."""
+    names = [f'inv{i}' for i in range(inverters)]
+    power = {name: 1234.5 for name in names}
+    power['site'] = 1234.5 * inverters
+    status = {name: 'Ok' for name in names}
+    return [
+        dict(power, topic='ac_measurements/power', precision=1),
+        dict(power, topic='dc_measurements/power', precision=1),
+        dict(status, topic='status/reason_for_derating'),
+        dict(status, topic='status/general_operating_status'),
+        dict(status, topic='status/grid_relay'),
+        dict(status, topic='status/condition'),
+    ]
+
+
+def consume(ring, results):
+    """Read messages until the stop message and report the throughput and latencies."""
+    latencies = []
+    interval = POLL_INTERVAL[0]
+    first = None
+    while True:
+        message = ring.get()
+        if message is None:
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL[1])
+            continue
+        interval = POLL_INTERVAL[0]
+        sequence, sent, target, method, args = pickle.loads(message)
+        now = time.monotonic()
+        if target is None:
+            break
+        first = first or now
+        latencies.append(now - sent)
+    elapsed = time.monotonic() - first if first else 0
+    ring.close()
+    results.put((len(latencies), elapsed, latencies))
+
+
+def run(mode, inverters, rate, duration, ring_bytes):
+    """Run one benchmark, returns the put cost, throughput, and latency percentiles."""
+    context = multiprocessing.get_context('spawn')
+    ring = SharedRing(size=ring_bytes)
+    results = context.Queue()
+    consumer = context.Process(target=consume, args=(ring, results))
+    consumer.start()
+    time.sleep(0.5)
+
+    sensors = snapshot(inverters)
+    sent = dropped = 0
+    put_time = 0.0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        if mode == 'paced':
+            wait = start + (sent + dropped) / rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        t0 = time.perf_counter()
+        message = pickle.dumps((sent + dropped, time.monotonic(), 'mqtt', 'publish', (sensors,)), pickle.HIGHEST_PROTOCOL)
+        if ring.put(message):
+            sent += 1
+        else:
+            dropped += 1
+        put_time += time.perf_counter() - t0
+    while not ring.put(pickle.dumps((sent + dropped, time.monotonic(), None, None, ()))):
+        time.sleep(0.01)
+
+    received, elapsed, latencies = results.get()
+    consumer.join()
+    ring.close()
+    latencies.sort()
+    percentile = lambda p: round(latencies[int(p * (len(latencies) - 1))] * 1000, 3) if latencies else None
+    return {
+        'bytes': len(message),
+        'put_us': round(put_time / max(sent + dropped, 1) * 1e6, 1),
+        'messages_per_s': round(received / elapsed) if elapsed else None,
+        'dropped': dropped,
+        'latency_p50_ms': percentile(0.50),
+        'latency_p99_ms': percentile(0.99),
+        'latency_max_ms': percentile(1.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multisma2 collector to sink handoff benchmark')
+    parser.add_argument('--inverters', type=int, nargs='+', default=[10, 100], help='inverters per snapshot')
+    parser.add_argument('--mode', nargs='+', default=['flood', 'paced'], choices=['flood', 'paced'], help='benchmarks to run')
+    parser.add_argument('--rate', type=float, default=100, help='messages per second of the paced runs')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per benchmark')
+    parser.add_argument('--ring-bytes', type=int, default=4 * 1024 * 1024, help='ring size, SINK_RING_BYTES')
+    args = parser.parse_args()
+
+    print(f"{'mode':6} {'inverters':>9} {'bytes':>7} {'put us':>8} {'msgs/s':>9} {'dropped':>8} {'lat p50':>9} {'lat p99':>9} {'lat max':>9}")
+    for mode in args.mode:
+        for inverters in args.inverters:
+            r = run(mode, inverters, args.rate, args.duration, args.ring_bytes)
+            print(f"{mode:6} {inverters:>9} {r['bytes']:>7} {r['put_us']:>8} {r['messages_per_s']:>9} {r['dropped']:>8} "
+                  f"{r['latency_p50_ms']:>9} {r['latency_p99_ms']:>9} {r['latency_max_ms']:>9}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
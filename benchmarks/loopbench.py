@@ -0,0 +1,109 @@
+"""Poll a simulated fleet with each event loop backend and report the throughput, lag and CPU.
+
+    python3 benchmarks/loopbench.py                          every installed backend, 10 and 100 inverters
+    python3 benchmarks/loopbench.py --inverters 500 --duration 30 --backend uvloop
+
+The simulator runs in its own process so only multisma2's polling is measured.  A cycle
+is one getAllOnlValues poll of every inverter followed by the site snapshot composite,
+run back to back for the duration while a probe task measures the event loop lag.
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+
+import aiohttp
+
+import simulator
+
+import eventloop
+import pvsite
+from inverter import Inverter
+
+# Seconds between the lag probe wake ups
+PROBE_INTERVAL = 0.01
+
+
+async def probe(lags):
+    """Record how late the event loop runs a sleeping task."""
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def poll(inverters, port, duration):
+    """Start the fleet and poll it for 'duration' seconds."""
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
+        site = pvsite.PVSite(session)
+        site._inverters = [Inverter(f'inv{i}', f'http://127.0.0.1:{port}/inv{i}', 'user', 'password', session) for i in range(inverters)]
+        keys = await asyncio.gather(*(inverter.start() for inverter in site._inverters))
+        if None in keys:
+            raise RuntimeError("Unable to start the simulated inverters")
+        site._keys.refresh(site._inverters, pvsite.MQTT_TOPICS.keys())
+
+        lags = []
+        task = asyncio.ensure_future(probe(lags))
+        cycles = 0
+        cpu = time.process_time()
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            await site.update_instantaneous()
+            await site.get_composite(pvsite.SITE_SNAPSHOT)
+            cycles += 1
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        task.cancel()
+        await asyncio.gather(*(inverter.stop() for inverter in site._inverters))
+
+    lags.sort()
+    return {
+        'polls_per_s': round(cycles * inverters / elapsed, 1),
+        'cycle_ms': round(elapsed / cycles * 1000, 2),
+        'cpu_ms_per_cycle': round(cpu / cycles * 1000, 2),
+        'cpu_percent': round(cpu / elapsed * 100, 1),
+        'lag_p50_ms': round(statistics.median(lags) * 1000, 2) if lags else None,
+        'lag_p99_ms': round(lags[int(0.99 * (len(lags) - 1))] * 1000, 2) if lags else None,
+        'lag_max_ms': round(lags[-1] * 1000, 2) if lags else None,
+    }
+
+
+def run(backend, inverters, port, duration):
+    """Run one benchmark on a new event loop of a backend."""
+    loop = eventloop.new_event_loop(backend)
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(poll(inverters, port, duration))
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multisma2 event loop backend benchmark')
+    parser.add_argument('--inverters', type=int, nargs='+', default=[10, 100], help='fleet sizes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per benchmark')
+    parser.add_argument('--backend', nargs='+', default=eventloop.available_backends(), help='event loop backends')
+    parser.add_argument('--port', type=int, default=18000, help='simulator port')
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=simulator.serve, args=(max(args.inverters), args.port), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        print(f"{'backend':10} {'inverters':>9} {'polls/s':>10} {'cycle ms':>10} {'cpu ms/cycle':>13} {'cpu %':>7} {'lag p50':>9} {'lag p99':>9} {'lag max':>9}")
+        for backend in args.backend:
+            for inverters in args.inverters:
+                r = run(backend, inverters, args.port, args.duration)
+                print(f"{backend:10} {inverters:>9} {r['polls_per_s']:>10} {r['cycle_ms']:>10} {r['cpu_ms_per_cycle']:>13} "
+                      f"{r['cpu_percent']:>7} {r['lag_p50_ms']:>9} {r['lag_p99_ms']:>9} {r['lag_max_ms']:>9}")
+    finally:
+        server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Local SMA WebConnect simulator serving a fleet of inverters on one port.
+
+    python3 benchmarks/simulator.py --inverters 10 --port 18000
+
+Inverter N answers at http://127.0.0.1:<port>/invN with the payloads from fixtures.py.
+"""
+
+import json
+import time
+import argparse
+
+from aiohttp import web
+
+import fixtures
+
+# Device ID in the result bodies
+DEVICE = '0199-B32C0E4A'
+
+# Payload variations served in turn so the values change between polls
+VARIATIONS = 8
+
+
+class Simulator():
+    """WebConnect endpoints of a simulated fleet."""
+    def __init__(self, inverters):
+        """Create the payloads of each inverter."""
+        self._keys = fixtures.key_table()
+        self._metadata = json.dumps(fixtures.metadata(self._keys))
+        self._tags = json.dumps(fixtures.tags())
+        self._payloads = [[fixtures.instantaneous(self._keys, seed=i * VARIATIONS + v) for v in range(VARIATIONS)] for i in range(inverters)]
+        self._polls = [0] * inverters
+
+    def application(self):
+        """Return the aiohttp application."""
+        app = web.Application()
+        app.router.add_post('/inv{inverter:\\d+}/dyn/login.json', self.login)
+        app.router.add_post('/inv{inverter:\\d+}/dyn/logout.json', self.logout)
+        app.router.add_post('/inv{inverter:\\d+}/dyn/getAllOnlValues.json', self.online_values)
+        app.router.add_post('/inv{inverter:\\d+}/dyn/getValues.json', self.values)
+        app.router.add_post('/inv{inverter:\\d+}/dyn/getLogger.json', self.logger)
+        app.router.add_get('/inv{inverter:\\d+}/data/ObjectMetadata_Istl.json', self.metadata)
+        app.router.add_get('/inv{inverter:\\d+}/data/l10n/en-US.json', self.tags)
+        return app
+
+    def payload(self, request):
+        """Return the next instantaneous payload of the requested inverter."""
+        inverter = int(request.match_info['inverter'])
+        self._polls[inverter] += 1
+        return self._payloads[inverter][self._polls[inverter] % VARIATIONS]
+
+    async def login(self, request):
+        return web.json_response({'result': {'sid': f"sim{request.match_info['inverter']}"}})
+
+    async def logout(self, request):
+        return web.json_response({'result': {'isLogin': False}})
+
+    async def online_values(self, request):
+        return web.json_response({'result': {DEVICE: self.payload(request)}})
+
+    async def values(self, request):
+        keys = (await request.json()).get('keys', [])
+        payload = self.payload(request)
+        return web.json_response({'result': {DEVICE: {key: payload[key] for key in keys if key in payload}}})
+
+    async def logger(self, request):
+        body = await request.json()
+        stop = min(body['tEnd'], int(time.time()))
+        return web.json_response({'result': {DEVICE: fixtures.history(body['tStart'], max(stop, body['tStart'] + 300))}})
+
+    async def metadata(self, request):
+        return web.Response(text=self._metadata, content_type='application/json')
+
+    async def tags(self, request):
+        return web.Response(text=self._tags, content_type='application/json')
+
+
+def serve(inverters, port):
+    """Run the simulator until interrupted."""
+    web.run_app(Simulator(inverters).application(), host='127.0.0.1', port=port, access_log=None, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMA WebConnect simulator')
+    parser.add_argument('--inverters', type=int, default=10, help='number of simulated inverters')
+    parser.add_argument('--port', type=int, default=18000, help='port to listen on')
+    args = parser.parse_args()
+    print(f"Simulating {args.inverters} inverters at http://127.0.0.1:{args.port}/inv0 ... /inv{args.inverters - 1}")
+    serve(args.inverters, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,228 @@
 """Module to estimate the clearsky irradiance for a site."""
 
-import pandas as pd
-from pvlib import location, irradiance
+import os
+import asyncio
+import datetime
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 import logging
 from pprint import pprint
 
-from configuration import APPLICATION_LOG_LOGGER_NAME
+from configuration import APPLICATION_LOG_LOGGER_NAME, APPLICATION_LOG_FILE
 
 logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 
+# Resolution of the precomputed clear-sky curves in seconds
+ENGINE_RESOLUTION = 60
+
+# pandas and pvlib are only imported by the functions computing irradiance, multisma2 reads the
+# precomputed curves with numpy and computes new curves in a helper process
+
 
 def site_location(latitude, longitude, tz):
+    from pvlib import location
     site = location.Location(latitude, longitude, tz)
     return site
 
 def get_irradiance(site, start, end, tilt, azimuth, freq):
     """Calculate the clear-sky POA (plane of array) irradiance."""
+    import pandas as pd
+
     # Creates one day's worth of intervals
     times = pd.date_range(start=start, end=end, freq=freq, tz=site.tz)
+    poa = poa_irradiance(site, times, tilt, azimuth)
+
+    # Return value: [{'t': timestamp, 'v': irradiance_value}]
+    timestamps = times.asi8 // 10**9
+    return [{'t': t, 'v': v} for t, v in zip(timestamps.tolist(), poa.tolist())]
+
+def poa_irradiance(site, times, tilt, azimuth):
+    """Return the clear-sky POA irradiance as an array for a DatetimeIndex."""
+    return orientations_irradiance(site, times, [(tilt, azimuth)])[0]
+
+def orientations_irradiance(site, times, orientations):
+    """Return a 2D array with the clear-sky POA irradiance of each (tilt, azimuth) orientation."""
+    from pvlib import irradiance
 
     # Generate clearsky data using the Ineichen model, which is the default
     # The get_clearsky method returns a dataframe with values for GHI, DNI, and DHI
     clearsky = site.get_clearsky(times)
-    
-    # Get solar azimuth and zenith to pass to the transposition function
+
+    # Get solar azimuth and zenith to pass to the transposition function, this is
+    # shared by all the orientations
     solar_position = site.get_solarposition(times=times)
-    
+
     # Use the get_total_irradiance function to transpose the GHI to POA
-    POA_irradiance = irradiance.get_total_irradiance(
-        surface_tilt=tilt,
-        surface_azimuth=azimuth,
-        dni=clearsky['dni'],
-        ghi=clearsky['ghi'],
-        dhi=clearsky['dhi'],
-        solar_zenith=solar_position['apparent_zenith'],
-        solar_azimuth=solar_position['azimuth'])
-
-    # Return a DataFrame with only POA result and convert to a dictionary of time and values
-    today_irradiance = pd.DataFrame({'POA': POA_irradiance['poa_global']})
-    points = []
-    for time, row in today_irradiance.iterrows():
-        dt = pd.to_datetime(time)
-        v = row['POA']
-        points.append({'t': int(dt.timestamp()), 'v': v})
+    poa = np.empty((len(orientations), len(times)), dtype=np.float32)
+    for i, (tilt, azimuth) in enumerate(orientations):
+        POA_irradiance = irradiance.get_total_irradiance(
+            surface_tilt=tilt,
+            surface_azimuth=azimuth,
+            dni=clearsky['dni'],
+            ghi=clearsky['ghi'],
+            dhi=clearsky['dhi'],
+            solar_zenith=solar_position['apparent_zenith'],
+            solar_azimuth=solar_position['azimuth'])
+        poa[i] = POA_irradiance['poa_global'].fillna(0).to_numpy()
+    return poa
 
-    # Return value: [{'t': timestamp, 'v': irradiance_value}]
-    return points
+
+class ArrayModel():
+    """Maps the inverters, their strings, and the site to the panel capacity of each array orientation.
+
+    An inverter entry in INVERTERS may list its arrays, each with an optional string
+    ('a', 'b', 'c'), tilt, azimuth, area, and efficiency that default to the site values:
+        'arrays': [{'string': 'a', 'tilt': 25, 'azimuth': 90, 'area': 30}, ...]
+    """
+    def __init__(self, inverters, tilt, azimuth, area, efficiency):
+        """Build the capacity matrix, rows are the names and columns the orientations."""
+        self.orientations = []
+        capacities = {}
+        for inverter in inverters:
+            name = inverter['name']
+            arrays = inverter.get('arrays', [{'area': inverter.get('area', area / len(inverters))}])
+            for array in arrays:
+                orientation = (array.get('tilt', tilt), array.get('azimuth', azimuth))
+                if orientation not in self.orientations:
+                    self.orientations.append(orientation)
+                column = self.orientations.index(orientation)
+                capacity = array.get('area', area / len(inverters) / len(arrays)) * array.get('efficiency', efficiency)
+                targets = ['site', name]
+                if 'string' in array:
+                    targets.append((name, array['string']))
+                for target in targets:
+                    capacities.setdefault(target, {}).setdefault(column, 0)
+                    capacities[target][column] += capacity
+
+        self.names = list(capacities.keys())
+        self.capacity = np.zeros((len(self.names), len(self.orientations)), dtype=np.float32)
+        for row, name in enumerate(self.names):
+            for column, capacity in capacities[name].items():
+                self.capacity[row, column] = capacity
+
+    def expected(self, poa):
+        """Return the expected production (W) of each name for POA irradiance per orientation.
+
+        'poa' is a 1D array for a single time or a 2D (orientations, times) array.
+        """
+        return self.capacity @ poa
+
+
+class IrradianceEngine():
+    """Clear-sky POA irradiance of every array orientation for a whole year, kept in a memory-mapped array file.
+
+    The curves for a year of the site's local time are computed once for the site geometry
+    and reused across restarts, any day or time range is then a slice of the array.
+    Only prepare() computes curves, until they are loaded the values are None.
+    """
+    def __init__(self, latitude, longitude, orientations, tzinfo=None, resolution=ENGINE_RESOLUTION):
+        """Create the engine for a list of (tilt, azimuth) orientations, no computation is done until prepare()."""
+        self._latitude = latitude
+        self._longitude = longitude
+        self._orientations = orientations
+        self._tzinfo = tzinfo
+        self._resolution = resolution
+        self._directory = os.path.dirname(os.path.expanduser(APPLICATION_LOG_FILE))
+        self._curves = None
+
+    def year(self, timestamp):
+        """Return the local year of a timestamp."""
+        return datetime.datetime.fromtimestamp(timestamp, self._tzinfo).year
+
+    def year_range(self, year):
+        """Return the (start, stop) timestamps of a local year."""
+        start = datetime.datetime(year, 1, 1, tzinfo=self._tzinfo).timestamp()
+        stop = datetime.datetime(year + 1, 1, 1, tzinfo=self._tzinfo).timestamp()
+        return int(start), int(stop)
+
+    def filename(self, year):
+        """Return the array file for a year, keyed by the site geometry and the start of the local year."""
+        geometry = f"{self._latitude},{self._longitude},{self._orientations},{self._resolution},{year},{self.year_range(year)}"
+        return os.path.join(self._directory, f"clearsky_{hashlib.sha1(geometry.encode()).hexdigest()[:16]}.npy")
+
+    def load(self, year):
+        """Map the saved curves for a year into memory, returns False if they are not computed yet."""
+        curves = self._curves
+        if curves and curves[0] == year:
+            return True
+        filename = self.filename(year)
+        if not os.path.isfile(filename):
+            logger.warning(f"The {year} clear-sky irradiance curves are not computed yet")
+            return False
+        self._curves = (year, self.year_range(year)[0], np.load(filename, mmap_mode='r'))
+        return True
+
+    async def prepare(self, year):
+        """Compute the curves for a year in a helper process if they are not saved yet."""
+        filename = self.filename(year)
+        if os.path.isfile(filename):
+            return
+        start, stop = self.year_range(year)
+        args = (self._latitude, self._longitude, self._orientations, self._resolution, year, start, stop, filename)
+        logger.info(f"Computing the {year} clear-sky irradiance curves in a helper process")
+        loop = asyncio.get_event_loop()
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                await loop.run_in_executor(pool, compute_curves, *args)
+        except Exception as e:
+            logger.warning(f"Unable to compute the clear-sky curves in a helper process, computing them in a thread: {e}")
+            await loop.run_in_executor(None, compute_curves, *args)
+
+    def curves(self, timestamp):
+        """Return (start, POA) of the loaded curves if they cover the local year of a timestamp, otherwise None."""
+        curves = self._curves
+        if curves is None or curves[0] != self.year(timestamp):
+            return None
+        return curves[1:]
+
+    def irradiance(self, start, stop, step):
+        """Return (timestamps, POA) from start up to stop (timestamps) every 'step' seconds, POA is (orientations, times).
+
+        Returns (None, None) if the curves of the year are not loaded.
+        """
+        curves = self.curves(start)
+        if curves is None:
+            return None, None
+        year_start, poa = curves
+        points = poa.shape[1]
+        first = max(int((start - year_start) / self._resolution), 0)
+        last = min(int((stop - year_start) / self._resolution), points - 1)
+        stride = max(step // self._resolution, 1)
+        values = poa[:, first:last + 1:stride]
+        timestamps = year_start + np.arange(first, last + 1, stride, dtype=np.int64)[:values.shape[1]] * self._resolution
+        return timestamps, values
+
+    def value(self, timestamp):
+        """Return the POA irradiance of each orientation at a timestamp, linearly interpolated, None if not loaded."""
+        curves = self.curves(timestamp)
+        if curves is None:
+            return None
+        year_start, poa = curves
+        position = (timestamp - year_start) / self._resolution
+        i = min(max(int(position), 0), poa.shape[1] - 2)
+        fraction = position - i
+        return poa[:, i] + (poa[:, i + 1] - poa[:, i]) * fraction
+
+
+def compute_curves(latitude, longitude, orientations, resolution, year, start, stop, filename):
+    """Compute the curves of a local year from 'start' up to 'stop' (timestamps) a month at a time to limit the memory used."""
+    import pandas as pd
+    from pvlib import location
+
+    logger.info(f"Computing the {year} clear-sky irradiance curves for {len(orientations)} orientation(s)")
+    site = location.Location(latitude, longitude, 'UTC')
+    points = (stop - start) // resolution
+    chunk = 31 * 86400 // resolution
+    partial = filename + '.partial'
+    poa = np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32, shape=(len(orientations), points))
+    for first in range(0, points, chunk):
+        times = pd.date_range(start=pd.Timestamp(start + first * resolution, unit='s', tz='UTC'),
+                              periods=min(chunk, points - first), freq=f'{resolution}s')
+        poa[:, first:first + len(times)] = orientations_irradiance(site, times, orientations)
+    poa.flush()
+    del poa
+    os.replace(partial, filename)
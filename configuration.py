@@ -1,3 +1,7 @@
+# multisma2 re-reads this file on SIGHUP ('kill -HUP <pid>') and applies the changes without a
+# restart: inverters are added, removed, or restarted, and the MQTT and InfluxDB connections are
+# reopened when their settings change.  The log and metrics endpoint settings need a restart.
+
 # Site location details for solar time calculations
 SITE_NAME = "Solar SMA"
 SITE_REGION = "New York"
@@ -12,6 +16,9 @@ SITE_TILT = 30
 SITE_PANEL_AREA = 100
 SITE_PANEL_EFFICIENCY = 0.15
 
+# Days of inverter history used to learn the local production forecast (optional, default 14)
+FORECAST_HISTORY_DAYS = 14
+
 # Application log file customization
 APPLICATION_LOG_FILE = 'log/multisma2'
 APPLICATION_LOG_FORMAT = '[%(asctime)s] [%(module)s] [%(levelname)s] %(message)s'
@@ -31,11 +38,27 @@ CO2_AVOIDANCE = 0.44000
 #  INFLUXDB_URL               set to the InfluxDB server URL and port
 #  INFLUXDB_ORG               set to the v2 organization or '-' if using v1.8
 #  INFLUXDB_TOKEN             set to a valid v2 token or v1.8 'username:password'
+#  INFLUXDB_ROLLUPS           optional, maps the rollup windows ('1m', '15m', '1h') to the bucket
+#                             (or 'database/retention_policy') receiving the min/mean/max/last aggregates
 INFLUXDB_ENABLE = True
 INFLUXDB_BUCKET = 'multisma2/autogen'
 INFLUXDB_URL = 'http://a0d7b954-influxdb:8086'
 INFLUXDB_ORG = '-'
 INFLUXDB_TOKEN = 'homeassistant:jun61978'
+#
+# The rollup buckets must exist before enabling INFLUXDB_ROLLUPS, with InfluxDB 1.8 create a retention
+# policy for each window, e.g. in the influx shell:
+#   CREATE RETENTION POLICY "rollup_1m" ON "multisma2" DURATION 90d REPLICATION 1
+#   CREATE RETENTION POLICY "rollup_15m" ON "multisma2" DURATION 730d REPLICATION 1
+#   CREATE RETENTION POLICY "rollup_1h" ON "multisma2" DURATION INF REPLICATION 1
+# and with InfluxDB 2.x create a bucket for each window and map the window to the bucket name:
+#   influx bucket create --name multisma2_rollup_1m --retention 90d
+INFLUXDB_ROLLUPS = None
+#INFLUXDB_ROLLUPS = {
+#    '1m': 'multisma2/rollup_1m',
+#    '15m': 'multisma2/rollup_15m',
+#    '1h': 'multisma2/rollup_1h',
+#}
 
 # MQTT configuration options:
 #  MQTT_ENABLE            set to True to enable sending messages to the broker
@@ -44,6 +67,19 @@ INFLUXDB_TOKEN = 'homeassistant:jun61978'
 #  MQTT_BROKER_PORT       set to port (default to 1883 if set to 0)
 #  MQTT_USERNAME          set to the username if authentication is used
 #  MQTT_PASSWORD          set to the password port if authentication is used
+#  MQTT_QOS               optional, QoS level used when publishing (default 0)
+#  MQTT_QUEUE_SIZE        optional, outbound messages queued before the oldest are dropped (default 1000)
+#  MQTT_MAX_INFLIGHT      optional, messages published but not yet delivered (default 20)
+#  MQTT_BATCH_SIZE        optional, messages encoded together by the publisher task (default 50)
+#  MQTT_ENCODING          optional, payload encoding 'json' (default), 'msgpack', 'cbor', or 'binary',
+#                         the encoding is described in the retained 'MQTT_CLIENT/schema' topic
+#  MQTT_V5                optional, set to True to connect with MQTT 5 and use topic aliases (default False)
+#  MQTT_QUERY_ENABLE      optional, set to True to answer key and history requests sent to
+#                         'MQTT_CLIENT/query/request' (default False)
+#  MQTT_BUFFER_BYTES      optional, memory used to buffer messages while disconnected (default 1 MiB)
+#  MQTT_BUFFER_ORDERED_TOPICS  optional, topic prefixes where every buffered message is replayed,
+#                         all other topics only replay their latest value (default [])
+#  MQTT_BUFFER_SPILL_FILE optional, file receiving messages evicted from the buffer (default None, dropped)
 MQTT_ENABLE = False
 MQTT_CLIENT = 'multisma2'
 MQTT_BROKER_IPADDR = 'broker.mqtt.com'
@@ -51,6 +87,59 @@ MQTT_BROKER_PORT = 0
 MQTT_USERNAME = 'username'
 MQTT_PASSWORD = 'password'
 
+# Prometheus metrics endpoint (optional), latency histograms and error counts of each stage are
+# served at http://METRICS_HOST:METRICS_PORT/metrics, set METRICS_PORT to None to disable
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9101
+
+# Live energy (optional), the AC power is integrated between the production meter changes and published
+# to 'energy/today' and 'energy/hour', polls further apart than ENERGY_MAX_GAP seconds are not integrated
+ENERGY_MAX_GAP = 60
+
+# Sink process (optional, Python 3.8 or later), the MQTT publishing and InfluxDB writes run in a second
+# process fed through a SINK_RING_BYTES shared memory ring so they never delay the inverter polls,
+# the sink logs to APPLICATION_LOG_FILE-sink.log and publishes the handoff latency to 'sink/handoff'
+SINK_PROCESS = False
+SINK_RING_BYTES = 4 * 1024 * 1024
+
+# Daily archive (optional, needs pyarrow), after midnight the previous day's samples (every poll of the
+# RING_BUFFER_KEYS), production history, and clear-sky curves are written to ARCHIVE_DIRECTORY as
+# memory-mappable Arrow IPC files ('arrow') or Parquet files ('parquet')
+ARCHIVE_ENABLE = False
+ARCHIVE_DIRECTORY = 'log/archive'
+ARCHIVE_FORMAT = 'arrow'
+
+# Read-only HTTP API (optional), the latest snapshot, production, CO2 avoided, availability and the state
+# of each inverter are served from memory at http://API_HOST:API_PORT/api/<name> with ETags, add
+# '?wait=<seconds>' and If-None-Match to wait for a change, set API_PORT to None to disable
+API_HOST = '127.0.0.1'
+API_PORT = 9102
+
+# Memory accounting (optional), http://METRICS_HOST:METRICS_PORT/memory reports the cache sizes and,
+# while tracing, the memory held by each module ('?start' and '?stop' turn tracing on and off)
+MEMORY_TRACE = False            # trace from startup, tracing costs CPU and memory
+MEMORY_TRACE_FRAMES = 10
+
+# Recent samples kept in memory for each inverter (optional), RING_BUFFER_HOURS of 10 second samples
+# of the RING_BUFFER_KEYS (default AC/DC power, DC voltage and current, and production), 0 disables
+RING_BUFFER_HOURS = 6
+
+# Event loop backend (optional): 'auto' uses uvloop when it is installed, 'uvloop', or 'asyncio'
+EVENT_LOOP = 'auto'
+
+# Target time in seconds from launch to the first published sample (optional, default 30), the
+# time of each startup phase is logged and published to 'MQTT_CLIENT/startup'
+STARTUP_TARGET = 30
+
+# The MQTT topic of each inverter key and the keys in the 10 second snapshot can be replaced
+# (optional, the defaults are MQTT_TOPICS and SITE_SNAPSHOT in pvsite.py)
+#MQTT_TOPICS = {'6100_40263F00': 'ac_measurements/power', ...}
+#SITE_SNAPSHOT = ['6100_40263F00', '6380_40251E00']
+
+# Event loop monitor (optional), callbacks blocking the event loop longer than this many seconds
+# are logged with their stack and task, lag percentiles are published as 'MQTT_CLIENT/loop/lag'
+LOOP_MONITOR_THRESHOLD = 0.1
+
 # Inverter login information
 INVERTER_USERNAME = installer
 INVERTER_PASSWORD = sma12345
@@ -59,6 +148,12 @@ INVERTER_PASSWORD = sma12345
 # Supply the IP address and login credentials for each inverter.  The inverter names are used
 # in MQTT messages for the individual inverter sensors, :
 # multisma2/production_lifetime {"unit": "kWh", "inv0": 3287.216, "total": 8966.242, "inv1": 2417.215}
+# The optional 'area' is the panel area (square meters) connected to the inverter, it is used for
+# the performance ratio and defaults to an equal share of SITE_PANEL_AREA.  Inverters with arrays
+# facing different directions can list them, each array (or string 'a', 'b', 'c') can override
+# the site tilt, azimuth, area, and efficiency:
+#   'arrays': [{'string': 'a', 'azimuth': 90, 'tilt': 20, 'area': 25},
+#              {'string': 'b', 'azimuth': 270, 'tilt': 20, 'area': 25}]
 INVERTERS = [
    {'ip': 'https://192.168.30.20', 'SMA': 'inv1', 'user': installer, 'password': sma12345},
 ]
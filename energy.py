@@ -0,0 +1,93 @@
+"""Streaming energy integration of the AC power samples, reconciled with the production meter."""
+
+import datetime
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import ENERGY_MAX_GAP
+except ImportError:
+    ENERGY_MAX_GAP = 60
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# AC grid power (W) integrated between the changes of the total production meter (Wh)
+ENERGY_POWER_KEY = '6100_40263F00'
+ENERGY_METER_KEY = '6400_0046C300'
+
+
+def next_hour(timestamp):
+    """Return the timestamp of the next local hour boundary."""
+    hour = datetime.datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+    return (hour + datetime.timedelta(hours=1)).timestamp()
+
+
+class EnergyIntegrator():
+    """Sub-Wh production meter estimate from the power samples, O(1) per sample.
+
+    The power is integrated with the trapezoidal rule since the last meter change, when
+    the meter changes the estimate restarts from the meter (plus the part of the last
+    interval integrated past it) so the error never accumulates.
+    Intervals longer than ENERGY_MAX_GAP seconds are not integrated, the next meter change
+    accounts for them.  The estimate never decreases unless the meter itself goes back.
+    """
+    def __init__(self, max_gap=None):
+        """Create an integrator, ENERGY_MAX_GAP is used without 'max_gap', no estimate is available until a meter value is seen."""
+        self._max_gap = max_gap
+        self._time = None
+        self._power = None
+        self._meter = None
+        self._since = 0.0
+        self._total = None
+        self._hour_end = None
+        self._hour_start = None
+        self.drift = 0.0
+        self.gaps = 0
+
+    def update(self, timestamp, power, meter):
+        """Add a sample, 'power' in W and 'meter' in Wh, either may be None."""
+        power = power or 0.0
+        max_gap = self._max_gap or ENERGY_MAX_GAP
+        energy = 0.0
+        if self._time is not None:
+            elapsed = timestamp - self._time
+            if 0 < elapsed <= max_gap:
+                energy = (self._power + power) * elapsed / 7200
+            elif elapsed > max_gap:
+                self.gaps += 1
+            if self._total is not None and timestamp >= self._hour_end:
+                self._hour_start = self._total + (energy * (self._hour_end - self._time) / elapsed if energy else 0.0)
+                self._hour_end = next_hour(timestamp)
+            self._since += energy
+        self._time = timestamp
+        self._power = power
+
+        if meter is not None and meter != self._meter:
+            # The meter changed during the last interval, the energy integrated past it is kept
+            since = 0.0
+            if self._meter is not None and meter > self._meter:
+                self.drift = self._meter + self._since - meter
+                since = min(max(self.drift, 0.0), energy)
+            elif self._meter is not None:
+                logger.warning(f"The production meter went back from {self._meter} to {meter} Wh")
+                self._total = self._hour_start = meter
+            self._meter = meter
+            self._since = since
+        if self._meter is None:
+            return
+
+        self._total = max(self._total or 0.0, self._meter + self._since)
+        if self._hour_end is None:
+            self._hour_start = self._total
+            self._hour_end = next_hour(timestamp)
+
+    def total(self):
+        """Return the estimated meter value in Wh, None before the first meter value."""
+        return self._total
+
+    def hour(self):
+        """Return the energy in Wh since the start of the current hour, None before the first meter value."""
+        if self._total is None:
+            return None
+        return self._total - self._hour_start
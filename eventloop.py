@@ -0,0 +1,51 @@
+"""Event loop backend selection, uvloop is used when it is installed."""
+
+import asyncio
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import EVENT_LOOP
+except ImportError:
+    EVENT_LOOP = 'auto'
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Supported backends, 'auto' picks the first one that can be imported
+BACKENDS = ['uvloop', 'asyncio']
+
+
+def available_backends():
+    """Return the backends that can be used on this host."""
+    backends = []
+    for backend in BACKENDS:
+        try:
+            if backend != 'asyncio':
+                __import__(backend)
+            backends.append(backend)
+        except ImportError:
+            pass
+    return backends
+
+
+def new_event_loop(backend=None):
+    """Create an event loop using the configured backend, falling back to asyncio."""
+    backend = backend or EVENT_LOOP
+    if backend not in BACKENDS + ['auto']:
+        logger.warning(f"Unknown event loop backend '{backend}', using 'auto'")
+        backend = 'auto'
+
+    if backend in ('auto', 'uvloop'):
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            if backend == 'uvloop':
+                logger.warning("uvloop is not installed, using the asyncio event loop")
+    return asyncio.new_event_loop()
+
+
+def backend_name(loop):
+    """Return the backend name of an event loop."""
+    return 'uvloop' if type(loop).__module__.startswith('uvloop') else 'asyncio'
@@ -0,0 +1,175 @@
+"""Local production forecast from the clear-sky model and the learned actual/clear-sky ratio."""
+
+import logging
+
+import numpy as np
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Forecast resolution in seconds, the ratio is learned for each bin of the day
+FORECAST_BIN = 1800
+FORECAST_BINS = 86400 // FORECAST_BIN
+
+# Weight of a new day in the rolling ratio
+FORECAST_ALPHA = 0.2
+
+# Bins with less clear-sky energy (Wh per kWh of daily clear-sky energy) are not learned
+FORECAST_MINIMUM = 5
+
+# Samples further apart than this (seconds) are not integrated
+FORECAST_MAX_GAP = 60
+
+# Limits on the intra-day adjustment of the remaining bins
+FORECAST_ADJUSTMENT = (0.1, 1.5)
+
+
+def fold(previous, actual, clearsky, bins=slice(None)):
+    """Return the rolling ratio with the binned actual energy of a day (or some of its bins) folded in."""
+    minimum = clearsky.sum(axis=1, keepdims=True) * FORECAST_MINIMUM / 1000
+    selected = np.zeros(FORECAST_BINS, dtype=bool)
+    selected[bins] = True
+    valid = (clearsky > minimum) & (clearsky > 0) & selected
+    ratio = np.divide(actual, clearsky, out=np.zeros_like(actual), where=valid)
+    return np.where(valid, (1 - FORECAST_ALPHA) * previous + FORECAST_ALPHA * ratio, previous)
+
+
+class ProductionForecast():
+    """Daily and intra-day production forecast of each inverter and the site.
+
+    The forecast for a bin is the clear-sky energy times the rolling ratio of actual to
+    clear-sky energy seen in that bin on previous days.  During the day the remaining
+    bins are scaled by how today compares with the forecast so far.
+    """
+    def __init__(self, engine, model):
+        """Create the forecast using an IrradianceEngine and the clearsky.ArrayModel of the site."""
+        self._engine = engine
+        self._model = model
+        self._rows = [i for i, name in enumerate(model.names) if isinstance(name, str)]
+        self.names = [model.names[i] for i in self._rows]
+        self._ratio = np.ones((len(self._rows), FORECAST_BINS))
+        self._day = None
+        self._clearsky = None
+        self._actual = np.zeros((len(self._rows), FORECAST_BINS))
+        self._closed = 0
+        self._last = None
+        self._adjustment = np.ones(len(self._rows))
+
+    def clearsky_energy(self, day):
+        """Return the clear-sky energy (Wh) in each bin of the day starting at timestamp 'day', None if the curves are not loaded."""
+        timestamps, poa = self._engine.irradiance(day, day + 86400 - 1, 60)
+        if poa is None:
+            return None
+        power = self._model.expected(poa)[self._rows]
+        energy = np.zeros((len(self._rows), FORECAST_BINS))
+        bins = (timestamps - day) // FORECAST_BIN
+        for row in range(len(self._rows)):
+            energy[row] = np.bincount(bins, weights=power[row], minlength=FORECAST_BINS)[:FORECAST_BINS]
+        return energy * 60 / 3600
+
+    def learn(self, actual, clearsky, bins=slice(None)):
+        """Fold the binned actual energy of a day (or some of its bins) into the rolling ratio."""
+        self._ratio = fold(self._ratio, actual, clearsky, bins)
+
+    def learn_history(self, history, first_day, days):
+        """Return the rolling ratio learned from the inverter history, a list per inverter with {'inverter': name} followed by meter readings.
+
+        The forecast is not changed, so this can run in an executor while the event loop updates
+        today's bins, set_ratio() applies the result.
+        """
+        ratio = self._ratio.copy()
+        for i in range(days):
+            day = first_day + i * 86400
+            actual = np.zeros((len(self._rows), FORECAST_BINS))
+            for inverter in history:
+                if not inverter or inverter[0].get('inverter') not in self.names:
+                    continue
+                row = self.names.index(inverter[0]['inverter'])
+                readings = [(r['t'], r['v']) for r in inverter[1:] if r.get('v') is not None and day <= r['t'] <= day + 86400]
+                if len(readings) < 2:
+                    continue
+                t, v = np.array(readings, dtype=np.float64).T
+                bins = ((t[1:] - day) // FORECAST_BIN).astype(np.int64).clip(0, FORECAST_BINS - 1)
+                actual[row] = np.bincount(bins, weights=np.diff(v), minlength=FORECAST_BINS)
+            clearsky = self.clearsky_energy(day) if actual.any() else None
+            if clearsky is not None:
+                ratio = fold(ratio, actual, clearsky)
+        return ratio
+
+    def set_ratio(self, ratio):
+        """Replace the rolling ratio with one returned by learn_history()."""
+        self._ratio = ratio
+
+    def new_day(self, day):
+        """Start a new day at timestamp 'day' (local midnight), the forecast is ready immediately if the curves are loaded."""
+        if self._clearsky is not None and self._day != day and self._closed < FORECAST_BINS:
+            self.close_bins(FORECAST_BINS)
+        self._day = day
+        self._clearsky = self.clearsky_energy(day)
+        self._actual[:] = 0
+        self._closed = 0
+        self._last = None
+        self._adjustment[:] = 1
+
+    def update(self, timestamp, snapshot):
+        """Integrate the AC power of a snapshot into today's bins."""
+        if self._clearsky is None:
+            return
+        power = None
+        for sensor in snapshot:
+            if sensor.get('topic') == 'ac_measurements/power':
+                power = np.array([float(sensor.get(name) or 0) for name in self.names])
+                break
+        if power is None:
+            return
+
+        current = int((timestamp - self._day) // FORECAST_BIN)
+        if self._last is not None:
+            last_time, last_power = self._last
+            if 0 < timestamp - last_time <= FORECAST_MAX_GAP and 0 <= current < FORECAST_BINS:
+                self._actual[:, current] += (last_power + power) / 2 * (timestamp - last_time) / 3600
+        self._last = (timestamp, power)
+        if current > self._closed:
+            self.close_bins(min(current, FORECAST_BINS))
+
+    def close_bins(self, current):
+        """Learn from the bins completed today and update the intra-day adjustment."""
+        bins = slice(self._closed, current)
+        forecast = (self._clearsky * self._ratio)[:, :current]
+        expected = forecast.sum(axis=1)
+        self._adjustment = np.divide(self._actual[:, :current].sum(axis=1), expected, out=np.ones_like(expected), where=expected > 0)
+        self._adjustment = self._adjustment.clip(*FORECAST_ADJUSTMENT)
+        self.learn(self._actual, self._clearsky, bins)
+        self._closed = current
+
+    def forecast(self):
+        """Return the forecast energy (Wh) of each bin, completed bins hold the actual energy, None without the curves."""
+        if self._clearsky is None:
+            return None
+        curve = self._clearsky * self._ratio
+        curve[:, self._closed:] *= self._adjustment[:, None]
+        curve[:, :self._closed] = self._actual[:, :self._closed]
+        return curve
+
+    def sensors(self):
+        """Return the forecast for today (kWh) of each inverter and the site."""
+        curve = self.forecast()
+        if curve is None:
+            return []
+        totals = dict(zip(self.names, (curve.sum(axis=1) / 1000).tolist()))
+        totals['topic'] = 'forecast/today'
+        totals['precision'] = 2
+        return [totals]
+
+    def line_protocol(self):
+        """Return the forecast average power (W) of each bin in InfluxDB line protocol."""
+        curve = self.forecast()
+        if curve is None:
+            return []
+        power = (curve * 3600 / FORECAST_BIN).round(1).tolist()
+        timestamps = (self._day + np.arange(FORECAST_BINS) * FORECAST_BIN).tolist()
+        lp_points = []
+        for name, values in zip(self.names, power):
+            lp_points.extend(f'forecast,inverter={name} production={v} {t}' for t, v in zip(timestamps, values))
+        return lp_points
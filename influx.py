@@ -4,11 +4,13 @@
 # https://docs.influxdata.com/influxdb/v2.0/reference/syntax/line-protocol/
 
 import time
+import datetime
 import logging
 from pprint import pprint
 
-from influxdb_client import InfluxDBClient, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from rollup import Rollup
+from lrucache import LRUCache
+import metrics
 
 from configuration import APPLICATION_LOG_LOGGER_NAME
 
@@ -16,6 +18,17 @@ logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 
 CACHE_ENABLED = False
 
+# influxdb_client.WritePrecision.S, the client is only imported when InfluxDB is enabled
+WRITE_PRECISION = 's'
+
+# Series signatures remembered for the change-only writes
+CACHE_SIZE = 4096
+
+# Measurements that are only written when a field changes
+CHANGE_ONLY_MEASUREMENTS = [
+    'status',
+]
+
 LP_LOOKUP = {
     'ac_measurements/power': {'measurement': 'ac_measurements', 'tag': 'inverter', 'field': 'power'},
     'ac_measurements/voltage': {'measurement': 'ac_measurements', 'tag': 'inverter', 'field': 'voltage'},
@@ -29,6 +42,10 @@ LP_LOOKUP = {
     'production/total': {'measurement': 'production', 'tag': 'inverter', 'field': 'total'},
     'production/today': {'measurement': 'production', 'tag': 'inverter', 'field': 'today'},
     'sun/position': {'measurement': 'sun', 'tag': None, 'field': None},
+    'performance/expected': {'measurement': 'performance', 'tag': 'inverter', 'field': 'expected'},
+    'performance/ac_ratio': {'measurement': 'performance', 'tag': 'inverter', 'field': 'ac_ratio'},
+    'performance/dc_ratio': {'measurement': 'performance', 'tag': 'inverter', 'field': 'dc_ratio'},
+    'forecast/today': {'measurement': 'forecast', 'tag': 'inverter', 'field': 'today'},
 }
 
 
@@ -36,44 +53,113 @@ class InfluxDB():
     def __init__(self, enabled):
         self._client = None
         self._write_api = None
+        self._query_api = None
         self._enabled = enabled
+        self._rollup = None
+        self._rollup_buckets = {}
 
     def __del__(self):
         if self._client:
             self._client.close()
 
-    def start(self, url, bucket, org, token):
+    def start(self, url, bucket, org, token, rollups=None):
         if not self._enabled:
             return True
         self._bucket = bucket
+        if rollups:
+            self._rollup_buckets = rollups
+            self._rollup = Rollup(rollups.keys())
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
         self._client = InfluxDBClient(url=url, token=token, org=org)
         self._write_api = self._client.write_api(write_options=SYNCHRONOUS) if self._client else None
+        self._query_api = self._client.query_api() if self._client else None
         result = self._client if self._client else False
         logger.info(f"{'Opened' if result else 'Failed to open'} the InfluxDB database '{self._bucket}' at {url}")
         return result
 
     def stop(self):
+        if self._rollup and self._write_api:
+            self.write_rollups(self._rollup.flush())
         if self._write_api:
             self._write_api.close()
             self._write_api = None
+        self._query_api = None
         if self._client:
             self._client.close()
             self._client = None
             logger.info(f"Closed the InfluxDB database")
 
-    cache = {}
+    def restart(self, enabled, url, bucket, org, token, rollups=None):
+        """Close the database and open it with new settings."""
+        self.stop()
+        InfluxDB.cache.clear()
+        self._enabled = enabled
+        self._rollup = None
+        self._rollup_buckets = {}
+        return self.start(url=url, bucket=bucket, org=org, token=token, rollups=rollups)
+
+    cache = LRUCache('influxdb', CACHE_SIZE)
+
+    @metrics.timed('influx_query_production_baselines', failed=lambda result: not result)
+    def query_production_baselines(self, starts):
+        """Query the 'production,total' value of every inverter at the start of each period.
+
+        'starts' is a dictionary of period names and timestamps, one query is made for the
+        whole fleet and the result is {inverter: {period: {'t': timestamp, 'v': value}}}.
+        The last value before the period start is used, otherwise the first one after it.
+        """
+        if not self._query_api:
+            return {}
+
+        window = 3 * 60 * 60
+        tables = []
+        for period, start in starts.items():
+            for side, (t0, t1, selector) in {
+                'before': (start - window, start, 'last'),
+                'after': (start, start + window, 'first'),
+            }.items():
+                tables.append(
+                    f'from(bucket: "{self._bucket}")'
+                    f' |> range(start: {flux_time(t0)}, stop: {flux_time(t1)})'
+                    f' |> filter(fn: (r) => r._measurement == "production" and r._field == "total")'
+                    f' |> {selector}()'
+                    f' |> set(key: "period", value: "{period}")'
+                    f' |> set(key: "side", value: "{side}")'
+                )
+        query = f'union(tables: [{", ".join(tables)}])'
 
+        try:
+            result = self._query_api.query(query)
+        except Exception as e:
+            logger.error(f"Database query() call failed in query_production_baselines(): {e}")
+            return {}
+
+        baselines = {}
+        for table in result:
+            for record in table.records:
+                inverter = record.values.get('inverter')
+                period = record.values.get('period')
+                side = record.values.get('side')
+                periods = baselines.setdefault(inverter, {})
+                if period in periods and side == 'after':
+                    continue
+                periods[period] = {'t': int(record.get_time().timestamp()), 'v': int(record.get_value())}
+        return baselines
+
+    @metrics.timed('influx_write_points', failed=lambda result: result is False)
     def write_points(self, points):
         if not self._write_api:
             return False
         try:
-            self._write_api.write(bucket=self._bucket, record=points, write_precision=WritePrecision.S)
+            self._write_api.write(bucket=self._bucket, record=points, write_precision=WRITE_PRECISION)
             result = True
         except Exception as e:
             logger.error(f"Database write_points() call failed in write_points(): {e}")
             result = False
         return result
 
+    @metrics.timed('influx_write_history', failed=lambda result: result is False)
     def write_history(self, site, topic):
         if not self._write_api:
             return False
@@ -100,78 +186,109 @@ class InfluxDB():
                     continue
 
         try:
-            self._write_api.write(bucket=self._bucket, record=lps, write_precision=WritePrecision.S)
+            self._write_api.write(bucket=self._bucket, record=lps, write_precision=WRITE_PRECISION)
             result = True
         except Exception as e:
             logger.error(f"Database write_points() call failed in write_history(): {e}")
             result = False
         return result
 
+    @metrics.timed('influx_write_sma_sensors', failed=lambda result: result is False)
     def write_sma_sensors(self, sensors):
         if not self._client:
             return False
 
         ts = int(time.time())
         lps = []
-        for old_point in sensors:
-            point = old_point.copy()
-            topic = point.pop('topic', None)
-            point.pop('precision', None)
-            if topic:
-                lookup = LP_LOOKUP.get(topic, None)
-                if not lookup:
-                    logger.error(f"write_sma_sensors(): unknown topic '{topic}'")
-                    continue
+        cached = {}
+        rollups = {}
+        for measurement, tags, fields in sensor_points(sensors):
+            lp = to_line_protocol(measurement, tags, fields)
+            if self._rollup:
+                for window, lines in self._rollup.add(measurement, tags, fields, ts).items():
+                    rollups.setdefault(window, []).extend(lines)
 
-                measurement = lookup.get('measurement')
-                tag = lookup.get('tag')
-                for k, v in point.items():
-                    field = lookup.get('field')
-                    signature = f'{measurement}_{k}_{field}'
-                    lp = f'{measurement}'
-                    if tag:
-                        lp += f',{tag}={k}'
-                    lp += f' '
-                    if not field:
-                        field = k
-                    if isinstance(v, int):
-                        lp += f'{field}={v}i'
-                    elif isinstance(v, float):
-                        lp += f'{field}={v}'
-                    elif isinstance(v, dict): 
-                        first = True
-                        for k1, v1 in v.items():
-                            if not first:
-                                lp += f','
-                            if isinstance(v1, int):
-                                lp += f'{k1}={v1}i' if k1 != k else f'{field}={v1}i'
-                            else:
-                                logger.error(f"write_sma_sensors(): unanticipated dictionary type '{type(v1)}' in measurement '{measurement}/{field}'")
-                            first = False
-                    else:
-                        logger.error(f"write_sma_sensors(): unanticipated type '{type(v)}' in measurement '{measurement}/{field}'")
+            # Check if in the cache, if not or different update cache and write
+            signature = f'{measurement}{tags}_{"_".join(fields.keys())}'
+            if CACHE_ENABLED or measurement in CHANGE_ONLY_MEASUREMENTS:
+                cached_result = InfluxDB.cache.get(signature, None)
+                if cached_result:
+                    if lp == cached_result:
                         continue
 
-                    # Check if in the cache, if not or different update cache and write
-                    if CACHE_ENABLED:
-                        cached_result = InfluxDB.cache.get(signature, None)
-                        if cached_result:
-                            if lp == cached_result:
-                                continue
-
-                    InfluxDB.cache[signature] = lp
-                    lp += f' {ts}'
-                    lps.append(lp)
+            cached[signature] = lp
+            lps.append(lp + f' {ts}')
 
         try:
-            #pprint(lps)
-            self._write_api.write(bucket=self._bucket, record=lps, write_precision=WritePrecision.S)
+            self._write_api.write(bucket=self._bucket, record=lps, write_precision=WRITE_PRECISION)
+            # Only points that were written are skipped next time they repeat
+            for signature, lp in cached.items():
+                InfluxDB.cache[signature] = lp
             result = True
         except Exception as e:
             logger.error(f"Database write_points() call failed in write_sma_sensors(): {e}")
             result = False
+
+        return self.write_rollups(rollups) and result
+
+    @metrics.timed('influx_write_rollups', failed=lambda result: result is False)
+    def write_rollups(self, rollups):
+        """Write the closed rollup windows to their retention targets."""
+        result = True
+        for window, lines in rollups.items():
+            try:
+                self._write_api.write(bucket=self._rollup_buckets[window], record=lines, write_precision=WRITE_PRECISION)
+            except Exception as e:
+                logger.error(f"Database write_points() call failed in write_rollups(): {e}")
+                result = False
         return result
 
+
+def sensor_points(sensors):
+    """Convert a list of sensor dictionaries into (measurement, tags, fields) tuples."""
+    for sensor in sensors:
+        topic = sensor.get('topic', None)
+        if not topic:
+            continue
+        lookup = LP_LOOKUP.get(topic, None)
+        if not lookup:
+            logger.error(f"write_sma_sensors(): unknown topic '{topic}'")
+            continue
+
+        measurement = lookup.get('measurement')
+        tag = lookup.get('tag')
+        for k, v in sensor.items():
+            if k in ('topic', 'precision'):
+                continue
+            field = lookup.get('field') or k
+            tags = f',{tag}={k}' if tag else ''
+            if isinstance(v, (int, float)):
+                fields = {field: v}
+            elif isinstance(v, dict):
+                fields = {}
+                for k1, v1 in v.items():
+                    if isinstance(v1, (int, float)):
+                        fields[k1 if k1 != k else field] = v1
+                    else:
+                        logger.error(f"write_sma_sensors(): unanticipated dictionary type '{type(v1)}' in measurement '{measurement}/{field}'")
+                if not fields:
+                    continue
+            else:
+                logger.error(f"write_sma_sensors(): unanticipated type '{type(v)}' in measurement '{measurement}/{field}'")
+                continue
+            yield measurement, tags, fields
+
+
+def flux_time(timestamp):
+    """Convert a Unix timestamp to a Flux (RFC3339) time literal."""
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def to_line_protocol(measurement, tags, fields):
+    """Create the line protocol for a point, without the timestamp."""
+    values = ','.join(f'{k}={v}i' if isinstance(v, int) else f'{k}={v}' for k, v in fields.items())
+    return f'{measurement}{tags} {values}'
+
 xxx = [
         'production,inverter=site irradiance=0.0 1613044800',
         'production,inverter=site irradiance=24.1 1613045400',
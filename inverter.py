@@ -2,14 +2,43 @@
 
 import asyncio
 import datetime
+import time
 import logging
 import json
+import hashlib
 from pprint import pprint
 
+import numpy as np
+from aiohttp import client_exceptions
+
 import sma
+import metrics
+import startup
+import keyindex
+import archive
+from lrucache import LRUCache
+from ringbuffer import RingBuffer
+from energy import EnergyIntegrator, ENERGY_POWER_KEY, ENERGY_METER_KEY
 
 from configuration import APPLICATION_LOG_LOGGER_NAME
 
+try:
+    from configuration import RING_BUFFER_HOURS
+except ImportError:
+    RING_BUFFER_HOURS = 6
+
+try:
+    from configuration import RING_BUFFER_KEYS
+except ImportError:
+    RING_BUFFER_KEYS = [
+        '6100_40263F00',    # AC grid power (current)
+        '6100_0046C200',    # PV generation power (current)
+        '6400_0046C300',    # Meter count and PV gen. meter (total power)
+        '6380_40251E00',    # DC power
+        '6380_40451F00',    # DC voltage
+        '6380_40452100',    # DC current
+    ]
+
 logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 
 # Inverter keys that contain aggregates
@@ -17,6 +46,36 @@ AGGREGATE_KEYS = [
     '6380_40251E00',  # DC Power (current power)
 ]
 
+# Multi-state keys sampled with a total series beside the phases or strings, DC voltage and current are never summed
+SAMPLE_TOTAL_KEYS = AGGREGATE_KEYS + [
+    '6100_40263F00',  # AC grid power (current)
+]
+
+# Daytime poll interval in seconds, sets the size of the recent sample buffers
+RING_BUFFER_RESOLUTION = 10
+
+# Metadata and l10n dictionaries, shared by the inverters running the same firmware
+shared_dictionaries = LRUCache('inverter_dictionaries', 8)
+
+
+def shared_dictionary(text):
+    """Return the dictionary for a JSON document, identical documents share one dictionary."""
+    digest = hashlib.sha1(text.encode()).digest()
+    dictionary = shared_dictionaries.get(digest)
+    if dictionary is None:
+        dictionary = shared_dictionaries[digest] = json.loads(text)
+    return dictionary
+
+
+def compact(results):
+    """Return the getAllOnlValues results as {key: states} without the device wrapper."""
+    return {key: value.get('1') for key, value in results.items() if value}
+
+
+def sample_hours():
+    """Return the hours of recent samples to keep, a whole day when archiving."""
+    return max(RING_BUFFER_HOURS, archive.ARCHIVE_HOURS if archive.ARCHIVE_ENABLE else 0)
+
 
 class Inverter:
     """Class to encapsulate a single inverter."""
@@ -31,52 +90,176 @@ class Inverter:
         self._metadata = None
         self._tags = None
         self._instantaneous = None
+        self._instantaneous_time = 0
         self._history = {}
         self._lock = asyncio.Lock()
+        # Changes whenever the keys supported by the inverter may have changed
+        self.generation = 0
+        self.failed_polls = 0
+        self._samples = None
+        self._samples_generation = None
+        self._samples_missing = ()
+        self._columns = None
+        self._scratch = None
+        self._energy = EnergyIntegrator()
 
-    async def start(self):
-        """Setup inverter for data collection."""
+    async def start(self, baselines=None):
+        """Setup inverter for data collection, returns the cached keys or None if the inverter is unavailable."""
         # SMA class object for access to inverters
         self._sma = sma.SMA(session=self._session, url=self._url, password=self._password, group=self._group)
         await self._sma.new_session()
         if self._sma.sma_sid is None:
             logger.info(f"{self._name} - no session ID")
             return None
+        startup.mark('logins')
         #logger.debug(f"Connected to SMA inverter '{self._name}' at {self._url} with session ID '{self._sma.sma_sid}'")
 
-        # Grab the metadata dictionary
-        metadata_url = self._url + "/data/ObjectMetadata_Istl.json"
-        async with self._session.get(metadata_url) as resp:
-            assert resp.status == 200
-            self._metadata = json.loads(await resp.text())
-
-        # Grab the inverter tag dictionary
-        tag_url = self._url + "/data/l10n/en-US.json"
-        async with self._session.get(tag_url) as resp:
-            assert resp.status == 200
-            self._tags = json.loads(await resp.text())
+        # Grab the metadata and inverter tag dictionaries
+        self.generation += 1
+        self._metadata = await self.read_dictionary("/data/ObjectMetadata_Istl.json")
+        self._tags = await self.read_dictionary("/data/l10n/en-US.json")
+        if self._metadata is None or self._tags is None:
+            await self.stop()
+            return None
+        startup.mark('metadata')
 
         # Read the initial set of history state data
-        await self.read_inverter_production()
+        if not await self.read_inverter_production(baselines):
+            await self.stop()
+            return None
+        startup.mark('history')
         await self.read_instantaneous()
+        if self._instantaneous is None:
+            await self.stop()
+            return None
+        startup.mark('first_poll')
 
         # Return a list of cached keys
         return self._instantaneous.keys()
 
+    async def read_dictionary(self, path):
+        """Read one of the inverter JSON dictionaries, None if it is unavailable."""
+        try:
+            async with self._session.get(self._url + path) as resp:
+                if resp.status == 200:
+                    return shared_dictionary(await resp.text())
+                logger.error(f"{self._name}: reading '{path}' returned HTTP status {resp.status}")
+        except (asyncio.TimeoutError, client_exceptions.ClientError) as e:
+            logger.error(f"{self._name}: unable to read '{path}': {e}")
+        return None
+
     async def stop(self):
         """Log out of the interter."""
         if self._sma:
             await self._sma.close_session()
             self._sma = None
 
-    async def read_instantaneous(self):
-        """Update the instantaneous inverter states."""
+    async def read_instantaneous(self, record=True):
+        """Update the instantaneous inverter states, 'record' adds them to the recent samples (only the scheduled polls do)."""
         async with self._lock:
-            self._instantaneous = await self._sma.read_instantaneous()
-            if self._instantaneous is None:
+            results = await self._sma.read_instantaneous()
+            if results is None:
                 #logger.info(f"Retrying 'read_instantaneous()' to create a new session")
-                self._instantaneous = await self._sma.read_instantaneous()
+                results = await self._sma.read_instantaneous()
+            instantaneous = compact(results) if results is not None else None
+            self.failed_polls = 0 if instantaneous is not None else self.failed_polls + 1
+            if instantaneous is not None:
+                if self._instantaneous is not None and instantaneous.keys() != self._instantaneous.keys():
+                    logger.info(f"{self._name}: the instantaneous keys have changed")
+                    self.generation += 1
+                self._instantaneous_time = time.time()
+            self._instantaneous = instantaneous
+            if instantaneous is not None:
+                if record:
+                    self.record_samples()
+                self._energy.update(self._instantaneous_time, self.total_value(ENERGY_POWER_KEY), self.total_value(ENERGY_METER_KEY))
+
+    def total_value(self, key):
+        """Return the scaled total of a key over all phases in the instantaneous states, None if it is missing."""
+        states = self._instantaneous.get(key, None)
+        if not states:
+            return None
+        total = 0
+        for state in states:
+            total += state.get('val', None) or 0
+        return total * (self.get_scale(key) or 1)
+
+    def energy(self):
+        """Return the integrated production of today and of the current hour in Wh, None before the first poll."""
+        total = self._energy.total()
+        baseline = self._history.get('today', None)
+        if total is None or baseline is None:
+            return None
+        return {'today': total - baseline['v'], 'hour': self._energy.hour()}
+
+    def record_samples(self):
+        """Append the RING_BUFFER_KEYS values of the instantaneous states to the recent samples."""
+        if not sample_hours():
+            return
+        if self._samples is None or self._samples_generation != self.generation or any(key in self._instantaneous for key in self._samples_missing):
+            self.create_samples()
+        for column, (key, indexes, scale) in enumerate(self._columns):
+            states = self._instantaneous.get(key, None)
+            if states is None:
+                self._scratch[column] = float('nan')
+                continue
+            total = 0
+            for index in indexes:
+                total += states[index].get('val', None) or 0
+            self._scratch[column] = total * scale
+        self._samples.append(self._instantaneous_time, self._scratch)
+
+    def create_samples(self):
+        """Create the recent sample buffer, multi-state keys have a series per phase or string and SAMPLE_TOTAL_KEYS a total.
+
+        The buffer is created again when the inverter keys change or a missing key appears,
+        the samples of the series that are kept are copied over.
+        """
+        series = []
+        missing = []
+        self._columns = []
+        for key in RING_BUFFER_KEYS:
+            states = self._instantaneous.get(key, None)
+            if not states:
+                missing.append(key)
+                continue
+            if self.get_type(key) != 0:
+                continue
+            scale = self.get_scale(key) or 1
+            if len(states) == 1 or key in SAMPLE_TOTAL_KEYS:
+                series.append(key)
+                self._columns.append((key, tuple(range(len(states))), scale))
+            if len(states) > 1:
+                for index, subkey in enumerate(['a', 'b', 'c'][:len(states)]):
+                    series.append(f'{key}/{subkey}')
+                    self._columns.append((key, (index,), scale))
+        samples = RingBuffer(series, sample_hours() * 3600 // RING_BUFFER_RESOLUTION)
+        if self._samples is not None:
+            samples.copy(self._samples)
+            logger.info(f"{self._name}: the sampled keys have changed, now sampling {series}")
+        self._samples = samples
+        self._samples_generation = self.generation
+        self._samples_missing = tuple(missing)
+        self._scratch = np.zeros(len(series))
+
+    def samples(self):
+        """Return the RingBuffer of recent samples, None until the first poll."""
+        return self._samples
 
+    def state(self):
+        """Return the cleaned values of every cached key and the poll time, None before the first poll."""
+        instantaneous = self._instantaneous
+        if instantaneous is None:
+            return None
+        state = self.clean({key: {'1': states} for key, states in instantaneous.items() if key in self._metadata})
+        state['time'] = int(self._instantaneous_time)
+        return state
+
+    def instantaneous_age(self):
+        """Return the age in seconds of the instantaneous inverter states."""
+        return time.time() - self._instantaneous_time
+
+    @metrics.timed('clean', label=lambda inverter: inverter._name)
     def clean(self, raw_results):
         """Clean the raw inverter data and return a dict with the key and result."""
         cleaned = {}
@@ -126,6 +309,8 @@ class Inverter:
     async def read_key(self, key):
         """Read a specified inverter key."""
         raw_result = await self._sma.read_values([key])
+        if raw_result is None:
+            return {'name': self._name}
         return self.clean({key: raw_result.get(key)})
 
     async def read_history(self, start, stop):
@@ -136,27 +321,44 @@ class Inverter:
             history.insert(0, {'inverter': self._name})
         return history
 
-    async def read_inverter_production(self):
-        """Read the baseline inverter production for select periods."""
+    async def read_inverter_production(self, baselines=None):
+        """Read the baseline inverter production for select periods.
+
+        Baselines supplied by the caller are used as is, only the missing periods
+        are read from the inverter history.
+        """
         one_hour = 60 * 60 * 1
         three_hours = 60 * 60 * 3
         today_start = int(datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0)).timestamp())
         month_start = int(datetime.datetime.combine(datetime.date.today().replace(day=1), datetime.time(0, 0)).timestamp())
         year_start = int(datetime.datetime.combine(datetime.date.today().replace(month=1, day=1), datetime.time(0, 0)).timestamp())
-        results = await asyncio.gather(
-            self.read_history(today_start - one_hour, today_start + three_hours),
-            self.read_history(month_start - one_hour, today_start),
-            self.read_history(year_start - one_hour, today_start),
-        )
-        self._history['today'] = results[0][1]
-        self._history['month'] = results[1][1]
-        self._history['year'] = results[2][1]
+        windows = {
+            'today': (today_start - one_hour, today_start + three_hours),
+            'month': (month_start - one_hour, today_start),
+            'year': (year_start - one_hour, today_start),
+        }
+        baselines = baselines or {}
+        periods = [period for period in windows.keys() if period not in baselines]
+        results = await asyncio.gather(*(self.read_history(*windows[period]) for period in periods))
+        for period, result in zip(periods, results):
+            if not result or len(result) < 2:
+                logger.error(f"{self._name}: unable to read the '{period}' production baseline")
+                return False
+            self._history[period] = result[1]
+        for period in windows.keys():
+            if period in baselines:
+                self._history[period] = baselines[period]
         self._history['lifetime'] = {'t': 0, 'v': 0}
         #{'today': {'t': 1611032400, 'v': 3121525},
         # 'month': {'t': 1609477200, 'v': 3055878},
         # 'year': {'t': 1609477200, 'v': 3055878},
         # 'lifetime': {'t': 0, 'v': 0}}
         logger.debug(f"{self._name}/read_inverter_production()/_history: {self._history}")
+        return True
+
+    def production_baselines(self):
+        """Return the production baselines in use."""
+        return self._history
 
     def display_metadata(self, key):
         """Display the inverter metadata for a key."""
@@ -164,13 +366,28 @@ class Inverter:
         pprint(f"{self._name}/{key}/{metadata}")
 
     async def get_state(self, key):
-        """Return the state for a given key."""
-        assert self._instantaneous != None
+        """Return the state for a given key, read from the inverter if the last poll did not have it.
+
+        Without a cached poll (the last one failed) the inverter is not read, only its name is returned.
+        """
         async with self._lock:
-            state = self._instantaneous.get(key, None).copy()
-        cleaned = self.clean({key: state})
+            instantaneous = self._instantaneous
+            if instantaneous is None:
+                return {'name': self._name}
+            states = instantaneous.get(key, None)
+        if states is None:
+            return await self.read_key(key)
+        cleaned = self.clean({key: {'1': states}})
         return cleaned
 
+    def key_source(self, key):
+        """Return how a key is read from this inverter, 'cache', 'read', or None if it is not supported."""
+        if self._instantaneous is not None and key in self._instantaneous:
+            return keyindex.CACHE
+        if self._metadata is not None and key in self._metadata:
+            return keyindex.READ
+        return None
+
     def name(self):
         """Return the inverter name."""
         return self._name
@@ -0,0 +1,56 @@
+"""Index of the keys each inverter supports and the cheapest way to read them."""
+
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Key sources, 'cache' keys are in the getAllOnlValues results and 'read' keys need a getValues call
+CACHE = 'cache'
+READ = 'read'
+
+
+class KeyIndex():
+    """Maps each key to the inverters that support it and the source to use for each.
+
+    Entries are built on first use and the index is rebuilt when the inverters change
+    or an inverter reports a different key set (after a firmware update).  A key that
+    no inverter lists in its metadata has no sources and is not kept in the index.
+    """
+    def __init__(self):
+        """Create an empty index."""
+        self._inverters = []
+        self._generations = ()
+        self._sources = {}
+
+    def refresh(self, inverters, keys=()):
+        """Rebuild the index for a list of inverters, 'keys' are indexed immediately."""
+        self._inverters = inverters
+        self._generations = tuple(inverter.generation for inverter in inverters)
+        self._sources = {}
+        for key in keys:
+            self.sources(key)
+
+    def sources(self, key):
+        """Return [(inverter, source)] for the inverters supporting a key, empty for an unknown key."""
+        generations = tuple(inverter.generation for inverter in self._inverters)
+        if generations != self._generations:
+            logger.info("Inverter keys have changed, rebuilding the key index")
+            self.refresh(self._inverters)
+
+        sources = self._sources.get(key, None)
+        if sources is None:
+            sources = [(inverter, inverter.key_source(key)) for inverter in self._inverters]
+            sources = [(inverter, source) for inverter, source in sources if source]
+            if sources:
+                self._sources[key] = sources
+        return sources
+
+    def known(self, key):
+        """Return True if any inverter supports the key."""
+        return bool(self.sources(key))
+
+    def cached(self, key):
+        """Return True if any inverter has the key in its cache."""
+        return any(source == CACHE for _, source in self.sources(key))
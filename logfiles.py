@@ -18,9 +18,9 @@ logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 # Public
 #
 
-def start(app_logger):
-    """Create the application log."""
-    filename = os.path.expanduser(APPLICATION_LOG_FILE + ".log")
+def start(app_logger, suffix=''):
+    """Create the application log, a process other than the main one adds a suffix to the file name."""
+    filename = os.path.expanduser(APPLICATION_LOG_FILE + suffix + ".log")
 
     try:
         from configuration import APPLICATION_LOG_LEVEL
@@ -0,0 +1,134 @@
+"""Event loop lag monitor and slow callback detector."""
+
+import sys
+import time
+import asyncio
+import threading
+import traceback
+import weakref
+import logging
+from collections import deque
+
+import metrics
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import LOOP_MONITOR_THRESHOLD
+except ImportError:
+    LOOP_MONITOR_THRESHOLD = 0.1
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Seconds between the lag samples
+LOOP_MONITOR_INTERVAL = 0.25
+
+# Lag samples kept for the percentiles (5 minutes)
+LOOP_MONITOR_SAMPLES = 1200
+
+# Frames logged for a blocked event loop
+LOOP_MONITOR_STACK_DEPTH = 12
+
+local_vars = {
+    'lags': deque(maxlen=LOOP_MONITOR_SAMPLES),
+    'slow': 0,
+}
+task_names = weakref.WeakKeyDictionary()
+
+
+def create_task(coro, name):
+    """Schedule a coroutine as a named task (Python 3.7 tasks have no name)."""
+    task = asyncio.ensure_future(coro)
+    task_names[task] = name
+    if hasattr(task, 'set_name'):
+        task.set_name(name)
+    return task
+
+
+def task_name(task):
+    """Return the name of an asyncio task, unnamed tasks are named after their coroutine."""
+    if task is None:
+        return 'event-loop'
+    name = task_names.get(task, None)
+    if name:
+        return name
+    return getattr(task.get_coro(), '__qualname__', 'task')
+
+
+class Watchdog(threading.Thread):
+    """Captures the event loop stack and task when the loop misses its heartbeat."""
+    def __init__(self, loop, thread_id, threshold):
+        """Watch the event loop running in 'thread_id'."""
+        super().__init__(name='multisma2-watchdog', daemon=True)
+        self._loop = loop
+        self._thread_id = thread_id
+        self._threshold = threshold
+        self._heartbeat = time.monotonic()
+        self._stall = None
+        self._stopped = threading.Event()
+
+    def beat(self):
+        """Called from the event loop, returns the stall captured since the last beat."""
+        stall = self._stall
+        self._stall = None
+        self._heartbeat = time.monotonic()
+        return stall
+
+    def run(self):
+        """Capture the stack of the event loop thread when it is blocked."""
+        while not self._stopped.wait(self._threshold / 2):
+            if self._stall or time.monotonic() - self._heartbeat < LOOP_MONITOR_INTERVAL + self._threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id, None)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self._loop)
+            self._stall = (task_name(task), ''.join(traceback.format_stack(frame, limit=LOOP_MONITOR_STACK_DEPTH)))
+
+    def stop(self):
+        """Stop watching."""
+        self._stopped.set()
+
+
+#
+# Public
+#
+
+async def run():
+    """Sample the event loop lag and log the blocking calls until cancelled."""
+    loop = asyncio.get_event_loop()
+    watchdog = Watchdog(loop, threading.get_ident(), LOOP_MONITOR_THRESHOLD)
+    watchdog.start()
+    try:
+        while True:
+            expected = loop.time() + LOOP_MONITOR_INTERVAL
+            await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            stall = watchdog.beat()
+            local_vars['lags'].append(lag)
+            metrics.record('loop_lag', 'site', lag)
+            if lag < LOOP_MONITOR_THRESHOLD:
+                continue
+            local_vars['slow'] += 1
+            if stall:
+                name, stack = stall
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms in task '{name}':\n{stack}")
+            else:
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms")
+    finally:
+        watchdog.stop()
+
+
+def statistics():
+    """Return the event loop lag percentiles (ms) over the last 5 minutes and the number of slow callbacks."""
+    lags = sorted(local_vars['lags'])
+    if not lags:
+        return {}
+    last = len(lags) - 1
+    return {
+        'p50': round(lags[last // 2] * 1000, 1),
+        'p95': round(lags[int(last * 0.95)] * 1000, 1),
+        'p99': round(lags[int(last * 0.99)] * 1000, 1),
+        'max': round(lags[last] * 1000, 1),
+        'slow': local_vars['slow'],
+    }
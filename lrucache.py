@@ -0,0 +1,74 @@
+"""Size-bounded caches with least recently used eviction."""
+
+from collections import OrderedDict
+
+# Every cache by name, for the memory accounting
+caches = {}
+
+
+class LRUCache():
+    """Dictionary holding at most 'maxsize' entries, the least recently used entry is evicted first."""
+    def __init__(self, name, maxsize):
+        """Create and register the cache."""
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        caches[name] = self
+
+    def get(self, key, default=None):
+        """Return the value of a key and mark it as recently used."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __getitem__(self, key):
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        """Return the entries from the least to the most recently used."""
+        return self._entries.items()
+
+    def clear(self):
+        """Remove every entry."""
+        self._entries.clear()
+
+    def statistics(self):
+        """Return the size and hit rate of the cache."""
+        return {
+            'entries': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def statistics():
+    """Return the statistics of every cache."""
+    return {name: cache.statistics() for name, cache in caches.items()}
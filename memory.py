@@ -0,0 +1,95 @@
+"""Memory accounting of each multisma2 subsystem using tracemalloc snapshots."""
+
+import os
+import tracemalloc
+import logging
+
+from aiohttp import web
+
+import lrucache
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import MEMORY_TRACE
+except ImportError:
+    MEMORY_TRACE = False
+
+try:
+    from configuration import MEMORY_TRACE_FRAMES
+except ImportError:
+    MEMORY_TRACE_FRAMES = 10
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Allocations are charged to the innermost multisma2 module on their traceback
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Number of allocation sites listed in a report
+MEMORY_TOP_SITES = 15
+
+local_vars = {
+    'previous': {},
+}
+
+
+def subsystem(traceback):
+    """Return the multisma2 module responsible for an allocation, 'other' for library allocations."""
+    for frame in reversed(traceback):
+        directory, filename = os.path.split(frame.filename)
+        if directory == SOURCE_DIRECTORY and filename.endswith('.py'):
+            return filename[:-3]
+    return 'other'
+
+
+def report():
+    """Return the traced memory of each subsystem and its growth since the previous report."""
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    subsystems = {}
+    for statistic in snapshot.statistics('traceback'):
+        totals = subsystems.setdefault(subsystem(statistic.traceback), {'bytes': 0, 'blocks': 0})
+        totals['bytes'] += statistic.size
+        totals['blocks'] += statistic.count
+
+    previous = local_vars['previous']
+    for name, totals in subsystems.items():
+        totals['growth'] = totals['bytes'] - previous.get(name, totals['bytes'])
+    local_vars['previous'] = {name: totals['bytes'] for name, totals in subsystems.items()}
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'traced': current,
+        'peak': peak,
+        'subsystems': dict(sorted(subsystems.items(), key=lambda item: -item[1]['bytes'])),
+        'top': [str(statistic) for statistic in snapshot.statistics('lineno')[:MEMORY_TOP_SITES]],
+    }
+
+
+async def handle_memory(request):
+    """Serve the /memory endpoint, '?start' and '?stop' control the tracing."""
+    if 'stop' in request.query:
+        tracemalloc.stop()
+        local_vars['previous'] = {}
+        logger.info("Memory tracing stopped")
+    elif 'start' in request.query and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+        logger.info("Memory tracing started")
+
+    result = {'tracing': tracemalloc.is_tracing(), 'caches': lrucache.statistics()}
+    if tracemalloc.is_tracing():
+        result.update(report())
+    return web.json_response(result)
+
+
+#
+# Public
+#
+
+def start():
+    """Trace the allocations from startup if configured."""
+    if MEMORY_TRACE and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+        logger.info(f"Memory tracing enabled ({MEMORY_TRACE_FRAMES} frames)")
@@ -0,0 +1,137 @@
+"""Latency histograms and error counters of the hot-path stages, served in Prometheus text format."""
+
+import time
+import bisect
+import asyncio
+import functools
+import logging
+
+from aiohttp import web
+
+import memory
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import METRICS_PORT
+except ImportError:
+    METRICS_PORT = None
+
+try:
+    from configuration import METRICS_HOST
+except ImportError:
+    METRICS_HOST = '127.0.0.1'
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+# (stage, label) -> [bucket counts, sum, count, errors]
+series = {}
+local_vars = {}
+
+
+def record(stage, label, elapsed, error=False):
+    """Record the latency of one call of a stage."""
+    entry = series.get((stage, label), None)
+    if entry is None:
+        entry = series[(stage, label)] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0]
+    entry[0][bisect.bisect_left(BUCKETS, elapsed)] += 1
+    entry[1] += elapsed
+    entry[2] += 1
+    if error:
+        entry[3] += 1
+
+
+def timed(stage, label=None, failed=None):
+    """Decorator recording the latency and errors of a function or coroutine.
+
+    'label(first_argument)' names the inverter the call belongs to, otherwise it is 'site',
+    and 'failed(result)' tells if a returned result is an error, exceptions are errors.
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await function(*args, **kwargs)
+                except Exception:
+                    record(stage, label(args[0]) if label else 'site', time.perf_counter() - start, True)
+                    raise
+                record(stage, label(args[0]) if label else 'site', time.perf_counter() - start, failed(result) if failed else False)
+                return result
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = function(*args, **kwargs)
+                except Exception:
+                    record(stage, label(args[0]) if label else 'site', time.perf_counter() - start, True)
+                    raise
+                record(stage, label(args[0]) if label else 'site', time.perf_counter() - start, failed(result) if failed else False)
+                return result
+        return wrapper
+    return decorator
+
+
+def prometheus():
+    """Return the metrics in the Prometheus text exposition format."""
+    lines = [
+        '# HELP multisma2_stage_seconds Latency of the multisma2 pipeline stages.',
+        '# TYPE multisma2_stage_seconds histogram',
+    ]
+    for (stage, label), (buckets, total, count, _) in sorted(series.items()):
+        labels = f'stage="{stage}",inverter="{label}"'
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + ['+Inf'], buckets):
+            cumulative += bucket
+            lines.append(f'multisma2_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'multisma2_stage_seconds_sum{{{labels}}} {total}')
+        lines.append(f'multisma2_stage_seconds_count{{{labels}}} {count}')
+
+    lines.append('# HELP multisma2_stage_errors_total Failed calls of the multisma2 pipeline stages.')
+    lines.append('# TYPE multisma2_stage_errors_total counter')
+    for (stage, label), (_, _, _, errors) in sorted(series.items()):
+        lines.append(f'multisma2_stage_errors_total{{stage="{stage}",inverter="{label}"}} {errors}')
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics(request):
+    """Serve the /metrics endpoint."""
+    return web.Response(text=prometheus(), content_type='text/plain')
+
+
+#
+# Public
+#
+
+async def start():
+    """Start the metrics and memory endpoints if a port is configured."""
+    if not METRICS_PORT:
+        return True
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/memory', memory.handle_memory)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.error(f"Unable to start the metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return False
+
+    local_vars['runner'] = runner
+    logger.info(f"Metrics endpoint available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return True
+
+
+async def stop():
+    """Stop the metrics endpoint."""
+    runner = local_vars.pop('runner', None)
+    if runner:
+        await runner.cleanup()
@@ -7,9 +7,16 @@ import random
 import string
 import time
 import logging
+import asyncio
+from collections import deque
 
-import json
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+from mqttbuffer import OutboundBuffer
+from mqttcodec import Codec
+import metrics
 
 from configuration import (
     APPLICATION_LOG_LOGGER_NAME,
@@ -22,9 +29,64 @@ from configuration import (
 )
 
 
+try:
+    from configuration import MQTT_QOS
+except ImportError:
+    MQTT_QOS = 0
+
+try:
+    from configuration import MQTT_QUEUE_SIZE
+except ImportError:
+    MQTT_QUEUE_SIZE = 1000
+
+try:
+    from configuration import MQTT_MAX_INFLIGHT
+except ImportError:
+    MQTT_MAX_INFLIGHT = 20
+
+try:
+    from configuration import MQTT_BATCH_SIZE
+except ImportError:
+    MQTT_BATCH_SIZE = 50
+
+try:
+    from configuration import MQTT_ENCODING
+except ImportError:
+    MQTT_ENCODING = 'json'
+
+try:
+    from configuration import MQTT_V5
+except ImportError:
+    MQTT_V5 = False
+
+try:
+    from configuration import MQTT_BUFFER_BYTES
+except ImportError:
+    MQTT_BUFFER_BYTES = 1024 * 1024
+
+try:
+    from configuration import MQTT_BUFFER_ORDERED_TOPICS
+except ImportError:
+    MQTT_BUFFER_ORDERED_TOPICS = []
+
+try:
+    from configuration import MQTT_BUFFER_SPILL_FILE
+except ImportError:
+    MQTT_BUFFER_SPILL_FILE = None
+
+
 logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 local_vars = {}
 
+# Number of delivery latencies kept for the percentile statistics
+LATENCY_SAMPLES = 500
+
+# Seconds before an undelivered message gives up its inflight window slot
+INFLIGHT_TIMEOUT = 30
+
+# Seconds between the connection attempts after a failed restart(), doubling up to the maximum
+RECONNECT_DELAY = (5, 120)
+
 
 def error_msg(code):
     """Convert a result code to string."""
@@ -39,11 +101,13 @@ def error_msg(code):
     return error_messages.get(str(code), "unknown error code: " + str(code))
 
 
-def on_disconnect(client, userdata, result_code):
+def on_disconnect(client, userdata, result_code, properties=None):
     """Process the on_disconnect callback."""
     # pylint: disable=unused-argument
     client.connected = False
     client.disconnect_failed = False
+    if 'loop' in local_vars:
+        local_vars['loop'].call_soon_threadsafe(reclaim_inflight, 0, True)
     if result_code == mqtt.MQTT_ERR_SUCCESS:
         logger.info(f"MQTT client successfully disconnected")
     else:
@@ -52,70 +116,302 @@ def on_disconnect(client, userdata, result_code):
             f"MQTT client unexpectedly disconnected: {error_msg(result_code)}, trying reconnect()")
 
 
-def on_connect(client, userdata, flags, result_code):
-    """Process the on_connect callback."""
+def on_connect(client, userdata, flags, result_code, properties=None):
+    """Process the on_connect callback, 'properties' is only passed by MQTT 5 connections."""
     # pylint: disable=unused-argument
     if result_code == mqtt.MQTT_ERR_SUCCESS:
+        # start() reads the alias maximum as soon as it sees the connection
+        client.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
         client.connected = True
         logger.info(f"MQTT {userdata['Type']} client successfully connected to {userdata['IP']}:{userdata['Port']}")
+        # Subscriptions and topic aliases only live as long as the connection, wake up
+        # the publisher to replay any messages buffered while disconnected
+        for topic in local_vars.get('handlers', {}).keys():
+            client.subscribe(topic, qos=1)
+        if 'loop' in local_vars:
+            local_vars['loop'].call_soon_threadsafe(reset_topic_aliases, client.topic_alias_maximum)
+            local_vars['loop'].call_soon_threadsafe(local_vars['ready'].set)
     else:
         client.connection_failed = True
         logger.info(f"MQTT client connection failed: {error_msg(result_code)}")
 
 
+def on_publish(client, userdata, mid):
+    """Process the on_publish callback, called from the paho network thread."""
+    # pylint: disable=unused-argument
+    local_vars['loop'].call_soon_threadsafe(delivered, mid)
+
+
+def on_message(client, userdata, message):
+    """Process the on_message callback, the topic handler is run in the event loop."""
+    # pylint: disable=unused-argument
+    handler = local_vars.get('handlers', {}).get(message.topic, None)
+    if handler is None:
+        return
+    properties = getattr(message, 'properties', None)
+    asyncio.run_coroutine_threadsafe(handler(message.payload, properties), local_vars['loop'])
+
+
 def mqtt_exit():
     """Close the MQTT connection when exiting using atexit()."""
     # Disconnect the MQTT client from the broker
-    local_vars['mqtt_client'].loop_stop()
+    client = local_vars.get('mqtt_client', None)
+    if client is None:
+        return
+    client.loop_stop()
     logger.info(f"MQTT client disconnect being called")
-    local_vars['mqtt_client'].disconnect()
+    client.disconnect()
+
+
+def reset_topic_aliases(maximum):
+    """Forget the topic aliases of the previous connection."""
+    local_vars['aliases'] = {}
+    local_vars['alias_maximum'] = maximum
+    local_vars['codec'].schema_changed = True
+
+
+def delivered(mid):
+    """A message was delivered (QoS 1/2) or written to the socket (QoS 0)."""
+    entry = local_vars['inflight'].pop(mid, None)
+    if entry is None:
+        return
+    latency = time.perf_counter() - entry[0]
+    stats = local_vars['stats']
+    stats['delivered'] += 1
+    stats['latencies'].append(latency)
+    local_vars['window'].release()
+
+
+def reclaim_inflight(age, disconnected=False):
+    """Release the window slots of the messages inflight for longer than 'age' seconds.
+
+    paho drops QoS 0 messages that were not written when the connection is lost and never
+    calls on_publish for them, those are buffered again.  QoS 1/2 messages stay with paho,
+    which resends them, so only their slots are released.
+    """
+    inflight = local_vars['inflight']
+    stats = local_vars['stats']
+    oldest = time.perf_counter() - age
+    for mid, (sent, topic, payload) in list(inflight.items()):
+        if sent > oldest:
+            continue
+        del inflight[mid]
+        local_vars['window'].release()
+        if MQTT_QOS == 0:
+            local_vars['buffer'].append(topic, payload)
+        if not disconnected:
+            stats['expired'] += 1
+
+
+@metrics.timed('mqtt_encode')
+def encode(sensors):
+    """Encode a batch of sensor dictionaries, returns a list of (topic, payload)."""
+    codec = local_vars['codec']
+    messages = []
+    for sensor in sensors:
+        if isinstance(sensor, tuple):
+            messages.append(sensor)
+            continue
+        topic = sensor.get('topic', None)
+        if topic is None:
+            logger.warning(f"'topic' not in sensor dictionary: {str(sensor)}")
+            continue
+
+        # Limit floats to the requested precision
+        precision = sensor.get('precision', None)
+        message = {}
+        for key, value in sensor.items():
+            if key in ('topic', 'precision'):
+                continue
+            if precision:
+                if isinstance(value, dict):
+                    value = {k: round(v, precision) for k, v in value.items()}
+                elif isinstance(value, float):
+                    value = round(value, precision)
+            message[key] = value
+
+        full_topic = MQTT_CLIENT + "/" + topic
+        messages.append((full_topic, codec.encode(full_topic, message)))
+    return messages
 
 
 #
 # Public
 #
 
+@metrics.timed('mqtt_publish')
 def publish(sensors):
-    """Publish a dictionary of sensor keys amd values using MQTT."""
-    # Check if MQTT is not connected to a broker or the sensor list is empty
-    if 'mqtt_client' not in local_vars or not sensors:
+    """Queue a list of sensor dictionaries for publishing, returns immediately.
+
+    A (topic, payload) tuple is published as is on the full topic name.
+    """
+    # Check if MQTT is not started or the sensor list is empty, while reconnecting the messages are buffered
+    if 'queue' not in local_vars or not sensors:
         return
 
-    # Separate out the sensor dictionaries
-    for original_sensor in sensors:
-        sensor = original_sensor.copy()
-        if 'topic' not in sensor:
-            logger.warning(f"'topic' not in sensor dictionary: {str(sensor)}")
-            continue
+    queue = local_vars['queue']
+    stats = local_vars['stats']
+    for sensor in sensors:
+        if len(queue) == queue.maxlen:
+            stats['dropped'] += 1
+        queue.append(sensor)
+        stats['queued'] += 1
+    local_vars['ready'].set()
 
-        # Extract the topic and precision from the dictionary
-        topic = sensor.pop('topic')
-        precision = sensor.pop('precision', None)
 
-        # Limit floats to the requested precision
-        for key, value in sensor.items():
-            if isinstance(value, dict):
-                for dict_key, dict_value in value.items():
-                    value[dict_key] = round(dict_value, precision) if precision else dict_value
-            if isinstance(value, float):
-                sensor[key] = round(value, precision) if precision else value
-
-        # Encode each sensor in JSON and publish
-        sensor_json = json.dumps(sensor)
-        message_info = local_vars['mqtt_client'].publish(
-            MQTT_CLIENT + "/" + topic, sensor_json
-        )
+async def run():
+    """Task that encodes the queued sensors in batches and publishes them, surviving a restart()."""
+    if 'queue' not in local_vars:
+        return
+
+    local_vars['running'] = True
+    ready = local_vars['ready']
+    while True:
+        await ready.wait()
+        ready.clear()
+        if 'queue' not in local_vars:
+            continue
+        client = local_vars.get('mqtt_client', None)
+        connected = client is not None and client.connected
+        queue = local_vars['queue']
+        buffer = local_vars['buffer']
+        if connected and local_vars['codec'].schema_changed:
+            announce_schema(client)
+        if connected and buffer:
+            messages = buffer.replay()
+            logger.info(f"MQTT client replaying {len(messages)} buffered messages")
+            await send(client, messages)
+
+        while queue:
+            batch = [queue.popleft() for _ in range(min(MQTT_BATCH_SIZE, len(queue)))]
+            messages = encode(batch)
+            if not connected or not client.connected:
+                for topic, payload in messages:
+                    buffer.append(topic, payload)
+                continue
+            if local_vars['codec'].schema_changed:
+                announce_schema(client)
+            await send(client, messages)
+
+
+def announce_schema(client):
+    """Publish the retained schema message describing the payload encoding of each topic."""
+    message_info = client.publish(MQTT_CLIENT + "/schema", local_vars['codec'].schema(), qos=1, retain=True)
+    if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+        local_vars['codec'].schema_changed = True
+
+
+def topic_alias(topic):
+    """Return the topic and publish properties to use, replacing the topic with an MQTT 5 alias."""
+    maximum = local_vars['alias_maximum']
+    if not maximum:
+        return topic, None
+    aliases = local_vars['aliases']
+    properties = aliases.get(topic, None)
+    if properties:
+        return '', properties
+    if len(aliases) >= maximum:
+        return topic, None
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.TopicAlias = len(aliases) + 1
+    aliases[topic] = properties
+    return topic, properties
+
+
+async def send(client, messages):
+    """Publish encoded messages within the inflight window, buffering them if the connection is lost."""
+    buffer = local_vars['buffer']
+    stats = local_vars['stats']
+    for topic, payload in messages:
+        while True:
+            window = local_vars['window']
+            try:
+                await asyncio.wait_for(window.acquire(), INFLIGHT_TIMEOUT)
+                break
+            except asyncio.TimeoutError:
+                reclaim_inflight(INFLIGHT_TIMEOUT)
+        inflight = local_vars['inflight']
+        alias_topic, properties = topic_alias(topic)
+        message_info = client.publish(alias_topic, payload, qos=MQTT_QOS, properties=properties)
+        if message_info.rc == mqtt.MQTT_ERR_NO_CONN:
+            window.release()
+            local_vars['aliases'] = {}
+            buffer.append(topic, payload)
+            continue
         if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+            window.release()
+            stats['failed'] += 1
             logger.warning(
                 f"MQTT message topic '{topic}'' failed to publish: {error_msg(message_info.rc)}",
             )
+            continue
+        inflight[message_info.mid] = (time.perf_counter(), topic, payload)
+        stats['published'] += 1
+
+
+def subscribe(topic, handler):
+    """Subscribe to a topic below MQTT_CLIENT, 'handler(payload, properties)' is a coroutine."""
+    if 'queue' not in local_vars:
+        return None
+    full_topic = MQTT_CLIENT + "/" + topic
+    local_vars.setdefault('handlers', {})[full_topic] = handler
+    # While reconnecting on_connect() subscribes
+    if 'mqtt_client' in local_vars:
+        local_vars['mqtt_client'].subscribe(full_topic, qos=1)
+    return full_topic
+
+
+def unsubscribe(topic):
+    """Unsubscribe from a topic below MQTT_CLIENT and forget its handler."""
+    if 'queue' not in local_vars:
+        return None
+    full_topic = local_vars['prefix'] + topic
+    if local_vars.get('handlers', {}).pop(full_topic, None) is None:
+        return None
+    if 'mqtt_client' in local_vars:
+        local_vars['mqtt_client'].unsubscribe(full_topic)
+    return full_topic
+
+
+def statistics():
+    """Return the publisher statistics, latencies are in milliseconds."""
+    if 'queue' not in local_vars:
+        return None
+
+    stats = local_vars['stats']
+    latencies = sorted(stats['latencies'])
+    percentile = lambda p: round(latencies[int(p * (len(latencies) - 1))] * 1000, 1) if latencies else None
+    return {
+        'queued': stats['queued'],
+        'published': stats['published'],
+        'delivered': stats['delivered'],
+        'dropped': stats['dropped'],
+        'failed': stats['failed'],
+        'expired': stats['expired'],
+        'inflight': len(local_vars['inflight']),
+        'backlog': len(local_vars['queue']),
+        'buffered': len(local_vars['buffer']),
+        'buffered_bytes': local_vars['buffer'].size()['memory'],
+        'spilled_bytes': local_vars['buffer'].size()['disk'],
+        'coalesced': local_vars['buffer'].coalesced,
+        'buffer_dropped': local_vars['buffer'].dropped,
+        'encoding': local_vars['codec'].encoding,
+        'topic_aliases': len(local_vars['aliases']),
+        'latency_p50': percentile(0.50),
+        'latency_p95': percentile(0.95),
+        'latency_max': round(latencies[-1] * 1000, 1) if latencies else None,
+    }
 
 
-def start():
-    """Tests and caches the client MQTT broker connection."""
-    if not MQTT_ENABLE:
-        return True
+def encoding_statistics():
+    """Return the payload bytes and encoding time per topic compared to JSON."""
+    if 'queue' not in local_vars:
+        return None
+    return local_vars['codec'].statistics()
+
 
+def connect():
+    """Create the client and wait for the broker connection, returns None if it fails (blocks up to 4 seconds)."""
     # Create a unique client name
     local_vars['clientname'] = (
         MQTT_CLIENT
@@ -129,6 +425,7 @@ def start():
     client = mqtt.Client(
         local_vars['clientname'],
         userdata={'IP': MQTT_BROKER_IPADDR, 'Port': port, 'Type': connection_type},
+        protocol=mqtt.MQTTv5 if MQTT_V5 else mqtt.MQTTv311,
     )
 
     # Setup and try to connect to the broker
@@ -169,20 +466,140 @@ def start():
         logger.error(f"MQTT connection failed with exception: {sys.exc_info()[0]}")
         raise
 
-    # Close the connection and return success
-    if client.connected:
-        client.on_disconnect = on_disconnect
-        client.reconnect_delay_set(min_delay=1, max_delay=120)
-        local_vars['mqtt_client'] = client
+    if not client.connected:
+        return None
+    client.on_disconnect = on_disconnect
+    client.on_publish = on_publish
+    client.on_message = on_message
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    return client
+
+
+def disconnect(client):
+    """Stop the network thread of a client and disconnect it (blocks until the thread exits)."""
+    client.loop_stop()
+    client.disconnect()
+
+
+def initialize(client):
+    """Create the publisher state for the first connected client."""
+    local_vars['loop'] = asyncio.get_event_loop()
+    local_vars['queue'] = deque(maxlen=MQTT_QUEUE_SIZE)
+    local_vars['ready'] = asyncio.Event()
+    local_vars['window'] = asyncio.Semaphore(MQTT_MAX_INFLIGHT)
+    local_vars['inflight'] = {}
+    local_vars['codec'] = Codec(MQTT_ENCODING)
+    local_vars['aliases'] = {}
+    local_vars['alias_maximum'] = getattr(client, 'topic_alias_maximum', 0)
+    local_vars['buffer'] = OutboundBuffer(
+        MQTT_BUFFER_BYTES, ordered=MQTT_BUFFER_ORDERED_TOPICS, spill_file=MQTT_BUFFER_SPILL_FILE
+    )
+    local_vars['stats'] = {
+        'queued': 0, 'published': 0, 'delivered': 0, 'dropped': 0, 'failed': 0, 'expired': 0,
+        'latencies': deque(maxlen=LATENCY_SAMPLES),
+    }
+    local_vars['mqtt_client'] = client
+    local_vars['prefix'] = MQTT_CLIENT + "/"
+    if not local_vars.get('atexit', False):
         atexit.register(mqtt_exit)
+        local_vars['atexit'] = True
+
+
+def start():
+    """Tests and caches the client MQTT broker connection."""
+    if not MQTT_ENABLE:
         return True
 
-    # Some sort of error occurred
-    return False
+    client = connect()
+    if client is None:
+        # Some sort of error occurred
+        return False
+    initialize(client)
+    return True
+
+
+async def restart():
+    """Reconnect with the current settings, the queued and buffered messages, inflight window, and subscriptions are kept.
+
+    The old client is stopped and the new one connected in an executor so the event loop keeps running.
+    If the broker does not answer the messages are buffered and the connection is retried in the background.
+    """
+    loop = asyncio.get_event_loop()
+    retry = local_vars.pop('retry', None)
+    if retry:
+        retry.cancel()
+    prefix = local_vars.get('prefix', None)
+    client = local_vars.pop('mqtt_client', None)
+    if client:
+        # The old client must not touch the new connection's inflight messages, its own
+        # messages free their window slots now and waiting senders move on
+        client.on_disconnect = None
+        client.on_publish = None
+        reclaim_inflight(0, True)
+        await loop.run_in_executor(None, disconnect, client)
+        logger.info("MQTT client disconnected for a configuration change")
 
+    if not MQTT_ENABLE:
+        local_vars.pop('queue', None)
+        return False
+
+    # on_connect() subscribes to the handler topics below the new MQTT_CLIENT
+    handlers = local_vars.get('handlers', {})
+    local_vars['handlers'] = {MQTT_CLIENT + "/" + topic[len(prefix):]: handler for topic, handler in handlers.items()}
+    local_vars['prefix'] = MQTT_CLIENT + "/"
+    client = await loop.run_in_executor(None, connect)
+    if client is None:
+        if 'window' in local_vars:
+            local_vars.setdefault('queue', deque(maxlen=MQTT_QUEUE_SIZE))
+            local_vars['retry'] = asyncio.ensure_future(reconnect(RECONNECT_DELAY[0]))
+        return False
+    attach(client)
+    return True
+
+
+async def reconnect(delay):
+    """Retry the connection with an exponential backoff after a failed restart()."""
+    loop = asyncio.get_event_loop()
+    while True:
+        logger.info(f"MQTT client retrying the connection in {delay} seconds")
+        await asyncio.sleep(delay)
+        client = await loop.run_in_executor(None, connect)
+        if client is not None:
+            local_vars.pop('retry', None)
+            attach(client)
+            return
+        delay = min(delay * 2, RECONNECT_DELAY[1])
+
+
+def attach(client):
+    """Publish through a new client, the publisher task and the senders keep using the same event, queue, and window."""
+    if 'window' not in local_vars:
+        initialize(client)
+    else:
+        local_vars['queue'] = deque(local_vars.get('queue', ()), maxlen=MQTT_QUEUE_SIZE)
+        local_vars['aliases'] = {}
+        local_vars['alias_maximum'] = getattr(client, 'topic_alias_maximum', 0)
+        local_vars['codec'].schema_changed = True
+        local_vars['mqtt_client'] = client
+        local_vars['prefix'] = MQTT_CLIENT + "/"
 
-if __name__ == '__main__':
-    test_msg = [{'Topic': 'test', 'Value': 'Test message'}]
-    # Test connection and if successful publish a test message
+    if not local_vars.get('running', False):
+        asyncio.ensure_future(run())
+    local_vars['ready'].set()
+
+
+async def test_publish(test_msg):
+    """Publish a test message and wait for it to be delivered."""
     if start():
         publish(test_msg)
+        task = asyncio.ensure_future(run())
+        await asyncio.sleep(1)
+        task.cancel()
+        print(statistics())
+
+
+if __name__ == '__main__':
+    test_msg = [{'topic': 'test', 'Value': 'Test message'}]
+    # Test connection and if successful publish a test message
+    asyncio.get_event_loop().run_until_complete(test_publish(test_msg))
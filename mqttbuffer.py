@@ -0,0 +1,121 @@
+"""Bounded outbound MQTT buffer used while the broker connection is down."""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+
+class OutboundBuffer():
+    """Holds encoded messages in publishing order with a limit on the memory used.
+
+    Topics that do not start with one of the 'ordered' prefixes are state topics where
+    only the latest value is kept.  When the byte limit is reached the oldest messages
+    are spilled to disk (if a spill file is given) or dropped.
+    """
+    def __init__(self, max_bytes, ordered=None, spill_file=None, max_spill_bytes=None):
+        """Create an empty buffer."""
+        self._max_bytes = max_bytes
+        self._ordered = tuple(ordered or [])
+        self._spill_file = os.path.expanduser(spill_file) if spill_file else None
+        self._max_spill_bytes = max_spill_bytes or 10 * max_bytes
+        self._messages = OrderedDict()
+        self._sequence = 0
+        self._bytes = 0
+        self._spilled_bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+        # Anything left over from a previous run is replayed
+        if self._spill_file and os.path.isfile(self._spill_file):
+            self._spilled_bytes = os.path.getsize(self._spill_file)
+
+    def __len__(self):
+        """Number of messages held in memory."""
+        return len(self._messages)
+
+    def __bool__(self):
+        """True if there are messages waiting for replay."""
+        return bool(self._messages) or self._spilled_bytes > 0
+
+    def size(self):
+        """Return the bytes used by the buffered messages in memory and on disk."""
+        return {'memory': self._bytes, 'disk': self._spilled_bytes}
+
+    def ordered(self, topic):
+        """True if every message for the topic is kept, the client prefix is ignored."""
+        return bool(self._ordered) and topic.split('/', 1)[-1].startswith(self._ordered)
+
+    def append(self, topic, payload):
+        """Add a message, replacing the pending value of a state topic."""
+        if self.ordered(topic):
+            self._sequence += 1
+            key = self._sequence
+        else:
+            key = topic
+            previous = self._messages.pop(key, None)
+            if previous:
+                self._bytes -= message_size(*previous)
+                self.coalesced += 1
+
+        self._messages[key] = (topic, payload)
+        self._bytes += message_size(topic, payload)
+        while self._bytes > self._max_bytes and self._messages:
+            _, oldest = self._messages.popitem(last=False)
+            self._bytes -= message_size(*oldest)
+            self.spill(*oldest)
+
+    def spill(self, topic, payload):
+        """Write an evicted message to the spill file or drop it."""
+        size = message_size(topic, payload)
+        if not self._spill_file or self._spilled_bytes + size > self._max_spill_bytes:
+            self.dropped += 1
+            return
+        try:
+            with open(self._spill_file, 'a') as f:
+                binary = isinstance(payload, bytes)
+                f.write(json.dumps([topic, payload.decode('latin-1') if binary else payload, binary]) + '\n')
+            self._spilled_bytes += size
+        except OSError as e:
+            logger.warning(f"Unable to spill MQTT message to '{self._spill_file}': {e}")
+            self.dropped += 1
+
+    def replay(self):
+        """Remove and return the buffered messages, oldest first."""
+        messages = []
+        if self._spilled_bytes:
+            pending = {message[0] for key, message in self._messages.items() if isinstance(key, str)}
+            spilled = []
+            latest = {}
+            try:
+                with open(self._spill_file, 'r') as f:
+                    for line in f:
+                        topic, payload, binary = json.loads(line)
+                        if binary:
+                            payload = payload.encode('latin-1')
+                        if not self.ordered(topic):
+                            if topic in pending:
+                                continue
+                            if topic in latest:
+                                spilled[latest[topic]] = None
+                            latest[topic] = len(spilled)
+                        spilled.append((topic, payload))
+                messages = [message for message in spilled if message]
+                os.remove(self._spill_file)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Unable to replay the MQTT spill file '{self._spill_file}': {e}")
+            self._spilled_bytes = 0
+
+        messages.extend(self._messages.values())
+        self._messages.clear()
+        self._bytes = 0
+        return messages
+
+
+def message_size(topic, payload):
+    """Approximate memory used by a message."""
+    return len(topic) + len(payload)
@@ -0,0 +1,136 @@
+"""MQTT payload encodings: JSON, MessagePack, CBOR, or a fixed-schema binary layout per topic."""
+
+import json
+import time
+import struct
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+ENCODINGS = ['json', 'msgpack', 'cbor', 'binary']
+
+# One in this many messages is also encoded in JSON to measure the savings
+JSON_SAMPLE_RATE = 20
+
+# Binary layout: little endian, a uint16 schema version followed by the fields
+BINARY_HEADER = '<H'
+BINARY_TYPES = {int: 'i', float: 'f'}
+
+
+class Codec():
+    """Encodes the message dictionaries built by mqtt.encode() and tracks the cost per topic."""
+    def __init__(self, encoding):
+        """Create a codec, unavailable encodings fall back to JSON."""
+        self._dumps = None
+        if encoding == 'msgpack':
+            try:
+                import msgpack
+                self._dumps = msgpack.packb
+            except ImportError:
+                logger.warning("MQTT encoding 'msgpack' requires the msgpack package, using 'json'")
+                encoding = 'json'
+        elif encoding == 'cbor':
+            try:
+                import cbor2
+                self._dumps = cbor2.dumps
+            except ImportError:
+                logger.warning("MQTT encoding 'cbor' requires the cbor2 package, using 'json'")
+                encoding = 'json'
+        elif encoding not in ENCODINGS:
+            logger.warning(f"Unknown MQTT encoding '{encoding}', using 'json'")
+            encoding = 'json'
+
+        self.encoding = encoding
+        self.schema_changed = True
+        self._schemas = {}
+        self._stats = {}
+
+    def encode(self, topic, message):
+        """Return the payload for a message on a topic."""
+        stats = self._stats.get(topic, None)
+        if stats is None:
+            stats = self._stats[topic] = {'messages': 0, 'bytes': 0, 'seconds': 0.0, 'json_messages': 0, 'json_bytes': 0, 'json_seconds': 0.0}
+
+        start = time.perf_counter()
+        if self.encoding == 'json':
+            payload = json.dumps(message)
+        elif self.encoding == 'binary':
+            payload = self.encode_binary(topic, message)
+        else:
+            payload = self._dumps(message)
+        stats['seconds'] += time.perf_counter() - start
+        stats['messages'] += 1
+        stats['bytes'] += len(payload)
+
+        if self.encoding != 'json' and stats['messages'] % JSON_SAMPLE_RATE == 1:
+            start = time.perf_counter()
+            sample = json.dumps(message)
+            stats['json_seconds'] += time.perf_counter() - start
+            stats['json_messages'] += 1
+            stats['json_bytes'] += len(sample)
+        return payload
+
+    def encode_binary(self, topic, message):
+        """Pack the message using the fixed layout for the topic, creating a new layout if the fields change."""
+        fields = []
+        values = []
+        for key, value in message.items():
+            if isinstance(value, dict):
+                for subkey, subvalue in value.items():
+                    fields.append((key, subkey, type(subvalue)))
+                    values.append(subvalue)
+            else:
+                fields.append((key, None, type(value)))
+                values.append(value)
+
+        schema = self._schemas.get(topic, None)
+        if schema is None or schema['fields'] != fields:
+            if not all(field_type in BINARY_TYPES for _, _, field_type in fields):
+                # Strings and other types have no fixed layout so the topic stays in JSON
+                layout = None
+            else:
+                layout = struct.Struct(BINARY_HEADER + ''.join(BINARY_TYPES[t] for _, _, t in fields))
+            version = (schema['version'] + 1) % 65536 if schema else 0
+            schema = {'fields': fields, 'struct': layout, 'version': version}
+            self._schemas[topic] = schema
+            self.schema_changed = True
+
+        if schema['struct'] is None:
+            return json.dumps(message)
+        return schema['struct'].pack(schema['version'], *values)
+
+    def schema(self):
+        """Return the retained schema message that describes how to decode each topic."""
+        self.schema_changed = False
+        topics = {}
+        for topic, schema in self._schemas.items():
+            if schema['struct'] is None:
+                topics[topic] = {'encoding': 'json'}
+                continue
+            topics[topic] = {
+                'encoding': 'binary',
+                'version': schema['version'],
+                'format': schema['struct'].format,
+                'fields': [[key, subkey] for key, subkey, _ in schema['fields']],
+            }
+        return json.dumps({'encoding': self.encoding, 'topics': topics})
+
+    def statistics(self):
+        """Return the average bytes and encoding time per topic compared to JSON."""
+        results = {}
+        for topic, stats in self._stats.items():
+            if not stats['messages']:
+                continue
+            result = {
+                'bytes': round(stats['bytes'] / stats['messages'], 1),
+                'encode_us': round(stats['seconds'] / stats['messages'] * 1e6, 1),
+            }
+            if stats['json_messages']:
+                json_bytes = stats['json_bytes'] / stats['json_messages']
+                result['json_bytes'] = round(json_bytes, 1)
+                result['json_encode_us'] = round(stats['json_seconds'] / stats['json_messages'] * 1e6, 1)
+                result['saved_pct'] = round((1 - result['bytes'] / json_bytes) * 100, 1) if json_bytes else 0.0
+            results[topic] = result
+        return results
@@ -2,6 +2,9 @@
 # Robust initialization and shutdown code courtesy of 
 # https://github.com/wbenny/python-graceful-shutdown.git
 
+# Imported first, the startup phases are timed from here
+import startup
+
 import logging
 import sys
 import os
@@ -13,6 +16,13 @@ import aiohttp
 
 from delayedints import DelayedKeyboardInterrupt
 from pvsite import PVSite
+import metrics
+import api
+import memory
+import profiler
+import reloader
+import loopmonitor
+import eventloop
 import version
 import logfiles
 from exceptions import TerminateSignal, NormalCompletion, AbnormalCompletion, FailedInitialization
@@ -26,17 +36,34 @@ class Multisma2():
 
     def __init__(self):
         """Initialize the Multisma2 instance."""
-        self._loop = asyncio.new_event_loop()
+        self._loop = eventloop.new_event_loop()
         self._session = None
         self._site = None
+        self._running = False
         signal.signal(signal.SIGTERM, self.catch)
         signal.siginterrupt(signal.SIGTERM, False)
+        profiler.install(self._loop)
+        self._loop.add_signal_handler(signal.SIGHUP, self.hangup)
 
     def catch(self, signum, frame):
         """Handler for SIGTERM signals."""
         logger.info("Received SIGTERM signal, forcing shutdown")
         raise TerminateSignal
 
+    def hangup(self):
+        """Handler for SIGHUP signals, reload the configuration."""
+        if not self._running:
+            logger.warning("Received SIGHUP signal during startup or shutdown, ignored")
+            return
+        logger.info("Received SIGHUP signal, reloading the configuration")
+        loopmonitor.create_task(self._areload(), 'reload')
+
+    async def _areload(self):
+        """Apply the changes of the reloaded configuration to the running site."""
+        changed = reloader.reload()
+        if changed and self._site:
+            await self._site.reconfigure(changed)
+
     def run(self):
         """Code to handle the start(), run(), and stop() interfaces."""
         try:
@@ -59,22 +86,34 @@ class Multisma2():
 
     async def _astart(self):
         """Asynchronous initialization code."""
+        startup.mark('imports')
         logfiles.start(logger)
         logger.info(f"multisma2 inverter collection utility {version.get_version()}, PID is {os.getpid()}")
+        logger.info(f"Using the {eventloop.backend_name(self._loop)} event loop")
+        memory.start()
 
         self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False))
         self._site = PVSite(self._session)
         result = await self._site.start()
         if not result: raise FailedInitialization
+        await metrics.start()
+        await api.start()
 
     async def _arun(self):
         """Asynchronous run code."""
-        await self._site.run()
+        self._running = True
+        try:
+            await self._site.run()
+        finally:
+            self._running = False
 
     async def _astop(self):
         """Asynchronous closing code."""
         logger.info("Closing multisma2 application")
         await self._site.stop()
+        await metrics.stop()
+        await api.stop()
+        profiler.stop()
         await self._session.close()
 
     def _start(self):
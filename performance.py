@@ -0,0 +1,59 @@
+"""Live performance ratio of the actual AC/DC power against the clear-sky expectation."""
+
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# No ratio is reported while the clear-sky POA irradiance (W/m^2) is below this
+MINIMUM_IRRADIANCE = 50
+
+# Snapshot topics compared to the expected production
+RATIO_TOPICS = {
+    'ac_measurements/power': 'performance/ac_ratio',
+    'dc_measurements/power': 'performance/dc_ratio',
+}
+
+
+class PerformanceRatio():
+    """Computes the performance ratio of each inverter, string, and the site from a snapshot."""
+    def __init__(self, engine, model):
+        """Create the calculator.
+
+        'engine' supplies the clear-sky POA irradiance of each orientation and 'model'
+        (a clearsky.ArrayModel) converts it to the expected production.
+        """
+        self._engine = engine
+        self._model = model
+
+    def sensors(self, snapshot, timestamp):
+        """Return the expected power and performance ratio sensors for a snapshot, none while the curves are not loaded."""
+        poa = self._engine.value(timestamp)
+        if poa is None or poa.max() < MINIMUM_IRRADIANCE:
+            return []
+
+        expected = dict(zip(self._model.names, self._model.expected(poa).tolist()))
+        sensors = [dict({k: v for k, v in expected.items() if isinstance(k, str)}, topic='performance/expected', precision=1)]
+        for sensor in snapshot:
+            ratio_topic = RATIO_TOPICS.get(sensor.get('topic'), None)
+            if ratio_topic is None:
+                continue
+            ratios = {}
+            for name, value in sensor.items():
+                power = expected.get(name, None)
+                if not power:
+                    continue
+                if isinstance(value, dict):
+                    strings = {k: v / expected[(name, k)] for k, v in value.items() if expected.get((name, k))}
+                    value = value.get(name, None)
+                    if strings and isinstance(value, (int, float)):
+                        strings[name] = value / power
+                        ratios[name] = strings
+                        continue
+                if isinstance(value, (int, float)):
+                    ratios[name] = value / power
+            ratios['topic'] = ratio_topic
+            ratios['precision'] = 3
+            sensors.append(ratios)
+        return sensors
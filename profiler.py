@@ -0,0 +1,113 @@
+"""Profile the running event loop on SIGUSR1/SIGUSR2 without restarting multisma2."""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import cProfile
+import datetime
+import threading
+import logging
+from collections import Counter
+
+from loopmonitor import task_name
+
+from configuration import APPLICATION_LOG_LOGGER_NAME, APPLICATION_LOG_FILE
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Profile duration in seconds for each signal
+PROFILE_SIGNALS = {
+    signal.SIGUSR1: 60,
+    signal.SIGUSR2: 600,
+}
+
+# Interval in seconds between the wall-clock stack samples
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+local_vars = {}
+
+
+def install(loop):
+    """Install the signal handlers that start a profile."""
+    for sig, duration in PROFILE_SIGNALS.items():
+        loop.add_signal_handler(sig, start, loop, duration)
+
+
+def start(loop, duration):
+    """Start a CPU profile and a wall-clock stack sampler that stop after 'duration' seconds."""
+    if 'profile' in local_vars:
+        logger.info("A profile is already running, signal ignored")
+        return
+
+    profile = cProfile.Profile(time.process_time)
+    try:
+        profile.enable()
+    except ValueError as e:
+        logger.warning(f"Unable to start the profiler: {e}")
+        return
+
+    sampler = Sampler(loop, threading.main_thread().ident)
+    sampler.start()
+    local_vars['profile'] = profile
+    local_vars['sampler'] = sampler
+    local_vars['started'] = datetime.datetime.now()
+    loop.call_later(duration, stop)
+    logger.info(f"Profiling the event loop for {duration} seconds")
+
+
+def stop():
+    """Stop profiling and write the pstats and collapsed stack files."""
+    profile = local_vars.pop('profile', None)
+    sampler = local_vars.pop('sampler', None)
+    started = local_vars.pop('started', None)
+    if profile is None:
+        return
+    profile.disable()
+    sampler.stop()
+
+    directory = os.path.dirname(os.path.expanduser(APPLICATION_LOG_FILE))
+    basename = os.path.join(directory, f"profile-{started.strftime('%Y%m%d-%H%M%S')}")
+    try:
+        profile.dump_stats(basename + '.pstats')
+        with open(basename + '.collapsed', 'w') as f:
+            for stack, count in sampler.samples.most_common():
+                f.write(f"{stack} {count}\n")
+    except OSError as e:
+        logger.error(f"Unable to write the profile '{basename}': {e}")
+        return
+    logger.info(f"Profile written to '{basename}.pstats' (CPU) and '{basename}.collapsed' (wall-clock, {sampler.count} samples)")
+
+
+class Sampler(threading.Thread):
+    """Samples the main thread stack and names the asyncio task that is running."""
+    def __init__(self, loop, thread_id):
+        """Create the sampler for the event loop running in 'thread_id'."""
+        super().__init__(name='multisma2-profiler', daemon=True)
+        self._loop = loop
+        self._thread_id = thread_id
+        self._stopped = threading.Event()
+        self.samples = Counter()
+        self.count = 0
+
+    def run(self):
+        """Collect samples until stopped."""
+        while not self._stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id, None)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self._loop)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(task_name(task))
+            self.samples[';'.join(reversed(stack))] += 1
+            self.count += 1
+
+    def stop(self):
+        """Stop sampling and wait for the thread."""
+        self._stopped.set()
+        self.join()
@@ -13,11 +13,22 @@ from astral.sun import sun, elevation, azimuth
 from astral import LocationInfo, now
 
 import clearsky
+import archive
 import version
 
 from inverter import Inverter
+from keyindex import KeyIndex, CACHE
 from influx import InfluxDB
+from baseline import BaselineProvider
+from query import KeyQueryService
+from performance import PerformanceRatio
+from forecast import ProductionForecast
 import mqtt
+import sink
+import metrics
+import api
+import loopmonitor
+import startup
 
 from configuration import SITE_LATITUDE, SITE_LONGITUDE, SITE_NAME, SITE_REGION, TIMEZONE
 from configuration import SITE_PANEL_AREA, SITE_PANEL_EFFICIENCY, SITE_AZIMUTH, SITE_TILT
@@ -27,6 +38,21 @@ from configuration import INVERTERS
 from configuration import INFLUXDB_ENABLE, INFLUXDB_BUCKET, INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG
 from configuration import APPLICATION_LOG_LOGGER_NAME
 
+try:
+    from configuration import INFLUXDB_ROLLUPS
+except ImportError:
+    INFLUXDB_ROLLUPS = None
+
+try:
+    from configuration import FORECAST_HISTORY_DAYS
+except ImportError:
+    FORECAST_HISTORY_DAYS = 14
+
+try:
+    from configuration import MQTT_QUERY_ENABLE
+except ImportError:
+    MQTT_QUERY_ENABLE = False
+
 
 logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
 
@@ -62,6 +88,15 @@ AGGREGATE_KEYS = [
     '6380_40251E00',    # DC power (totals for site and each inverter)
 ]
 
+# Seconds between the reconnection attempts to an unavailable inverter, doubling up to the maximum
+RECONNECT_BACKOFF = (30, 1800)
+
+# INVERTERS entries that need a new session when they change
+INVERTER_CONNECTION_KEYS = ('ip', 'user', 'password')
+
+# Consecutive failed polls after which a running inverter is unavailable and reconnected
+UNAVAILABLE_POLLS = 6
+
 SITE_SNAPSHOT = [
     '6100_40263F00',    # AC grid power (current)
     '6380_40251E00',    # DC power (current)
@@ -71,35 +106,77 @@ SITE_SNAPSHOT = [
     '6180_08414C00',    # Status: Condition
 ]
 
+# The topic names and the snapshot keys can be replaced in configuration.py (and reloaded with SIGHUP)
+try:
+    from configuration import MQTT_TOPICS
+except ImportError:
+    pass
+
+try:
+    from configuration import SITE_SNAPSHOT
+except ImportError:
+    pass
+
 
 class PVSite():
     """Class to describe a PV site with one or more inverters."""
     def __init__(self, session):
         """Create a new PVSite object."""
         self._inverters = []
+        self._unavailable = []
         self._session = session
         self._tasks = None
         self._total_production = None
-        self._cached_keys = []
+        self._keys = KeyIndex()
         self._scaling = 1
         self._daylight = None
         self._task_gather = None
+        self._forecast_task = None
         self._dawn = None
         self._dusk = None
         self._siteinfo = LocationInfo(SITE_NAME, SITE_REGION, TIMEZONE, SITE_LATITUDE, SITE_LONGITUDE)
         self._tzinfo = tz.gettz(TIMEZONE)
+        self._baselines = BaselineProvider(influxdb)
+        self._reconnects = {}
+        self._query = None
+        self._reload_lock = asyncio.Lock()
+        self.build_models()
+
+    def build_models(self):
+        """Create the clear-sky, performance, and forecast models of the site geometry."""
+        self._arrays = clearsky.ArrayModel(INVERTERS, SITE_TILT, SITE_AZIMUTH, SITE_PANEL_AREA, SITE_PANEL_EFFICIENCY)
+        self._irradiance = clearsky.IrradianceEngine(SITE_LATITUDE, SITE_LONGITUDE, self._arrays.orientations, self._tzinfo)
+        self._performance = PerformanceRatio(self._irradiance, self._arrays)
+        self._forecast = ProductionForecast(self._irradiance, self._arrays)
 
     async def start(self):
         """Initialize the PVSite object."""
-        if not influxdb.start(url=INFLUXDB_URL, bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, token=INFLUXDB_TOKEN): return False
-        if not mqtt.start(): return False
-
-        for inverter in INVERTERS:
-            self._inverters.append(Inverter(inverter['name'], inverter['ip'], inverter['user'], inverter['password'], self._session))
-
-        cached_keys = await asyncio.gather(*(inverter.start() for inverter in self._inverters))
-        if None in cached_keys: return False
-        self._cached_keys = cached_keys[0]
+        if not influxdb.start(url=INFLUXDB_URL, bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, token=INFLUXDB_TOKEN, rollups=INFLUXDB_ROLLUPS): return False
+        startup.mark('influxdb')
+        if not sink.start(influxdb): return False
+
+        # With a sink process the collector only needs MQTT to answer queries
+        if (not sink.running() or MQTT_QUERY_ENABLE) and not mqtt.start(): return False
+        startup.mark('mqtt')
+
+        inverters = [Inverter(inverter['name'], inverter['ip'], inverter['user'], inverter['password'], self._session) for inverter in INVERTERS]
+        baselines = await self._baselines.baselines([inverter.name() for inverter in inverters])
+        cached_keys = await asyncio.gather(*(inverter.start(baselines.get(inverter.name())) for inverter in inverters))
+
+        # Start with the inverters that respond, the others are reconnected in the background
+        for inverter, keys in zip(inverters, cached_keys):
+            if keys is None:
+                logger.warning(f"Inverter '{inverter.name()}' is unavailable, it will be added to the site when it responds")
+                self._unavailable.append(inverter)
+            else:
+                self._inverters.append(inverter)
+        if not self._inverters:
+            logger.error("No inverters are available")
+            return False
+        self._keys.refresh(self._inverters, MQTT_TOPICS.keys())
+        self.cache_baselines()
+        self.publish_availability()
+        self.start_query_service()
         return True
 
     async def run(self):
@@ -109,6 +186,10 @@ class PVSite():
             self.update_instantaneous(),
             self.update_total_production(),
         )
+        await self.first_sample()
+
+        # The clear-sky curves and the forecast history are loaded once the first sample is out
+        self._forecast_task = loopmonitor.create_task(self.prepare_forecast(), 'forecast')
 
         queues = {
             '10s': asyncio.Queue(),
@@ -117,22 +198,31 @@ class PVSite():
             '300s': asyncio.Queue(),
         }
         self._task_gather = asyncio.gather(
-                self.daylight(),
-                self.midnight(),
-                self.scheduler(queues),
-                self.task_10s(queues.get('10s')),
-                self.task_30s(queues.get('30s')),
-                self.task_60s(queues.get('60s')),
-                self.task_300s(queues.get('300s')),
+                loopmonitor.create_task(self.daylight(), 'daylight'),
+                loopmonitor.create_task(self.midnight(), 'midnight'),
+                loopmonitor.create_task(self.scheduler(queues), 'scheduler'),
+                loopmonitor.create_task(self.task_10s(queues.get('10s')), 'task_10s'),
+                loopmonitor.create_task(self.task_30s(queues.get('30s')), 'task_30s'),
+                loopmonitor.create_task(self.task_60s(queues.get('60s')), 'task_60s'),
+                loopmonitor.create_task(self.task_300s(queues.get('300s')), 'task_300s'),
+                loopmonitor.create_task(mqtt.run(), 'mqtt'),
+                loopmonitor.create_task(loopmonitor.run(), 'loopmonitor'),
         )
+        for inverter in list(self._unavailable):
+            self.reconnect_later(inverter)
         await self._task_gather
 
     async def stop(self):
         """Shutdown the site."""
         if self._task_gather:
             self._task_gather.cancel()
+        if self._forecast_task:
+            self._forecast_task.cancel()
+        for task in self._reconnects.values():
+            task.cancel()
 
-        await asyncio.gather(*(inverter.stop() for inverter in self._inverters))
+        await asyncio.gather(*(inverter.stop() for inverter in self._inverters + self._unavailable))
+        sink.stop()
         influxdb.stop()
  
     async def solar_data_update(self) -> None:
@@ -147,6 +237,11 @@ class PVSite():
             f"and dusk occurs at {self._dusk.strftime('%H:%M')} "
             f"on this {day_of_year()} day of {astral_now.year}")
 
+        # Today's forecast is ready and published well before dawn
+        midnight = datetime.datetime.combine(astral_now.date(), datetime.time(0, 0), tzinfo=self._tzinfo)
+        self._forecast.new_day(int(midnight.timestamp()))
+        await self.publish_forecast()
+
     async def daylight(self) -> None:
         """Task to determine when it is daylight and daylight changes."""
         SAMPLE_PERIOD = [
@@ -179,32 +274,237 @@ class PVSite():
             midnight = datetime.datetime.combine(tomorrow, datetime.time(0, 5))
             await asyncio.sleep((midnight - now).total_seconds())
 
-            # Update internal sun info and the daily production
+            # Archive yesterday before the curves of a new year are loaded
             logger.info(f"multisma2 inverter collection utility {version.get_version()}, PID is {os.getpid()}")
-            await self.solar_data_update()
-            await asyncio.gather(*(inverter.read_inverter_production() for inverter in self._inverters))
-            await self.update_total_production()
-            influxdb.write_points(self.irradiance_today())
-            influxdb.write_history(await self.get_yesterday_production(), 'production/today')
+            yesterday_production = await self.guarded("read yesterday's production", self.get_yesterday_production)
+            await self.guarded("archive yesterday", self.archive_yesterday, yesterday_production)
+
+            # Update internal sun info and the daily production, each step runs even if an earlier one failed
+            await self.guarded("load the clear-sky curves", self.load_irradiance)
+            await self.guarded("update the solar data", self.solar_data_update)
+            await self.guarded("read the inverter production", self.read_inverter_production)
+            await self.guarded("update the total production", self.update_total_production)
+            await self.guarded("write today's irradiance and yesterday's production", self.write_daily, yesterday_production)
+
+    async def guarded(self, step, call, *args):
+        """Run a step of the daily or reload sequence, an error is logged and None returned so the sequence goes on."""
+        try:
+            return await call(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Unable to {step}: {e}")
+            return None
+
+    async def write_daily(self, yesterday_production):
+        """Write today's clear-sky production curves and yesterday's production history."""
+        sink.write('write_points', self.irradiance_today())
+        if yesterday_production is not None:
+            sink.write('write_history', yesterday_production, 'production/today')
+
+    async def archive_yesterday(self, production):
+        """Write yesterday's samples, production history, and expected clear-sky production to the archive."""
+        if not archive.ARCHIVE_ENABLE:
+            return
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        start = int(datetime.datetime.combine(yesterday, datetime.time(0, 0)).timestamp())
+        stop = int(datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0)).timestamp())
+        timestamps, poa = self._irradiance.irradiance(start, stop - 1, clearsky.ENGINE_RESOLUTION)
+        await archive.archive(yesterday, {
+            'samples': archive.sample_columns(self._inverters, start, stop - 0.001),
+            'history': archive.history_columns(production) if production is not None else None,
+            'clearsky': archive.clearsky_columns(timestamps, self._arrays.names, self._arrays.expected(poa)) if poa is not None else None,
+        })
+
+    async def first_sample(self):
+        """Publish the first snapshot as soon as the site is up and report the startup timing."""
+        sensors = await self.snapshot()
+        sink.publish(sensors)
+        sink.write('write_sma_sensors', sensors)
+        self.update_api(snapshot=sensors)
+        sink.publish(startup.report())
+
+    async def prepare_forecast(self):
+        """Load the clear-sky curves in the background, then learn and publish today's forecast."""
+        try:
+            await self.load_irradiance()
+            startup.mark('irradiance')
+            today = datetime.datetime.combine(now(tzinfo=self._tzinfo).date(), datetime.time(0, 0), tzinfo=self._tzinfo)
+            self._forecast.new_day(int(today.timestamp()))
+            await self.learn_forecast()
+            await self.publish_forecast()
+            startup.mark('forecast')
+            logger.info(f"Clear-sky curves and today's forecast ready after {startup.local_vars['phases']['forecast']:.2f}s")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Unable to prepare the clear-sky curves and forecast: {e}")
+
+    async def load_irradiance(self):
+        """Map this year's clear-sky curves, computing them in a helper process if needed."""
+        year = self._irradiance.year(time.time())
+        await self._irradiance.prepare(year)
+        await asyncio.get_event_loop().run_in_executor(None, self._irradiance.load, year)
+
+    async def learn_forecast(self):
+        """Learn the forecast ratios from the recent inverter history."""
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time(0, 0), tzinfo=self._tzinfo)
+        first_day = today - datetime.timedelta(days=FORECAST_HISTORY_DAYS)
+        history = await self.get_production_history(int(first_day.timestamp()), int(today.timestamp()))
+        ratio = await asyncio.get_event_loop().run_in_executor(
+            None, self._forecast.learn_history, history, int(first_day.timestamp()), FORECAST_HISTORY_DAYS
+        )
+        self._forecast.set_ratio(ratio)
+
+    async def publish_forecast(self):
+        """Publish today's forecast and write the forecast curve."""
+        sink.publish(self._forecast.sensors())
+        sink.write('write_points', self._forecast.line_protocol())
 
     def irradiance_today(self):
-        # Create location object to store lat, lon, timezone
-        site = clearsky.site_location(SITE_LATITUDE, SITE_LONGITUDE, tz=TIMEZONE)
+        """Get today's clear-sky production curves of each inverter and the site from dawn to dusk in line protocol."""
         dawn = self._dawn
         dusk = self._dusk + datetime.timedelta(minutes=10)
-        start = datetime.datetime(dawn.year, dawn.month, dawn.day, dawn.hour, int(int(dawn.minute/10)*10))
-        stop = datetime.datetime(dusk.year, dusk.month, dusk.day, dusk.hour, int(int(dusk.minute/10)*10))
-
-        # Get irradiance data for today and convert to InfluxDB line protocol
-        irradiance = clearsky.get_irradiance(site=site, start=start.strftime("%Y-%m-%d %H:%M:00"), end=stop.strftime("%Y-%m-%d %H:%M:00"), tilt=SITE_TILT, azimuth=SITE_AZIMUTH, freq='10min')
+        start = datetime.datetime(dawn.year, dawn.month, dawn.day, dawn.hour, int(int(dawn.minute/10)*10), tzinfo=dawn.tzinfo)
+        stop = datetime.datetime(dusk.year, dusk.month, dusk.day, dusk.hour, int(int(dusk.minute/10)*10), tzinfo=dusk.tzinfo)
+
+        # Slice today's irradiance from the yearly curves and convert to InfluxDB line protocol
+        timestamps, poa = self._irradiance.irradiance(int(start.timestamp()), int(stop.timestamp()), 600)
+        if poa is None:
+            return []
+        production = self._arrays.expected(poa).round(1)
+        timestamps = timestamps.tolist()
         lp_points = []
-        for point in irradiance:
-            t = point['t']
-            v = point['v'] * SITE_PANEL_AREA * SITE_PANEL_EFFICIENCY
-            lp = f'production,inverter=site irradiance={round(v, 1)} {t}'
-            lp_points.append(lp)
+        for name, values in zip(self._arrays.names, production.tolist()):
+            if not isinstance(name, str):
+                continue
+            lp_points.extend(f'production,inverter={name} irradiance={v} {t}' for t, v in zip(timestamps, values))
         return lp_points
 
+    async def read_inverter_production(self):
+        """Update the production baselines of each inverter for the new periods."""
+        baselines = await self._baselines.baselines([inverter.name() for inverter in self._inverters])
+        await asyncio.gather(
+            *(inverter.read_inverter_production(baselines.get(inverter.name())) for inverter in self._inverters)
+        )
+        self.cache_baselines()
+
+    def cache_baselines(self):
+        """Save the production baselines so a restart does not need the inverter history."""
+        for inverter in self._inverters:
+            self._baselines.update(inverter.name(), inverter.production_baselines())
+        self._baselines.save()
+
+    def reconnect_later(self, inverter, delay=RECONNECT_BACKOFF[0]):
+        """Start the task reconnecting an unavailable inverter."""
+        name = inverter.name()
+        task = loopmonitor.create_task(self.reconnect(inverter, delay), f"reconnect {name}")
+        self._reconnects[name] = task
+
+        def done(task):
+            if self._reconnects.get(name, None) is task:
+                del self._reconnects[name]
+        task.add_done_callback(done)
+
+    async def reconnect(self, inverter, delay):
+        """Retry starting an unavailable inverter with an exponential backoff, then add it to the site."""
+        first, maximum = RECONNECT_BACKOFF
+        await inverter.stop()
+        while True:
+            await asyncio.sleep(delay)
+            baselines = await self._baselines.baselines([inverter.name()])
+            keys = await inverter.start(baselines.get(inverter.name()))
+            if keys is not None:
+                break
+            delay = min(max(delay * 2, first), maximum)
+            logger.info(f"Inverter '{inverter.name()}' is still unavailable, retrying in {delay} seconds")
+
+        # Replace the list so a composite being built keeps the inverters it started with
+        order = [inverter['name'] for inverter in INVERTERS]
+        self._unavailable.remove(inverter)
+        self._inverters = sorted(self._inverters + [inverter], key=lambda i: order.index(i.name()))
+        self._keys.refresh(self._inverters, MQTT_TOPICS.keys())
+        self.cache_baselines()
+        logger.info(f"Inverter '{inverter.name()}' is available and has been added to the site")
+        self.publish_availability()
+
+    def start_query_service(self):
+        """Start the MQTT key query service if it is enabled, or stop it if it has been disabled."""
+        if MQTT_QUERY_ENABLE and self._query is None:
+            self._query = KeyQueryService(self)
+            self._query.start()
+        elif not MQTT_QUERY_ENABLE and self._query is not None:
+            self._query.stop()
+            self._query = None
+
+    async def reconfigure(self, changed):
+        """Apply the settings changed by a configuration reload, the rest of the site keeps running."""
+        async with self._reload_lock:
+            names = set(changed.keys())
+            if any(name.startswith('INFLUXDB_') for name in names):
+                influxdb.restart(INFLUXDB_ENABLE, url=INFLUXDB_URL, bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, token=INFLUXDB_TOKEN, rollups=INFLUXDB_ROLLUPS)
+            if any(name.startswith('MQTT_') for name in names - {'MQTT_TOPICS', 'MQTT_QUERY_ENABLE'}) and (not sink.running() or MQTT_QUERY_ENABLE):
+                await mqtt.restart()
+            if any(name.startswith(('MQTT_', 'INFLUXDB_')) for name in names - {'MQTT_TOPICS', 'MQTT_QUERY_ENABLE'}):
+                await sink.restart()
+            if 'MQTT_QUERY_ENABLE' in names:
+                if MQTT_QUERY_ENABLE and 'queue' not in mqtt.local_vars:
+                    await mqtt.restart()
+                self.start_query_service()
+            if 'INVERTERS' in names:
+                await self.update_inverters(changed['INVERTERS'][0] or [])
+            if names & {'MQTT_TOPICS', 'SITE_SNAPSHOT', 'INVERTERS'}:
+                self._keys.refresh(self._inverters, MQTT_TOPICS.keys())
+            if names & {'INVERTERS', 'SITE_LATITUDE', 'SITE_LONGITUDE', 'SITE_TILT', 'SITE_AZIMUTH', 'SITE_PANEL_AREA', 'SITE_PANEL_EFFICIENCY'}:
+                self._siteinfo = LocationInfo(SITE_NAME, SITE_REGION, TIMEZONE, SITE_LATITUDE, SITE_LONGITUDE)
+                self.build_models()
+                await self.guarded("load the clear-sky curves", self.load_irradiance)
+                await self.guarded("update the solar data", self.solar_data_update)
+                await self.guarded("learn the forecast", self.learn_forecast)
+                await self.guarded("publish the forecast", self.publish_forecast)
+
+    async def update_inverters(self, previous):
+        """Stop the inverters removed from INVERTERS, start the new ones, and restart those with new connection settings.
+
+        Geometry changes ('arrays', 'area', ...) keep the session, reconfigure() rebuilds the models.
+        """
+        connection = lambda inverter: tuple(inverter.get(key, None) for key in INVERTER_CONNECTION_KEYS) if inverter else None
+        configured = {inverter['name']: inverter for inverter in INVERTERS}
+        previous = {inverter['name']: inverter for inverter in previous}
+        changed = [name for name, inverter in configured.items() if connection(previous.get(name, None)) != connection(inverter)]
+        removed = [name for name in previous.keys() if name not in configured] + changed
+
+        for inverter in [inverter for inverter in self._inverters + self._unavailable if inverter.name() in removed]:
+            task = self._reconnects.get(inverter.name(), None)
+            if task:
+                task.cancel()
+            await inverter.stop()
+            logger.info(f"Inverter '{inverter.name()}' has been removed from the site")
+            api.remove(f'inverters/{inverter.name()}')
+        self._inverters = [inverter for inverter in self._inverters if inverter.name() not in removed]
+        self._unavailable = [inverter for inverter in self._unavailable if inverter.name() not in removed]
+
+        # New inverters are started like unavailable inverters, without waiting
+        for name in changed:
+            inverter = configured[name]
+            inverter = Inverter(inverter['name'], inverter['ip'], inverter['user'], inverter['password'], self._session)
+            self._unavailable.append(inverter)
+            self.reconnect_later(inverter, 0)
+        self.publish_availability()
+
+    def publish_availability(self):
+        """Publish the inverter availability to MQTT and the API."""
+        availability = self.availability()
+        sink.publish(availability)
+        api.update('availability', availability[0])
+
+    def availability(self):
+        """Get the availability of each configured inverter."""
+        availability = {inverter.name(): 'online' for inverter in self._inverters}
+        availability.update({inverter.name(): 'offline' for inverter in self._unavailable})
+        availability['topic'] = 'inverters/availability'
+        return [availability]
+
     async def scheduler(self, queues):
         """Task to schedule actions at regular intervals."""
         SLEEP = 0.5
@@ -235,9 +535,15 @@ class PVSite():
             sensors = await asyncio.gather(
                 self.snapshot(),
             )
+            sensors.append(await self.performance_ratio(sensors[0]))
+            if self.is_daylight():
+                self._forecast.update(time.time(), sensors[0])
             for sensor in sensors:
-                mqtt.publish(sensor)
-                influxdb.write_sma_sensors(sensor)
+                sink.publish(sensor)
+                sink.write('write_sma_sensors', sensor)
+            energy = await self.energy()
+            sink.publish(energy)
+            self.update_api(snapshot=sensors[0], performance=sensors[1], energy=energy)
 
     async def task_30s(self, queue):
         """Work done every 30 seconds."""
@@ -248,7 +554,7 @@ class PVSite():
                 self.inverter_efficiency(),
             )
             for sensor in sensors:
-                mqtt.publish(sensor)
+                sink.publish(sensor)
 
     async def task_60s(self, queue):
         """Work done every 60 seconds."""
@@ -260,13 +566,14 @@ class PVSite():
                 self.co2_avoided(),
             )
             for sensor in sensors:
-                mqtt.publish(sensor)
+                sink.publish(sensor)
+            self.update_api(production=sensors[0], co2avoided=sensors[1])
             sensors = await asyncio.gather(
                 self.sun_position(),
             )
             for sensor in sensors:
-                mqtt.publish(sensor)
-                influxdb.write_sma_sensors(sensor)
+                sink.publish(sensor)
+                sink.write('write_sma_sensors', sensor)
 
     async def task_300s(self, queue):
         """Work done every 300 seconds (5 minutes)."""
@@ -277,11 +584,43 @@ class PVSite():
                 self.total_production(),
             )
             for sensor in sensors:
-                influxdb.write_sma_sensors(sensor)
-
-    async def update_instantaneous(self):
-        """Update the instantaneous cache from the inverter."""
-        await asyncio.gather(*(inverter.read_instantaneous() for inverter in self._inverters))
+                sink.write('write_sma_sensors', sensor)
+            if self.is_daylight():
+                await self.publish_forecast()
+            sink.check()
+            sink.publish(await self.sink_statistics())
+            sink.publish(await self.mqtt_statistics())
+            sink.publish(await self.mqtt_encoding())
+            sink.publish(await self.loop_lag())
+
+    def update_api(self, **sensors):
+        """Replace the API resources with the latest sensors and the state of each inverter, nothing is done without the API server."""
+        if not api.running():
+            return
+        for name, sensor in sensors.items():
+            api.update(name, sensor)
+        for inverter in self._inverters:
+            state = inverter.state()
+            if state is not None:
+                api.update(f'inverters/{inverter.name()}', state)
+
+    async def update_instantaneous(self, record=True):
+        """Update the instantaneous cache from the inverter, on-demand reads pass 'record=False' to keep them out of the samples."""
+        inverters = self._inverters
+        await asyncio.gather(*(inverter.read_instantaneous(record) for inverter in inverters))
+        for inverter in inverters:
+            if inverter.failed_polls >= UNAVAILABLE_POLLS and inverter in self._inverters:
+                await self.remove_unavailable(inverter)
+
+    async def remove_unavailable(self, inverter):
+        """Move an inverter that stopped responding to the unavailable inverters and reconnect it in the background."""
+        logger.warning(f"Inverter '{inverter.name()}' failed {inverter.failed_polls} polls in a row, it will be added back when it responds")
+        # Replace the list so a composite being built keeps the inverters it started with
+        self._inverters = [i for i in self._inverters if i is not inverter]
+        self._unavailable.append(inverter)
+        self._keys.refresh(self._inverters, MQTT_TOPICS.keys())
+        self.publish_availability()
+        self.reconnect_later(inverter)
 
     async def get_yesterday_production(self):
         """Get the total production meter values for the previous day."""
@@ -295,6 +634,7 @@ class PVSite():
     async def get_production_history(self, start, stop):
         """Get the production totals for a given period and create a site total."""
         production = await asyncio.gather(*(inverter.read_history(start, stop) for inverter in self._inverters))
+        production = [inverter for inverter in production if inverter]
         total = {}
         for inverter in production:
             for i in range(1, len(inverter)):
@@ -330,6 +670,8 @@ class PVSite():
                 total = 0
                 for inverter in inverter_periods:
                     for inverter_name, history_value in inverter.items():
+                        if inverter_name not in total_production:
+                            continue
                         period_total = total_production[inverter_name] - history_value
                         total += period_total
                         period_stats[inverter_name] = period_total
@@ -423,10 +765,68 @@ class PVSite():
         efficiencies['topic'] = 'ac_measurements/efficiency'
         return [efficiencies]
 
+    async def mqtt_statistics(self):
+        """Get the MQTT publisher queue and delivery statistics, published by the sink process when there is one."""
+        statistics = mqtt.statistics() if not sink.running() else None
+        if not statistics:
+            return []
+        statistics['topic'] = 'mqtt/statistics'
+        return [statistics]
+
+    async def sink_statistics(self):
+        """Get the messages handed to the sink process and the messages dropped because it fell behind."""
+        statistics = sink.statistics()
+        if not statistics:
+            return []
+        statistics['topic'] = 'sink/statistics'
+        return [statistics]
+
+    async def mqtt_encoding(self):
+        """Get the MQTT payload size and encoding time per topic compared to JSON."""
+        statistics = mqtt.encoding_statistics() if not sink.running() else None
+        if not statistics:
+            return []
+        statistics['topic'] = 'mqtt/encoding'
+        return [statistics]
+
+    async def loop_lag(self):
+        """Get the event loop lag percentiles and the number of slow callbacks."""
+        statistics = loopmonitor.statistics()
+        if not statistics:
+            return []
+        statistics['topic'] = 'loop/lag'
+        statistics['unit'] = 'ms'
+        return [statistics]
+
     async def snapshot(self):
         """Get the values of interest from each inverter."""
         return await self.get_composite(SITE_SNAPSHOT)
 
+    async def energy(self):
+        """Get the production of today and of the current hour integrated from the AC power of each inverter."""
+        today = {}
+        hour = {}
+        for inverter in self._inverters:
+            energy = inverter.energy()
+            if energy is None:
+                continue
+            today[inverter.name()] = energy['today']
+            hour[inverter.name()] = energy['hour']
+        if not today:
+            return []
+        today['site'] = sum(today.values())
+        hour['site'] = sum(hour.values())
+        return [
+            dict(today, topic='energy/today', unit='Wh', precision=3),
+            dict(hour, topic='energy/hour', unit='Wh', precision=3),
+        ]
+
+    async def performance_ratio(self, snapshot):
+        """Compare the snapshot AC and DC power to the clear-sky expectation."""
+        if not self.is_daylight():
+            return []
+        return self._performance.sensors(snapshot, time.time())
+
     async def total_production(self):
         """Get the total production of each inverter and the total of all inverters."""
         return await self.get_composite(["6400_0046C300"])
@@ -435,14 +835,15 @@ class PVSite():
         """Read a list of keys from the cache or the inverter(s)."""
         return await self.get_composite(keys)
 
+    @metrics.timed('composite')
     async def get_composite(self, keys):
         """Get the key values of each inverter and optionally create a site total."""
         sensors = []
         for key in keys:
-            if self.cached_key(key):
-                results = await asyncio.gather(*(inverter.get_state(key) for inverter in self._inverters))
-            else:
-                results = await asyncio.gather(*(inverter.read_key(key) for inverter in self._inverters))
+            results = await asyncio.gather(*(
+                inverter.get_state(key) if source == CACHE else inverter.read_key(key)
+                for inverter, source in self._keys.sources(key)
+            ))
 
             composite = {}
             total = 0
@@ -470,10 +871,32 @@ class PVSite():
 
         return sensors
 
+    def known_key(self, key):
+        """Determines if any inverter supports a key."""
+        return self._keys.known(key)
+
     def cached_key(self, key):
-        """Determines if a key in the inverter cache."""
-        cached = key in self._cached_keys
-        return cached
+        """Determines if a key is in the cache of any inverter."""
+        return self._keys.cached(key)
+
+    def recent_samples(self, series, seconds):
+        """Get the mean, minimum, maximum, and rate per second of a series over the last seconds from each inverter."""
+        statistics = {}
+        for inverter in self._inverters:
+            samples = inverter.samples()
+            if samples is None or series not in samples.series:
+                continue
+            statistics[inverter.name()] = {
+                'mean': samples.mean(series, seconds),
+                'min': samples.min(series, seconds),
+                'max': samples.max(series, seconds),
+                'rate': samples.rate(series, seconds),
+            }
+        return statistics
+
+    def instantaneous_age(self):
+        """Return the age in seconds of the oldest instantaneous inverter states, infinite without inverters."""
+        return max((inverter.instantaneous_age() for inverter in self._inverters), default=float('inf'))
 
     def find_total_production(self, period):
         """Find the total production for a given period."""
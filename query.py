@@ -0,0 +1,150 @@
+"""MQTT request/response service for reading inverter keys and history on demand."""
+
+import json
+import time
+import asyncio
+import logging
+
+from aiohttp import client_exceptions
+
+import mqtt
+from lrucache import LRUCache
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Topic receiving the requests, responses go to 'query/response/<id>' unless a response topic below MQTT_CLIENT is given
+QUERY_REQUEST_TOPIC = 'query/request'
+QUERY_RESPONSE_TOPIC = 'query/response/'
+
+# Limits on a single request
+QUERY_MAX_KEYS = 50
+QUERY_MAX_HISTORY = 31 * 24 * 60 * 60
+
+# Default age in seconds of cached values that are still answered without an inverter call
+QUERY_MAX_AGE = 15
+
+# Recent results kept for reuse
+QUERY_CACHE_SIZE = 256
+
+
+class KeyQueryService():
+    """Answers key and history requests, merging concurrent requests into one inverter call.
+
+    Request: {"id": "1", "keys": ["6100_40263F00"], "max_age": 15}
+             {"id": "2", "history": {"start": 1611032400, "stop": 1611075600}}
+             {"id": "3", "recent": {"series": "6380_40251E00/a", "seconds": 600}}
+    Response: {"id": "1", "sensors": [...]}, {"id": "2", "history": [...]},
+              {"id": "3", "recent": {"inv0": {"mean": ..., "min": ..., "max": ..., "rate": ...}}} or {"id": ..., "error": "..."}
+    """
+    def __init__(self, site):
+        """Create the service for a PVSite."""
+        self._site = site
+        self._inflight = {}
+        self._results = LRUCache('query', QUERY_CACHE_SIZE)
+
+    def start(self):
+        """Subscribe to the request topic."""
+        topic = mqtt.subscribe(QUERY_REQUEST_TOPIC, self.handle)
+        if topic:
+            logger.info(f"MQTT key query service listening on '{topic}'")
+
+    def stop(self):
+        """Unsubscribe from the request topic, requests already being answered still complete."""
+        topic = mqtt.unsubscribe(QUERY_REQUEST_TOPIC)
+        if topic:
+            logger.info(f"MQTT key query service stopped listening on '{topic}'")
+
+    async def handle(self, payload, properties):
+        """Handle a request message and publish the response."""
+        prefix = mqtt.MQTT_CLIENT + "/"
+        response_topic = getattr(properties, 'ResponseTopic', None) if properties else None
+        request_id = None
+        try:
+            request = json.loads(payload)
+            request_id = str(request.get('id', ''))
+            response_topic = request.get('response_topic', response_topic)
+            if response_topic is not None and (not isinstance(response_topic, str) or not response_topic.startswith(prefix)):
+                response_topic = None
+                raise ValueError(f"the response topic must start with '{prefix}'")
+            if not response_topic:
+                response_topic = prefix + QUERY_RESPONSE_TOPIC + request_id
+            response = {'id': request_id}
+            if 'keys' in request:
+                response['sensors'] = await self.read_keys(request['keys'], request.get('max_age', QUERY_MAX_AGE))
+            elif 'history' in request:
+                response['history'] = await self.read_history(int(request['history']['start']), int(request['history']['stop']))
+            elif 'recent' in request:
+                response['recent'] = self._site.recent_samples(str(request['recent']['series']), float(request['recent']['seconds']))
+            else:
+                response['error'] = "request needs 'keys', 'history', or 'recent'"
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            response = {'id': request_id, 'error': f"invalid request: {e}"}
+        except (client_exceptions.ClientError, asyncio.TimeoutError) as e:
+            response = {'id': request_id, 'error': f"inverter request failed: {e or type(e).__name__}"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"MQTT query {request_id} failed: {e}")
+            response = {'id': request_id, 'error': f"request failed: {e or type(e).__name__}"}
+
+        if not isinstance(response_topic, str) or not response_topic.startswith(prefix):
+            if request_id is None:
+                logger.warning(f"Discarding MQTT query without an id or response topic: {response.get('error')}")
+                return
+            response_topic = prefix + QUERY_RESPONSE_TOPIC + request_id
+
+        mqtt.publish([(response_topic, json.dumps(response))])
+
+    async def read_keys(self, keys, max_age):
+        """Read the keys from the instantaneous values if fresh enough, otherwise from the inverters."""
+        if not isinstance(keys, list) or len(keys) > QUERY_MAX_KEYS:
+            raise ValueError(f"'keys' must be a list of at most {QUERY_MAX_KEYS} keys")
+        unknown = [key for key in keys if not isinstance(key, str) or not self._site.known_key(key)]
+        if unknown:
+            raise ValueError(f"no inverter supports the keys {unknown}")
+
+        if self._site.instantaneous_age() > max_age and any(self._site.cached_key(key) for key in keys):
+            await self.single_flight('instantaneous', max_age, self.update_instantaneous)
+
+        sensors = await asyncio.gather(*(self.read_key(key, max_age) for key in keys))
+        return [sensor for sensor in sensors if sensor]
+
+    async def read_key(self, key, max_age):
+        """Return the composite sensor of a single key."""
+        if self._site.cached_key(key):
+            return (await self._site.read_keys([key]))[0]
+        return await self.single_flight(key, max_age, lambda: self.read_live_key(key))
+
+    async def read_live_key(self, key):
+        """Read a key that is not part of the instantaneous values from each inverter."""
+        return (await self._site.read_keys([key]))[0]
+
+    async def update_instantaneous(self):
+        """Refresh the instantaneous values of every inverter, the refresh is not a recent sample."""
+        await self._site.update_instantaneous(record=False)
+
+    async def read_history(self, start, stop):
+        """Read the production history of each inverter and the site."""
+        if not 0 < stop - start <= QUERY_MAX_HISTORY:
+            raise ValueError(f"'history' range must be positive and at most {QUERY_MAX_HISTORY} seconds")
+        return await self.single_flight(('history', start, stop), QUERY_MAX_AGE, lambda: self._site.get_production_history(start, stop))
+
+    async def single_flight(self, signature, max_age, call):
+        """Run 'call()' once for concurrent requests with the same signature and reuse recent results."""
+        now = time.time()
+        result = self._results.get(signature, None)
+        if result and now - result[0] <= max_age:
+            return result[1]
+        for stale in [s for s, (t, _) in self._results.items() if now - t > QUERY_MAX_AGE]:
+            del self._results[stale]
+
+        task = self._inflight.get(signature, None)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._inflight[signature] = task
+            task.add_done_callback(lambda _: self._inflight.pop(signature, None))
+        value = await asyncio.shield(task)
+        self._results[signature] = (time.time(), value)
+        return value
@@ -0,0 +1,70 @@
+"""Re-read configuration.py and rebind the changed settings in the multisma2 modules."""
+
+import os
+import sys
+import importlib
+import logging
+
+import configuration
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Settings only used during startup
+RESTART_SETTINGS = [
+    'APPLICATION_LOG_FILE',
+    'APPLICATION_LOG_FORMAT',
+    'APPLICATION_LOG_LEVEL',
+    'API_HOST',
+    'API_PORT',
+    'METRICS_HOST',
+    'METRICS_PORT',
+    'MEMORY_TRACE',
+    'MEMORY_TRACE_FRAMES',
+    'SINK_PROCESS',
+    'SINK_RING_BYTES',
+]
+
+
+def settings():
+    """Return the current settings of the configuration module."""
+    return {name: value for name, value in vars(configuration).items() if name.isupper()}
+
+
+def rebind(name, value):
+    """Replace a setting in every multisma2 module that imported it."""
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if module is configuration or not filename or not hasattr(module, name):
+            continue
+        if os.path.dirname(os.path.abspath(filename)) == SOURCE_DIRECTORY:
+            setattr(module, name, value)
+
+
+#
+# Public
+#
+
+def reload():
+    """Re-read configuration.py, returns {name: (previous, current)} for the changed settings or None on error."""
+    previous = settings()
+    try:
+        importlib.reload(configuration)
+    except Exception as e:
+        vars(configuration).update(previous)
+        logger.error(f"Unable to reload the configuration, keeping the current settings: {e}")
+        return None
+
+    current = settings()
+    changed = {name: (previous.get(name, None), value) for name, value in current.items() if previous.get(name, None) != value}
+    for name in previous.keys() - current.keys():
+        logger.warning(f"'{name}' was removed from the configuration, restart multisma2 to use its default")
+    for name, (_, value) in changed.items():
+        rebind(name, value)
+        if name in RESTART_SETTINGS:
+            logger.warning(f"'{name}' was changed, restart multisma2 to apply it")
+    logger.info(f"Configuration reloaded, changed settings: {', '.join(changed.keys()) or 'none'}")
+    return changed
@@ -0,0 +1,94 @@
+"""Fixed-memory ring buffer of recent samples with zero-copy windows."""
+
+import numpy as np
+
+
+class RingBuffer():
+    """The last 'capacity' samples of a set of series sharing one timestamp per sample.
+
+    Every sample is written twice, at its position and one capacity later, so the most
+    recent samples are always a contiguous slice and windows are numpy views.
+    """
+    def __init__(self, series, capacity):
+        """Allocate the buffer for a list of series names."""
+        self.series = list(series)
+        self.capacity = capacity
+        self._rows = {name: row for row, name in enumerate(self.series)}
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        self._values = np.full((len(self.series), 2 * capacity), np.nan, dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        """Add a sample, 'values' has one entry per series in order."""
+        position = self._next
+        self._times[position] = self._times[position + self.capacity] = timestamp
+        self._values[:, position] = values
+        self._values[:, position + self.capacity] = values
+        self._next = (position + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def copy(self, other):
+        """Copy the most recent samples of the series this (empty) buffer shares with another buffer."""
+        count = min(len(other), self.capacity)
+        span = other._span()
+        times = other._times[span][len(other) - count:]
+        self._times[:count] = self._times[self.capacity:self.capacity + count] = times
+        for name, row in self._rows.items():
+            if name in other._rows:
+                values = other._values[other._rows[name], span][len(other) - count:]
+                self._values[row, :count] = self._values[row, self.capacity:self.capacity + count] = values
+        self._next = count % self.capacity
+        self._count = count
+
+    def _span(self):
+        """Return the slice of the doubled arrays holding the samples, oldest first."""
+        stop = self._next + self.capacity
+        return slice(stop - self._count, stop)
+
+    def slice(self, name, start=None, stop=None):
+        """Return (timestamps, values) views of a series from start up to stop (timestamps)."""
+        span = self._span()
+        times = self._times[span]
+        first = 0 if start is None else np.searchsorted(times, start, side='left')
+        last = len(times) if stop is None else np.searchsorted(times, stop, side='right')
+        return times[first:last], self._values[self._rows[name], span][first:last]
+
+    def window(self, name, seconds):
+        """Return (timestamps, values) views of the last 'seconds' of a series."""
+        if not self._count:
+            return self.slice(name)
+        latest = self._times[(self._next - 1) % self.capacity]
+        return self.slice(name, start=latest - seconds)
+
+    def latest(self, name):
+        """Return (timestamp, value) of the most recent sample, None if empty."""
+        if not self._count:
+            return None
+        position = (self._next - 1) % self.capacity
+        return self._times[position], self._values[self._rows[name], position]
+
+    def mean(self, name, seconds):
+        """Return the mean of a series over the last 'seconds', None without samples."""
+        _, values = self.window(name, seconds)
+        return float(np.nanmean(values)) if len(values) and not np.isnan(values).all() else None
+
+    def min(self, name, seconds):
+        """Return the minimum of a series over the last 'seconds', None without samples."""
+        _, values = self.window(name, seconds)
+        return float(np.nanmin(values)) if len(values) and not np.isnan(values).all() else None
+
+    def max(self, name, seconds):
+        """Return the maximum of a series over the last 'seconds', None without samples."""
+        _, values = self.window(name, seconds)
+        return float(np.nanmax(values)) if len(values) and not np.isnan(values).all() else None
+
+    def rate(self, name, seconds):
+        """Return the change per second of a series over the last 'seconds', None with less than two samples."""
+        times, values = self.window(name, seconds)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        return float((values[-1] - values[0]) / (times[-1] - times[0]))
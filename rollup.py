@@ -0,0 +1,83 @@
+"""Streaming rollup of sensor points into min/mean/max/last aggregates."""
+
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Rollup windows in seconds, the names are used to select the target bucket
+ROLLUP_WINDOWS = {
+    '1m': 60,
+    '15m': 900,
+    '1h': 3600,
+}
+
+# Measurements that are aggregated, status fields are enumerations and are not averaged
+ROLLUP_MEASUREMENTS = [
+    'ac_measurements',
+    'dc_measurements',
+    'production',
+    'sun',
+    'performance',
+]
+
+
+class Rollup():
+    """Keeps in-memory aggregates for each window and emits them when a window closes."""
+    def __init__(self, windows):
+        """Create the rollup, 'windows' is a list of window names from ROLLUP_WINDOWS."""
+        self._windows = {name: ROLLUP_WINDOWS[name] for name in windows}
+        self._series = {name: {} for name in self._windows}
+
+    def add(self, measurement, tags, fields, ts):
+        """Add the fields of a point and return {window: [line protocol]} for closed windows."""
+        closed = {}
+        if measurement not in ROLLUP_MEASUREMENTS:
+            return closed
+
+        for name, seconds in self._windows.items():
+            window_start = ts - ts % seconds
+            series_key = (measurement, tags)
+            series = self._series[name].get(series_key, None)
+            if series and series['start'] != window_start:
+                closed[name] = [to_line(measurement, tags, series)]
+                series = None
+            if series is None:
+                series = {'start': window_start, 'fields': {}}
+                self._series[name][series_key] = series
+
+            aggregates = series['fields']
+            for field, value in fields.items():
+                aggregate = aggregates.get(field, None)
+                if aggregate is None:
+                    aggregates[field] = [value, value, value, 1, value]
+                    continue
+                if value < aggregate[0]: aggregate[0] = value
+                if value > aggregate[1]: aggregate[1] = value
+                aggregate[2] += value
+                aggregate[3] += 1
+                aggregate[4] = value
+
+        return closed
+
+    def flush(self):
+        """Return {window: [line protocol]} for all open windows and reset the rollup."""
+        flushed = {}
+        for name, series in self._series.items():
+            lines = [to_line(measurement, tags, s) for (measurement, tags), s in series.items()]
+            if lines:
+                flushed[name] = lines
+            series.clear()
+        return flushed
+
+
+def to_line(measurement, tags, series):
+    """Convert a series aggregate to line protocol, all values are written as floats."""
+    fields = []
+    for field, (v_min, v_max, v_sum, count, v_last) in series['fields'].items():
+        fields.append(
+            f"{field}_min={float(v_min)},{field}_mean={round(v_sum / count, 3)},"
+            f"{field}_max={float(v_max)},{field}_last={float(v_last)}"
+        )
+    return f"{measurement}{tags} {','.join(fields)} {series['start']}"
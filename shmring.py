@@ -0,0 +1,137 @@
+"""Single producer, single consumer message ring in shared memory."""
+
+import struct
+import multiprocessing
+
+from multiprocessing import shared_memory
+
+# The write and read positions are on separate cache lines of the header, in units of 8 bytes
+HEADER = 128
+HEAD = 0
+TAIL = 8
+CAPACITY = 1
+
+# Seconds to wait for the lock, a process that died holding it must not block the other one
+LOCK_TIMEOUT = 0.1
+
+# Length prefix of a message, WRAP tells the reader to continue at the start of the ring
+LENGTH = struct.Struct('<I')
+WRAP = 0xFFFFFFFF
+
+
+class SharedRing():
+    """Variable length messages in a shared memory block, one process puts and another gets.
+
+    The positions are running byte counts, only the producer moves the head and only the
+    consumer moves the tail, each after its message bytes are in place.  A full ring makes
+    put() fail instead of waiting, so the producer never blocks on the consumer.
+    The positions are read and moved holding a process shared lock, its acquire and release
+    are memory barriers so the message bytes are visible before the position that publishes
+    them, also on weakly ordered CPUs (ARM).  The lock is only held for the position update,
+    if it cannot be taken within LOCK_TIMEOUT put() drops the message and get() finds nothing.
+
+    The ring is passed to the other process as a Process argument, which attaches it.
+    """
+    def __init__(self, name=None, size=0, lock=None):
+        """Create a ring of 'size' bytes, or attach to the ring 'name' created by another process."""
+        if name is None:
+            lock = multiprocessing.get_context('spawn').Lock()
+        elif lock is None:
+            raise ValueError("attaching to a ring needs its lock, pass the ring as a Process argument")
+        self._lock = lock
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=HEADER + size)
+            self._memory.buf[:HEADER] = bytes(HEADER)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self._owner = name is None
+        self._buffer = self._memory.buf
+        self._positions = self._buffer[:HEADER].cast('Q')
+        if self._owner:
+            self._positions[CAPACITY] = size
+        self._capacity = self._positions[CAPACITY]
+
+    def __getstate__(self):
+        """Pass the name and the lock to a new process."""
+        return self.name, self._lock
+
+    def __setstate__(self, state):
+        """Attach to the ring in a new process."""
+        name, lock = state
+        self.__init__(name, lock=lock)
+
+    def replace_lock(self):
+        """Use a new lock, only while no other process is attached (the last one may have died holding the lock)."""
+        self._lock = multiprocessing.get_context('spawn').Lock()
+
+    def positions(self):
+        """Return (head, tail), None if the lock is not available."""
+        if not self._lock.acquire(timeout=LOCK_TIMEOUT):
+            return None
+        try:
+            return self._positions[HEAD], self._positions[TAIL]
+        finally:
+            self._lock.release()
+
+    def move(self, index, position):
+        """Store the head or tail position, returns False if the lock is not available."""
+        if not self._lock.acquire(timeout=LOCK_TIMEOUT):
+            return False
+        self._positions[index] = position
+        self._lock.release()
+        return True
+
+    def __len__(self):
+        """Return the number of bytes waiting."""
+        positions = self.positions()
+        return positions[0] - positions[1] if positions else 0
+
+    def put(self, message):
+        """Add a message, returns False if it does not fit."""
+        capacity = self._capacity
+        positions = self.positions()
+        if positions is None:
+            return False
+        head, tail = positions
+        free = capacity - (head - tail)
+        need = LENGTH.size + len(message)
+        offset = head % capacity
+        skip = capacity - offset if offset + need > capacity else 0
+        if skip + need > free:
+            return False
+        if skip:
+            if skip >= LENGTH.size:
+                LENGTH.pack_into(self._buffer, HEADER + offset, WRAP)
+            offset = 0
+        LENGTH.pack_into(self._buffer, HEADER + offset, len(message))
+        self._buffer[HEADER + offset + LENGTH.size:HEADER + offset + need] = message
+        return self.move(HEAD, head + skip + need)
+
+    def get(self):
+        """Remove and return the oldest message, None if the ring is empty."""
+        capacity = self._capacity
+        positions = self.positions()
+        if positions is None:
+            return None
+        head, tail = positions
+        if tail == head:
+            return None
+        offset = tail % capacity
+        if capacity - offset < LENGTH.size or LENGTH.unpack_from(self._buffer, HEADER + offset)[0] == WRAP:
+            tail += capacity - offset
+            offset = 0
+        length = LENGTH.unpack_from(self._buffer, HEADER + offset)[0]
+        start = HEADER + offset + LENGTH.size
+        message = bytes(self._buffer[start:start + length])
+        if not self.move(TAIL, tail + LENGTH.size + length):
+            return None
+        return message
+
+    def close(self):
+        """Detach from the ring, the creator also frees it."""
+        self._positions.release()
+        self._buffer = None
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
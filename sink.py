@@ -0,0 +1,302 @@
+"""MQTT and InfluxDB output, written in-process or handed to a sink process through shared memory.
+
+With SINK_PROCESS the collector (this process) only polls and decodes the inverters, every
+publish() and write() is pickled into a SharedRing read by the sink process, which runs
+the MQTT publisher and the InfluxDB writes.  A slow broker, database, or garbage collection
+in the sink then never delays a poll, a full ring drops the message instead of waiting.
+"""
+
+import os
+import sys
+import time
+import pickle
+import signal
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import mqtt
+import metrics
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import SINK_PROCESS
+except ImportError:
+    SINK_PROCESS = False
+
+try:
+    from configuration import SINK_RING_BYTES
+except ImportError:
+    SINK_RING_BYTES = 4 * 1024 * 1024
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# Sink polling interval, doubling while the ring stays empty
+SINK_POLL_INTERVAL = (0.001, 0.05)
+
+# Seconds between the sink statistics
+SINK_STATISTICS_INTERVAL = 300
+
+# Seconds the sink process has to drain the ring and flush at shutdown
+SINK_STOP_TIMEOUT = 10
+
+# Number of handoff latencies kept for the percentile statistics
+LATENCY_SAMPLES = 1000
+
+local_vars = {}
+
+
+def forward(target, method, args):
+    """Put a call in the ring for the sink process, counted as dropped if the ring is full."""
+    start = time.perf_counter()
+    stats = local_vars['stats']
+    message = pickle.dumps((stats['sent'] + stats['dropped'], time.monotonic(), target, method, args), pickle.HIGHEST_PROTOCOL)
+    if local_vars['ring'].put(message):
+        stats['sent'] += 1
+        stats['bytes'] += len(message)
+        metrics.record('sink_handoff', 'site', time.perf_counter() - start)
+    else:
+        stats['dropped'] += 1
+        metrics.record('sink_handoff', 'site', time.perf_counter() - start, True)
+
+
+def start_process():
+    """Start the sink process reading the ring, any previous sink process must have exited."""
+    # A sink that died may have held the ring lock
+    local_vars['ring'].replace_lock()
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=sink_main, args=(local_vars['ring'], os.getpid()), name='multisma2-sink', daemon=True)
+    process.start()
+    local_vars['process'] = process
+    logger.info(f"Started the sink process, PID is {process.pid}")
+
+
+#
+# Sink process
+#
+
+def sink_main(ring, parent):
+    """Entry point of the sink process, 'ring' is the SharedRing attached by the process start."""
+    import logfiles
+
+    # The collector stops the sink with a message once it has stopped polling, or kills it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logfiles.start(logger, '-sink')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        started = loop.run_until_complete(consume(ring, parent))
+    finally:
+        ring.close()
+        loop.close()
+    if not started:
+        # The collector starts the sink again on its next check()
+        sys.exit(1)
+
+
+async def consume(ring, parent):
+    """Start MQTT and InfluxDB, then run the calls read from the ring until stopped, returns False if either fails to start."""
+    from influx import InfluxDB
+    from configuration import INFLUXDB_ENABLE, INFLUXDB_BUCKET, INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG
+    try:
+        from configuration import INFLUXDB_ROLLUPS
+    except ImportError:
+        INFLUXDB_ROLLUPS = None
+
+    influxdb = InfluxDB(INFLUXDB_ENABLE)
+    if not influxdb.start(url=INFLUXDB_URL, bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, token=INFLUXDB_TOKEN, rollups=INFLUXDB_ROLLUPS):
+        logger.error("The sink process is unable to open InfluxDB, exiting")
+        return False
+    if not mqtt.start():
+        logger.error("The sink process is unable to connect to the MQTT broker, exiting")
+        influxdb.stop()
+        return False
+    publisher = asyncio.ensure_future(mqtt.run())
+    targets = {'mqtt': mqtt, 'influxdb': influxdb}
+
+    # InfluxDB writes block, they run one at a time beside the MQTT publisher
+    loop = asyncio.get_event_loop()
+    writer = ThreadPoolExecutor(max_workers=1)
+    writes = deque()
+    stats = {'received': 0, 'lost': 0, 'bytes': 0, 'latencies': deque(maxlen=LATENCY_SAMPLES), 'next': None}
+    report = time.monotonic() + SINK_STATISTICS_INTERVAL
+    interval = SINK_POLL_INTERVAL[0]
+    running = True
+    while running:
+        message = ring.get()
+        if message is None:
+            if os.getppid() != parent:
+                logger.warning("The collector process is gone, stopping the sink process")
+                break
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, SINK_POLL_INTERVAL[1])
+            continue
+        interval = SINK_POLL_INTERVAL[0]
+
+        sequence, sent, target, method, args = pickle.loads(message)
+        stats['latencies'].append(time.monotonic() - sent)
+        if stats['next'] is not None:
+            stats['lost'] += sequence - stats['next']
+        stats['next'] = sequence + 1
+        stats['received'] += 1
+        stats['bytes'] += len(message)
+        if target is None:
+            running = False
+        elif target == 'influxdb':
+            writes.append((method, loop.run_in_executor(writer, getattr(influxdb, method), *args)))
+        else:
+            getattr(targets[target], method)(*args)
+
+        while writes and writes[0][1].done():
+            write_failed(*writes.popleft())
+        if time.monotonic() > report:
+            report = time.monotonic() + SINK_STATISTICS_INTERVAL
+            mqtt.publish(handoff_statistics(stats))
+            if mqtt.statistics():
+                mqtt.publish([dict(mqtt.statistics(), topic='mqtt/statistics')])
+                mqtt.publish([dict(mqtt.encoding_statistics(), topic='mqtt/encoding')])
+        await asyncio.sleep(0)
+
+    await asyncio.gather(*(future for _, future in writes), return_exceptions=True)
+    for method, future in writes:
+        write_failed(method, future)
+    writer.shutdown()
+    influxdb.stop()
+    deadline = time.monotonic() + SINK_STOP_TIMEOUT
+    while mqtt.local_vars.get('queue') and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    publisher.cancel()
+    logger.info(f"Sink process stopped after {stats['received']} messages")
+    return True
+
+
+def write_failed(method, future):
+    """Log the error of a finished InfluxDB write."""
+    error = future.exception()
+    if error is not None:
+        logger.error(f"InfluxDB '{method}' failed in the sink process: {error}")
+
+
+def handoff_statistics(stats):
+    """Return the handoff sensor, latencies are in milliseconds."""
+    latencies = sorted(stats['latencies'])
+    if not latencies:
+        return []
+    return [{
+        'topic': 'sink/handoff',
+        'received': stats['received'],
+        'lost': stats['lost'],
+        'bytes': stats['bytes'],
+        'latency_p50': round(latencies[len(latencies) // 2] * 1000, 3),
+        'latency_p99': round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 3),
+        'latency_max': round(latencies[-1] * 1000, 3),
+    }]
+
+
+#
+# Public
+#
+
+def start(influxdb):
+    """Write to 'influxdb' and MQTT in-process, or start the sink process if SINK_PROCESS is set."""
+    local_vars['influxdb'] = influxdb
+    if not SINK_PROCESS:
+        return True
+    try:
+        from shmring import SharedRing
+    except ImportError:
+        logger.error("The sink process needs Python 3.8 or later, writing in-process")
+        return True
+
+    local_vars['ring'] = SharedRing(size=SINK_RING_BYTES)
+    local_vars['stats'] = {'sent': 0, 'dropped': 0, 'bytes': 0}
+    start_process()
+    return True
+
+
+def running():
+    """Return True if the output is handed to a sink process."""
+    return 'ring' in local_vars
+
+
+def publish(sensors):
+    """Publish a list of sensors to MQTT."""
+    if 'ring' in local_vars:
+        if sensors:
+            forward('mqtt', 'publish', (sensors,))
+    else:
+        mqtt.publish(sensors)
+
+
+def write(method, *args):
+    """Call an InfluxDB write method, 'write_sma_sensors', 'write_points', or 'write_history'."""
+    if 'ring' in local_vars:
+        forward('influxdb', method, args)
+    else:
+        getattr(local_vars['influxdb'], method)(*args)
+
+
+def check():
+    """Restart the sink process if it has exited, the messages still in the ring are kept."""
+    process = local_vars.get('process', None)
+    if process is None or process.is_alive():
+        return
+    logger.error(f"The sink process exited with code {process.exitcode}, restarting it")
+    start_process()
+
+
+async def restart():
+    """Restart the sink process to apply new MQTT or InfluxDB settings."""
+    process = local_vars.pop('process', None)
+    if process is None:
+        return
+    while not stop_message() and process.is_alive():
+        await asyncio.sleep(SINK_POLL_INTERVAL[1])
+    await asyncio.get_event_loop().run_in_executor(None, join, process)
+    # Two sink processes reading the ring would corrupt its read position
+    if process.is_alive():
+        logger.error("The sink process is still running, not starting a new one")
+        local_vars['process'] = process
+        return
+    start_process()
+
+
+def statistics():
+    """Return the collector side handoff counters, None when writing in-process."""
+    if 'ring' not in local_vars:
+        return None
+    return dict(local_vars['stats'], waiting=len(local_vars['ring']))
+
+
+def stop_message():
+    """Put the message stopping the sink process once it has drained the ring, returns False if the ring is full."""
+    stats = local_vars['stats']
+    if not local_vars['ring'].put(pickle.dumps((stats['sent'] + stats['dropped'], time.monotonic(), None, None, ()))):
+        return False
+    stats['sent'] += 1
+    return True
+
+
+def join(process):
+    """Wait for the sink process to exit, killing it after SINK_STOP_TIMEOUT (it ignores SIGTERM)."""
+    process.join(SINK_STOP_TIMEOUT)
+    if process.is_alive():
+        logger.warning("The sink process did not stop, killing it")
+        process.kill()
+        process.join()
+
+
+def stop():
+    """Stop the sink process and free the ring."""
+    if 'ring' not in local_vars:
+        return
+    process = local_vars.pop('process', None)
+    if process:
+        while not stop_message() and process.is_alive():
+            time.sleep(SINK_POLL_INTERVAL[1])
+        join(process)
+    local_vars.pop('ring').close()
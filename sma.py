@@ -11,6 +11,8 @@ import async_timeout
 import jmespath
 from aiohttp import client_exceptions
 
+import metrics
+
 from configuration import APPLICATION_LOG_LOGGER_NAME
 
 logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
@@ -45,6 +47,7 @@ class SMA:
         self.sma_sid = None
         self.sma_uid = uid
 
+    @metrics.timed('sma_fetch', label=lambda sma: sma._url, failed=lambda body: isinstance(body, dict) and 'err' in body)
     async def _fetch_json(self, url, payload):
         """Fetch json data for requests."""
         params = {
@@ -0,0 +1,49 @@
+"""Startup phase timing and the time to the first sample, measured from the multisma2 imports."""
+
+import time
+import resource
+import logging
+
+from configuration import APPLICATION_LOG_LOGGER_NAME
+
+try:
+    from configuration import STARTUP_TARGET
+except ImportError:
+    STARTUP_TARGET = 30
+
+logger = logging.getLogger(APPLICATION_LOG_LOGGER_NAME)
+
+# multisma2.py imports this module first
+STARTED = time.perf_counter()
+
+local_vars = {
+    'phases': {},
+}
+
+
+def mark(phase):
+    """Record the end of a startup phase, a phase run by each inverter ends with the last one."""
+    local_vars['phases'][phase] = time.perf_counter() - STARTED
+
+
+def report():
+    """Log the time taken by each phase and return it as a sensor, called once the first sample is out."""
+    mark('first_sample')
+    phases = sorted(local_vars['phases'].items(), key=lambda item: item[1])
+    previous = 0
+    steps = []
+    for phase, elapsed in phases:
+        steps.append(f"{phase} {elapsed - previous:.2f}s")
+        previous = elapsed
+    total = local_vars['phases']['first_sample']
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(f"Startup phases: {', '.join(steps)}")
+    logger.info(f"First sample after {total:.2f}s (target {STARTUP_TARGET}s), peak memory {max_rss:.1f} MB")
+    if total > STARTUP_TARGET:
+        logger.warning(f"Time to first sample of {total:.2f}s exceeds the {STARTUP_TARGET}s target")
+
+    sensor = dict(phases)
+    sensor['max_rss_mb'] = max_rss
+    sensor['topic'] = 'startup'
+    sensor['precision'] = 2
+    return [sensor]